@@ -1,21 +1,240 @@
 import os
 import uuid
-import requests
+import functools
+import base64
 from flask import Flask, render_template, request, jsonify, Response
-from interpreter import interpreter
+from interpreter import OpenInterpreter
 import json
-import threading
-import queue
 import sys
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from dotenv import load_dotenv
+
+# Settings are read when the modules below are imported, so the .env file must be loaded first
+load_dotenv(dotenv_path=os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), '.env'))
+
+from utils.session_manager import SessionManager, SessionLimitError, DEFAULT_SESSION_ID
+from utils.wire_format import negotiate_stream_encoder, SseJsonEncoder, UnsupportedStreamFormat
+from utils.chunk_coalescer import ChunkCoalescer
+from utils.replay_buffer import ReplayBuffer, iter_events
+from utils.chunk_pipeline import ChunkTranslator
+from utils.output_spill import OutputSpillStore, OutputNotFound, HANDLE_PATTERN, attach_output_handles, without_output_handles
+from utils.tts_cache import TtsCache
+from utils.tts_engines import OpenAiTts, OrpheusTts, TtsError, synthesize_cached, stream_cached
+from utils.upstream import upstreams, UpstreamError
+from utils.model_catalogue import ModelCatalogue
+from utils.llm_router import LlmRouter, parse_api_bases
+from utils.admission import AdmissionController, AdmissionRejected, CodeExecutionGate
+from utils.conversation_store import ConversationStore, owner_key
+from utils.context_budget import ContextManager
+from utils.blob_store import BlobStore, BLOB_ID_PATTERN, blob_media_type
+from utils.conversation_tree import turn_start
+from utils.history_view import MAX_PAGE, history_etag, history_page, parse_fields
+from utils.markdown_stream import MarkdownStream, markdown_available
+from utils.speech_rewrite import SpeechRewriter
+from utils.tts_prefetch import TtsPrefetcher, SpeechStream, AUDIO_HANDLE_PATTERN, audio_media_type
+from utils.tts_batch import TtsBatchSynthesizer, BATCH_MEDIA_TYPE, MAX_BATCH_SEGMENTS, encode_batch_frame, split_sentences
 
 app = Flask(__name__)
 
-# Queue for storing messages from interpreter
-message_queue = queue.Queue()
+# Settings applied to every newly created interpreter; /settings and startup update these
+interpreter_defaults = {
+    'auto_run': True,  # Auto-run code without confirmation
+    'model': "gpt-4",  # Default model, can be changed through UI
+}
+
+def apply_interpreter_settings(target, settings):
+    """Apply a dict of settings to an interpreter instance"""
+    for key, value in settings.items():
+        if key == 'auto_run':
+            target.auto_run = value
+        else:
+            setattr(target.llm, key, value)
+
+# Trims, elides and summarizes what each model request resends of the conversation (CONTEXT_POLICY=off disables)
+context_manager = ContextManager(
+    policy=os.environ.get('CONTEXT_POLICY', 'trim'),
+    elide_tokens=int(os.environ.get('CONTEXT_ELIDE_TOKENS', 2000)),
+    keep_turns=int(os.environ.get('CONTEXT_KEEP_TURNS', 2)),
+    get_client=upstreams.openai if os.environ.get('OPENAI_API_KEY') else None,
+    summary_model=os.environ.get('CONTEXT_SUMMARY_MODEL', 'gpt-4o-mini'),
+    upstream=upstreams.get('openai')
+)
+
+# Images and large code and output in finished turns are stored by hash, messages keep references (BLOB_THRESHOLD=0 disables)
+blob_store = BlobStore(
+    os.path.expanduser(os.environ.get('BLOB_DIR') or os.path.join('~', '.oi-web-ui', 'blobs')),
+    memory_bytes=int(os.environ.get('BLOB_CACHE_MEMORY_MB', 32)) * 1024 * 1024,
+    threshold=int(os.environ.get('BLOB_THRESHOLD', 16384))
+)
+
+def create_interpreter():
+    """Build a new interpreter configured with the current defaults"""
+    new_interpreter = OpenInterpreter()
+    apply_interpreter_settings(new_interpreter, interpreter_defaults)
+    context_manager.attach(new_interpreter)
+    # Attached last, so model requests (and the context policy) see the full content
+    blob_store.attach(new_interpreter)
+    return new_interpreter
+
+# Large code output goes to per-session files instead of the stream (OUTPUT_SPILL_THRESHOLD=0 disables)
+output_store = OutputSpillStore(
+    os.environ.get('OUTPUT_SPILL_DIR') or os.path.join(tempfile.gettempdir(), 'oi-web-output'),
+    threshold=int(os.environ.get('OUTPUT_SPILL_THRESHOLD', 65536))
+)
+
+# Synthesized speech, keyed by a hash of (engine, model, voice, format, text)
+tts_cache = TtsCache(
+    memory_bytes=int(os.environ.get('TTS_CACHE_MEMORY_MB', 32)) * 1024 * 1024,
+    directory=os.environ.get('TTS_CACHE_DIR') or os.path.join(tempfile.gettempdir(), 'oi-web-tts-cache'),
+    disk_bytes=int(os.environ.get('TTS_CACHE_DISK_MB', 512)) * 1024 * 1024
+)
+openai_tts = OpenAiTts()
+orpheus_tts = OrpheusTts()
+
+# Rewrites text the way a person would say it and picks an emotion for the avatar (SPEECH_REWRITE=false disables)
+speech_rewriter = SpeechRewriter(
+    upstreams.openai,
+    model=os.environ.get('SPEECH_REWRITE_MODEL', 'gpt-4o-mini'),
+    max_entries=int(os.environ.get('SPEECH_REWRITE_CACHE_SIZE', 1024)),
+    ttl=float(os.environ.get('SPEECH_REWRITE_TTL', 3600)),
+    enabled=os.environ.get('SPEECH_REWRITE', 'true').lower() in ('1', 'true', 'yes')
+            and bool(os.environ.get('OPENAI_API_KEY')),
+    upstream=upstreams.get('openai')
+)
+
+# Synthesizes the sentences of spoken replies while the reply is still streaming (TTS_PREFETCH_WORKERS=0 disables)
+tts_prefetcher = TtsPrefetcher(
+    tts_cache,
+    max_workers=int(os.environ.get('TTS_PREFETCH_WORKERS', 2)),
+    max_pending=int(os.environ.get('TTS_PREFETCH_MAX_PENDING', 32)),
+    rewriter=speech_rewriter
+)
+# Seconds a request for prefetched audio waits for its synthesis to finish
+TTS_PREFETCH_WAIT = float(os.environ.get('TTS_PREFETCH_WAIT', 60))
+
+# Concurrent synthesis requests per backend for the batch endpoints
+tts_batch = TtsBatchSynthesizer(tts_cache, concurrency={
+    openai_tts.name: int(os.environ.get('TTS_BATCH_CONCURRENCY_OPENAI', 4)),
+    orpheus_tts.name: int(os.environ.get('TTS_BATCH_CONCURRENCY_ORPHEUS', 2)),
+})
+
+# Conversations are saved block by block, so they survive restarts and session eviction
+conversation_store = ConversationStore(
+    os.path.expanduser(os.environ.get('CONVERSATION_DB') or os.path.join('~', '.oi-web-ui', 'conversations.db'))
+)
+
+def restore_conversation(session_id, target):
+    """Reload a conversation's saved messages into a session's new interpreter"""
+    messages = conversation_store.load(session_id)
+    if messages:
+        # The spill files of an earlier session are gone, and older rows may still name them
+        messages = without_output_handles(messages)
+        # Conversations saved before payloads were moved out don't bring them back into memory
+        blob_store.externalize(messages)
+        target.messages = messages
+        print(f"[Conversations] Restored {len(messages)} messages into session {session_id}", file=sys.stderr)
+
+def save_conversation(session, start):
+    """Store a session's messages from index start, logging rather than failing the chat on errors"""
+    try:
+        # Spill files don't outlive the session, so stored messages don't keep their handles
+        conversation_store.save(session.session_id, without_output_handles(session.interpreter.messages), start,
+                                owner=session.owner)
+    except Exception as e:
+        print(f"[Conversations] Error saving session {session.session_id}: {str(e)}", file=sys.stderr)
+
+# One interpreter and one chunk channel per conversation
+session_manager = SessionManager(
+    create_interpreter,
+    max_sessions=int(os.environ.get('MAX_SESSIONS', 16)),
+    idle_timeout=float(os.environ.get('SESSION_IDLE_TIMEOUT', 3600)),
+    on_close=lambda session: output_store.remove_session(session.session_id),
+    restore=restore_conversation
+)
+
+# Bounded pool of workers that drive interpreter.chat() generators
+chat_executor = ThreadPoolExecutor(
+    max_workers=int(os.environ.get('CHAT_WORKERS', 32)),
+    thread_name_prefix='chat'
+)
+
+# Concurrency pools and wait queues per class of work; interactive chat is admitted first
+# (each class's limits can be overridden with ADMISSION_<CLASS>_LIMIT, _QUEUE and _WAIT)
+admission = AdmissionController(max_active=int(os.environ.get('ADMISSION_MAX_ACTIVE', 24)))
+admission.configure('chat', limit=16, max_queue=32, max_wait=10, priority=0)
+# Code runs inside a chat's slot, so it has its own pool but doesn't take a shared slot
+admission.configure('code', limit=8, max_queue=32, max_wait=300, priority=0, shared=False)
+admission.configure('tts', limit=8, max_queue=64, max_wait=10, priority=1)
+admission.configure('aux', limit=4, max_queue=16, max_wait=5, priority=2)
+
+def admitted(work_class):
+    """Run a view in an admission slot of a work class, held until its response has been sent"""
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            slot = admission.acquire(work_class)
+            try:
+                response = app.make_response(view(*args, **kwargs))
+            except BaseException:
+                slot.release()
+                raise
+            # Streamed responses keep the slot until the last byte is out
+            response.call_on_close(slot.release)
+            return response
+        return wrapper
+    return decorator
+
+# Merge token-sized chunks into larger SSE frames (STREAM_COALESCE_MS=0 disables)
+STREAM_COALESCE_MS = float(os.environ.get('STREAM_COALESCE_MS', 0))
+STREAM_COALESCE_BYTES = int(os.environ.get('STREAM_COALESCE_BYTES', 4096))
+
+# Delivered chunks kept per generation so a dropped stream can be resumed
+REPLAY_BUFFER_SIZE = int(os.environ.get('REPLAY_BUFFER_SIZE', 4096))
+# Undelivered chunks per generation before output is merged or dropped and the model is paused
+STREAM_MAX_PENDING = int(os.environ.get('STREAM_MAX_PENDING', 1024))
+
+# Seconds a generation keeps running after its last reader disconnects
+STREAM_DISCONNECT_GRACE = float(os.environ.get('STREAM_DISCONNECT_GRACE', 10))
+# Seconds a new generation waits for a client to start reading its stream (at least 5)
+STREAM_FIRST_READER_TIMEOUT = max(5.0, float(os.environ.get('STREAM_FIRST_READER_TIMEOUT', 30)))
+# Idle seconds between keepalive frames, which let the server notice dropped clients (0 disables)
+STREAM_KEEPALIVE = float(os.environ.get('STREAM_KEEPALIVE', 15))
+
+def create_coalescer():
+    """Build a chunk coalescer for one stream, or None if coalescing is disabled"""
+    if STREAM_COALESCE_MS <= 0:
+        return None
+    return ChunkCoalescer(window_ms=STREAM_COALESCE_MS, max_bytes=STREAM_COALESCE_BYTES)
+
+def get_session_id():
+    """Resolve the client's session id from the header, query string or JSON body"""
+    session_id = request.headers.get('X-Session-ID') or request.args.get('session_id')
+    if not session_id and request.is_json:
+        session_id = (request.get_json(silent=True) or {}).get('session_id')
+    return session_id or DEFAULT_SESSION_ID
 
-# Configure the interpreter
-interpreter.auto_run = True  # Auto-run code without confirmation
-interpreter.llm.model = "gpt-4"  # Default model, can be changed through UI
+def get_owner():
+    """Owner key of the requesting client: its X-Client-ID, or its session id if it sends none"""
+    return owner_key(request.headers.get('X-Client-ID') or get_session_id())
+
+def get_session():
+    """Get (or lazily create) the session for the current request"""
+    session = session_manager.get(get_session_id())
+    if session.owner is None:
+        session.owner = get_owner()
+    return session
+
+@app.errorhandler(SessionLimitError)
+def session_limit_reached(error):
+    """All session slots are busy generating"""
+    return jsonify({"error": str(error)}), 503
+
+@app.errorhandler(AdmissionRejected)
+def admission_rejected(error):
+    """The work class's queue is full or the request waited too long"""
+    return jsonify({"error": str(error)}), 429, {'Retry-After': str(error.retry_after)}
 
 @app.route('/')
 def index():
@@ -30,40 +249,58 @@ def tts_test():
 @app.route('/settings', methods=['GET', 'POST'])
 def settings():
     """Handle settings update"""
+    session = get_session()
+    interpreter = session.interpreter
     if request.method == 'POST':
         data = request.json
+        updates = {}
           # Update model settings
         model = data.get('model')
         if model:
-            interpreter.llm.model = model
+            updates['model'] = model
             custom = data.get('custom')
             # Handle custom models
             if custom:
-                    interpreter.llm.model = 'openai/' + model  # Set model to custom'
-                    interpreter.llm.offline = True
-                    # get LOCAL_MODEL_API_BASE from environment variable
-                    local_api_base = os.environ.get('LOCAL_MODEL_API_BASE')
-                    interpreter.llm.api_base = local_api_base 
-                    interpreter.llm.format = "openai"  # Configure chat format for OpenAI compatibility
-                    print(f"Using custom model API base: {local_api_base}", file=sys.stderr)
+                    updates['model'] = 'openai/' + model  # Set model to custom'
+                    updates['offline'] = True
+                    # Chats are routed across LOCAL_MODEL_API_BASES; the primary marks the session as local
+                    updates['api_base'] = llm_router.primary
+                    updates['format'] = "openai"  # Configure chat format for OpenAI compatibility
+                    print(f"Using custom model API bases: {', '.join(llm_router.api_bases)}", file=sys.stderr)
             else:
                 # Reset to default API base for hosted models
-                interpreter.llm.api_base = None
-                interpreter.llm.offline = False
+                updates['api_base'] = None
+                updates['offline'] = False
         
         # Update context window if provided
         context_window = data.get('context_window')
         if context_window and str(context_window).isdigit():
-            interpreter.llm.context_window = int(context_window)
+            updates['context_window'] = int(context_window)
             
         # Update max tokens if provided
         max_tokens = data.get('max_tokens')
         if max_tokens and str(max_tokens).isdigit():
-            interpreter.llm.max_tokens = int(max_tokens)
+            updates['max_tokens'] = int(max_tokens)
               # Update auto_run setting
         auto_run = data.get('auto_run')
         if auto_run is not None:
-            interpreter.auto_run = auto_run
+            updates['auto_run'] = auto_run
+        
+        # The context policy is this session's own; other sessions keep theirs
+        # (settings for an interpreter without one are still validated)
+        context_policy = context_manager.policy(interpreter)
+        try:
+            (context_policy or context_manager.defaults.copy()).configure(
+                policy=data.get('context_policy') or None,
+                elide_tokens=int(data['context_elide_tokens']) if data.get('context_elide_tokens') is not None else None,
+                keep_turns=int(data['context_keep_turns']) if data.get('context_keep_turns') is not None else None
+            )
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        
+        # Apply to this session and make them the defaults for new sessions
+        apply_interpreter_settings(interpreter, updates)
+        interpreter_defaults.update(updates)
             
         return jsonify({"success": True})
     
@@ -74,18 +311,16 @@ def settings():
         "max_tokens": interpreter.llm.max_tokens,
         "auto_run": interpreter.auto_run
     }
+    settings.update((context_manager.policy(interpreter) or context_manager.defaults).settings)
+    ledger = context_manager.ledger(interpreter)
+    settings['context_tokens'] = ledger.total if ledger is not None else None
     
     # Add API base URL if it's set (for local models)
     if hasattr(interpreter.llm, 'api_base') and interpreter.llm.api_base:
         settings['api_base'] = interpreter.llm.api_base
     else:
-        settings['api_base'] = os.environ.get('LOCAL_MODEL_API_BASE', 'http://192.168.1.118:1234/v1')
-    
-    # Add API base URL if it's set (for local models)
-    if hasattr(interpreter.llm, 'api_base') and interpreter.llm.api_base:
-        settings['api_base'] = interpreter.llm.api_base
-    else:
-        settings['api_base'] = os.environ.get('LOCAL_MODEL_API_BASE', 'http://localhost:1234/v1')
+        settings['api_base'] = llm_router.primary or 'http://localhost:1234/v1'
+    settings['api_bases'] = llm_router.api_bases
     
     return jsonify(settings)
 
@@ -98,423 +333,752 @@ def chat():
     if not prompt:
         return jsonify({"error": "No prompt provided"}), 400
     
-    # Generate a unique session ID for this chat
-    session_id = str(uuid.uuid4())
-    print(f"Starting chat session {session_id} with prompt: {prompt}", file=sys.stderr)
+    # Pick the wire encoding (full JSON, compact or MessagePack)
+    try:
+        encoder = negotiate_stream_encoder(request.headers.get('Accept'), request.args.get('stream_format'))
+    except UnsupportedStreamFormat as e:
+        return jsonify({"error": str(e)}), 406
+    
+    session = get_session()
     
-    # Clear the queue before starting a new chat
-    while not message_queue.empty():
-        message_queue.get()
+    # Server-side markdown rendering, when asked for and available
+    render_html = data.get('render') == 'html' and markdown_available()
     
-    # Start a new thread for processing the chat
-    threading.Thread(target=process_chat, args=(prompt,)).start()
+    # Only one generation may drive a session's interpreter at a time
+    generation = start_generation(session, prompt, speak=bool(data.get('speak')), voice=data.get('voice'),
+                                  render_html=render_html)
+    if generation is None:
+        return jsonify({"error": "A response is already being generated for this conversation"}), 409
     
     # Return the streaming response
-    return Response(stream_messages(), mimetype='text/event-stream')
+    headers = {'X-Stream-Format': encoder.name, 'X-Chat-ID': generation.chat_id}
+    if render_html:
+        headers['X-Markdown-Render'] = 'html'
+    return Response(stream_messages(generation, 0, create_coalescer(), encoder), mimetype=encoder.media_type,
+                    headers=headers)
+
+def find_generation(chat_id):
+    """The current request's session and its generation, if the generation matches chat_id"""
+    session = session_manager.peek(get_session_id())
+    generation = session.generation if session is not None else None
+    if generation is None or generation.chat_id != chat_id:
+        return session, None
+    return session, generation
+
+@app.route('/chat/<chat_id>/stream', methods=['GET'])
+def resume_chat(chat_id):
+    """Resume a dropped chat stream after the client's Last-Event-ID"""
+    session, generation = find_generation(chat_id)
+    if generation is None:
+        return jsonify({"error": "Unknown or expired chat"}), 404
+    
+    last_event_id = request.headers.get('Last-Event-ID') or request.args.get('last_event_id') or '0'
+    if not last_event_id.isdigit():
+        return jsonify({"error": "Last-Event-ID must be a number"}), 400
+    
+    try:
+        encoder = negotiate_stream_encoder(request.headers.get('Accept'), request.args.get('stream_format'))
+    except UnsupportedStreamFormat as e:
+        return jsonify({"error": str(e)}), 406
+    
+    print(f"Resuming chat {chat_id} after event {last_event_id}", file=sys.stderr)
+    return Response(stream_messages(generation, int(last_event_id), create_coalescer(), encoder),
+                    mimetype=encoder.media_type,
+                    headers={'X-Stream-Format': encoder.name, 'X-Chat-ID': chat_id})
+
+@app.route('/chat/<chat_id>/cancel', methods=['POST'])
+def cancel_chat(chat_id):
+    """Stop a running generation and the code it is executing"""
+    session, generation = find_generation(chat_id)
+    if generation is None:
+        return jsonify({"error": "Unknown or expired chat"}), 404
+    
+    cancelled = cancel_generation(session, generation, "cancelled by client")
+    return jsonify({"success": True, "cancelled": cancelled})
+
+def cancel_generation(session, generation, reason):
+    """
+    Ask a generation to stop and terminate any code it is running
+    
+    The worker notices the flag at its next chunk, closes the interpreter's
+    generator and releases the session.
+    
+    Returns:
+        True if the generation was still running
+    """
+    if not generation.cancel():
+        return False
+    print(f"Cancelling chat {generation.chat_id} in session {session.session_id}: {reason}", file=sys.stderr)
+    session.terminate_code()
+    return True
+
+def cancel_when_abandoned(session, generation):
+    """Cancel a generation if it still has no readers once the disconnect grace period is over"""
+    def check():
+        if generation.readers == 0:
+            cancel_generation(session, generation, "no client is reading the stream")
+    
+    timer = threading.Timer(max(0.0, STREAM_DISCONNECT_GRACE), check)
+    timer.daemon = True
+    timer.start()
+
+def cancel_when_never_read(session, generation):
+    """Cancel a generation if no client has started reading its stream once the first-reader timeout is over"""
+    def check():
+        if not generation.ever_attached:
+            cancel_generation(session, generation, "no client started reading the stream")
+    
+    timer = threading.Timer(STREAM_FIRST_READER_TIMEOUT, check)
+    timer.daemon = True
+    timer.start()
 
-def process_chat(prompt):
-    """Process the chat in a separate thread"""
+def start_generation(session, prompt, speak=False, voice=None, render_html=False):
+    """
+    Claim the session and run the generation on the bounded chat executor
+    
+    Args:
+        session: The ChatSession to generate in
+        prompt: The user's prompt
+        speak: Whether to add speech chunks with prefetched audio for the reply's sentences
+        voice: Voice for the speech (defaults to the TTS engine's)
+        render_html: Whether to add markdown chunks with each message's finished blocks rendered to HTML
+        
+    Returns:
+        The generation's ReplayBuffer, or None if the session is already generating
+        
+    Raises:
+        AdmissionRejected: If the server is too busy to start another chat
+    """
+    if not session.generation_lock.acquire(blocking=False):
+        return None
+    try:
+        slot = admission.acquire('chat')
+    except AdmissionRejected:
+        session.generation_lock.release()
+        raise
+    
+    # Generate a unique ID for this chat
+    chat_id = str(uuid.uuid4())
+    print(f"Starting chat {chat_id} in session {session.session_id} with prompt: {prompt}", file=sys.stderr)
+    
+    # Each generation gets a fresh replay buffer; the previous one is dropped
+    generation = ReplayBuffer(chat_id, capacity=REPLAY_BUFFER_SIZE, max_pending=STREAM_MAX_PENDING)
+    generation.on_abandoned = lambda: cancel_when_abandoned(session, generation)
+    session.generation = generation
+    # A client that never reads the stream would otherwise leave it blocked on a full buffer for good
+    cancel_when_never_read(session, generation)
+    
+    speech = SpeechStream(tts_prefetcher, orpheus_tts, voice or orpheus_tts.default_voice) if speak else None
+    renderer = MarkdownStream() if render_html else None
+    chat_executor.submit(process_chat, session, prompt, generation, speech, slot, renderer)
+    return generation
+
+def process_chat(session, prompt, generation, speech=None, slot=None, renderer=None):
+    """Process the chat on a chat executor worker, publishing chunks to the generation's replay buffer"""
+    # Diverts large code output to disk
+    spiller = output_store.spiller(session.session_id)
+    # Makes each code block wait for a code execution slot
+    code_gate = CodeExecutionGate(admission)
+    first_new_message = None
     try:
         print(f"Processing chat with prompt: {prompt}", file=sys.stderr)
         
-        # Import the utils modules for parsing interpreter chunks
-        from utils.helpers import parse_interpreter_chunk
-        from utils.message_handler import process_chunk_for_ui        # Track whether we're in a code block or message block
-        in_code_block = False
-        in_message_block = False
-        had_code_execution = False
-        code_execution_ended = False
+        # Translates raw interpreter chunks into UI-ready chunks in one pass
+        translator = ChunkTranslator()
+        first_new_message = len(session.interpreter.messages)
+        # Messages before this index are in the conversation store
+        saved = first_new_message
         
-        # Stream the chat response
-        for chunk in interpreter.chat(prompt, stream=True, display=False):
-            # Print chunk type for debugging
-            print(f"Chunk type: {type(chunk)}, Content: {chunk}", file=sys.stderr)
-            
-            try:                # Parse the chunk into a standardized format
-                processed_chunk = parse_interpreter_chunk(chunk)
-                
-                # Make sure code, console, and output chunks are properly marked
-                if processed_chunk['type'] in ['code', 'console', 'output']:
-                    processed_chunk['skip_chat'] = True
-                
-                # Add UI hints for the frontend
-                enhanced_chunk = process_chunk_for_ui(processed_chunk)
-                
-                # Update our state tracking
-                if enhanced_chunk['type'] == 'code' and enhanced_chunk.get('is_new_block'):
-                    in_code_block = True
-                    had_code_execution = True
-                    code_execution_ended = False
-                    # Make sure this is marked as a new element for the UI
-                    enhanced_chunk['new_ui_element'] = True
-                
-                # If code block is ending, mark it and add a flag for the UI
-                if enhanced_chunk['type'] == 'code' and enhanced_chunk.get('is_end'):
-                    in_code_block = False
-                    enhanced_chunk['code_block_completed'] = True # Explicit flag for UI
+        # Stream the chat response (from the best local backend when the session uses a local model)
+        stream = llm_router.chat(session.interpreter, prompt)
+        try:
+            for chunk in stream:
+                if generation.cancelled:
+                    print(f"Chat {generation.chat_id} cancelled, stopping generation", file=sys.stderr)
+                    break
                 
-                # Track when output is ending too (indicates end of code execution)
-                if enhanced_chunk['type'] == 'output' and enhanced_chunk.get('is_end'):
-                    code_execution_ended = True
+                # Print chunk type for debugging
+                print(f"Chunk type: {type(chunk)}, Content: {chunk}", file=sys.stderr)
+                session.messages_changed()
+            
+                try:
+                    # Send the UI-ready chunk to the frontend
+                    items = [out for item in translator.translate(chunk) for out in spiller.process(item)]
+                    if speech is not None:
+                        # Sentences completed by this chunk are synthesized while the reply continues
+                        items = [out for item in items for out in speech.process(item)]
+                    if renderer is not None:
+                        # Blocks closed by this chunk are rendered once, on the server
+                        items = [out for item in items for out in renderer.process(item)]
+                    for item in items:
+                        generation.put(item)
+                except Exception as chunk_error:
+                    print(f"Error processing chunk: {str(chunk_error)}", file=sys.stderr)
+                    # If parsing fails, still try to send something useful
+                    if isinstance(chunk, dict):
+                        generation.put(chunk)
+                    elif isinstance(chunk, str):
+                        generation.put({"type": "message", "content": chunk})
+                    else:
+                        generation.put({"type": "message", "content": str(chunk)})
                 
-                # Handle message blocks
-                if enhanced_chunk['type'] == 'message':
-                    # Only set new_message_after_code if this is a truly new message after 
-                    # complete code execution (end of code + end of output)
-                    if had_code_execution and code_execution_ended:
-                        enhanced_chunk['new_message_after_code'] = True
-                        had_code_execution = False  # Reset the flag
-                        code_execution_ended = False # Reset the flag
-                    
-                    if enhanced_chunk.get('is_new_block'):
-                        in_message_block = True
+                # A finished code block runs when the next chunk is requested, once a code slot is free
+                code_gate.observe(chunk)
                 
-                # Send the enhanced chunk to the frontend
-                message_queue.put(enhanced_chunk)
-            except Exception as chunk_error:
-                print(f"Error processing chunk: {str(chunk_error)}", file=sys.stderr)
-                # If parsing fails, still try to send something useful
-                if isinstance(chunk, dict):
-                    message_queue.put(chunk)
-                elif isinstance(chunk, str):
-                    message_queue.put({"type": "message", "content": chunk})
-                else:
-                    message_queue.put({"type": "message", "content": str(chunk)})
+                # Store each block as soon as it is complete
+                if isinstance(chunk, dict) and chunk.get('end'):
+                    save_conversation(session, saved)
+                    saved = len(session.interpreter.messages)
+        finally:
+            # Closing the interpreter's generator stops the model request
+            stream.close()
                 
     except Exception as e:
         import traceback
         print(f"Error in process_chat: {str(e)}", file=sys.stderr)
         traceback.print_exc(file=sys.stderr)
-        message_queue.put({"type": "error", "content": str(e)})
+        generation.put({"type": "error", "content": str(e)})
     finally:
-        # Signal that we're done
-        message_queue.put(None)
+        code_gate.release()
+        if slot is not None:
+            slot.release()
+        # Close the last output block and point history at any spilled output
+        for item in spiller.finish():
+            generation.put(item)
+        if speech is not None:
+            if generation.cancelled:
+                tts_prefetcher.cancel(speech.handles)
+            else:
+                for item in speech.finish():
+                    generation.put(item)
+        if renderer is not None:
+            for item in renderer.finish():
+                generation.put(item)
+        if first_new_message is not None:
+            attach_output_handles(session.interpreter.messages[first_new_message:], spiller)
+            # The turn is over, so nothing will run its code again: move its images and large payloads out
+            blob_store.externalize(session.interpreter.messages[first_new_message:])
+            # Rewrite the whole turn: output handles and blob references were attached and the last block may not have ended
+            save_conversation(session, first_new_message)
+        
+        # Signal that we're done and let the session accept the next chat
+        generation.put(None)
+        if generation.dropped_chunks or generation.blocked_seconds:
+            print(f"Chat {generation.chat_id} slow client: {generation.stats}", file=sys.stderr)
+        session.messages_changed()
+        session.touch()
+        session.generation_lock.release()
 
-def stream_messages():
-    """Stream messages from the queue as SSE events"""
-    while True:
+def stream_messages(generation, after_id=0, coalescer=None, encoder=None):
+    """Stream a generation's chunks after after_id in the negotiated wire encoding"""
+    encoder = encoder or SseJsonEncoder()
+    for event_id, chunk in iter_events(generation, after_id, coalescer, STREAM_KEEPALIVE):
+        if chunk is None:
+            # Idle keepalive; writing it is how a dropped client gets noticed
+            keepalive = encoder.keepalive()
+            if keepalive:
+                yield keepalive
+            continue
         try:
-            chunk = message_queue.get()
-            
-            # None means we're done
-            if chunk is None:
-                yield "data: [DONE]\n\n"
-                break
-                
-            # Convert the chunk to a proper format for SSE
-            if isinstance(chunk, dict):
-                # Already a dictionary, convert to JSON
-                chunk_str = json.dumps(chunk)
-            elif isinstance(chunk, str):
-                # Try parsing as JSON in case it's already a JSON string
-                try:
-                    json.loads(chunk)  # Just to validate
-                    chunk_str = chunk
-                except json.JSONDecodeError:
-                    # If not valid JSON, wrap it as a message
-                    chunk_str = json.dumps({"type": "message", "content": chunk})
-            else:
-                # For any other type, convert to string and wrap as message
-                chunk_str = json.dumps({"type": "message", "content": str(chunk)})
-                
-            yield f"data: {chunk_str}\n\n"
+            yield encoder.encode(chunk, event_id)
         except Exception as e:
-            error_msg = json.dumps({"type": "error", "content": str(e)})
-            yield f"data: {error_msg}\n\n"
+            yield encoder.encode({"type": "error", "content": str(e)})
             print(f"Error in stream_messages: {str(e)}", file=sys.stderr)
+    
+    yield encoder.done()
 
 @app.route('/reset', methods=['POST'])
 def reset():
     """Reset the interpreter's state"""
-    interpreter.messages = []
+    session = get_session()
+    if session.generation is not None:
+        cancel_generation(session, session.generation, "conversation reset")
+    session.interpreter.messages = []
+    session.tree.clear()
+    session.messages_changed()
+    conversation_store.truncate(session.session_id, 0)
     return jsonify({"success": True})
 
 @app.route('/reset_from_index', methods=['POST'])
 def reset_from_index():
-    """Reset the interpreter's state from a specific message index"""
-    try:
-        data = request.json
-        message_index = data.get('message_index')
-        
-        print(f"Resetting conversation from index: {message_index}", file=sys.stderr)
-        print(f"Current messages count: {len(interpreter.messages)}", file=sys.stderr)
-        
-        if message_index is None:
-            return jsonify({"error": "No message index provided"}), 400
-        
-        # Handle negative indexes (e.g., -1 to reset everything)
-        if message_index < 0:
-            interpreter.messages = []
-            print("Reset all messages due to negative index", file=sys.stderr)
-            return jsonify({"success": True, "remaining_messages": 0})
-        
-        # Keep messages up to (and including) the specified index
-        if len(interpreter.messages) > 0:
-            # Ensure the index is valid
-            valid_index = min(message_index, len(interpreter.messages) - 1)
-            
-            # Keep only messages up to the specified index
-            interpreter.messages = interpreter.messages[:valid_index+1]
-            print(f"Kept messages up to index {valid_index}, new count: {len(interpreter.messages)}", file=sys.stderr)
-            
-            # Print kept messages for debugging
-            if len(interpreter.messages) > 0:
-                for i, msg in enumerate(interpreter.messages):
-                    role = msg.get('role', 'unknown')
-                    content_preview = str(msg.get('content', ''))[:50] + ('...' if len(str(msg.get('content', ''))) > 50 else '')
-                    print(f"Message {i}: role={role}, content={content_preview}", file=sys.stderr)
-            
-            return jsonify({
-                "success": True, 
-                "remaining_messages": len(interpreter.messages),
-                "last_message_role": interpreter.messages[-1].get('role') if interpreter.messages else None
-            })
+    """
+    Fork the conversation after a message, e.g. to edit or regenerate what follows it
+    
+    The messages after message_index are kept as a branch that /branches
+    lists and /branches/switch returns to. A negative index keeps nothing.
+    """
+    session = get_session()
+    interpreter = session.interpreter
+    data = request.json or {}
+    message_index = data.get('message_index')
+    
+    if not isinstance(message_index, int):
+        return jsonify({"error": "No message index provided"}), 400
+    if session.busy:
+        return jsonify({"error": "A response is being generated for this conversation"}), 409
+    
+    remaining = session.tree.fork(interpreter.messages, message_index)
+    session.messages_changed()
+    conversation_store.truncate(session.session_id, remaining)
+    print(f"[Sessions] Forked session {session.session_id} after message {message_index}, "
+          f"{remaining} messages kept", file=sys.stderr)
+    
+    return jsonify({
+        "success": True,
+        "remaining_messages": remaining,
+        "last_message_role": interpreter.messages[-1].get('role') if interpreter.messages else None
+    })
+
+@app.route('/reset_to_message', methods=['POST'])
+def reset_to_message():
+    """
+    Delete a message shown in the chat and everything after it, keeping them as a branch
+    
+    The chat shows one element per user message and per reply, so the
+    message is given by its turn (how many user messages come before it)
+    and its role: deleting a user message drops its whole turn, deleting
+    a reply keeps the turn's user message. Alternatively, "messages" gives
+    the whole conversation; each needs a role, type and content.
+    """
+    session = get_session()
+    data = request.json or {}
+    turn = data.get('turn')
+    messages = data.get('messages')
+    
+    if turn is None:
+        if not isinstance(messages, list) or not all(
+                isinstance(message, dict) and all(key in message for key in ('role', 'type', 'content'))
+                for message in messages):
+            return jsonify({"error": "Provide a turn, or messages with a role, type and content each"}), 400
+    elif not isinstance(turn, int) or turn < 0:
+        return jsonify({"error": "turn must be a non-negative integer"}), 400
+    if session.busy:
+        return jsonify({"error": "A response is being generated for this conversation"}), 409
+    
+    if turn is None:
+        changed_from = session.tree.replace(session.interpreter.messages, messages)
+        session.messages_changed()
+        save_conversation(session, changed_from)
+    else:
+        if data.get('role') == 'user':
+            message_index = turn_start(session.interpreter.messages, turn) - 1
         else:
-            # If no messages, reset everything
-            interpreter.messages = []
-            print("Reset all messages (empty message list)", file=sys.stderr)
-            return jsonify({"success": True, "remaining_messages": 0})
-    except Exception as e:
-        import traceback
-        print(f"Error in reset_from_index: {str(e)}", file=sys.stderr)
-        traceback.print_exc(file=sys.stderr)
-        return jsonify({"error": str(e), "traceback": traceback.format_exc()}), 500
+            # A reply belongs to the turn of the user message before it
+            message_index = turn_start(session.interpreter.messages, turn - 1) if turn > 0 else -1
+        remaining = session.tree.fork(session.interpreter.messages, message_index)
+        session.messages_changed()
+        conversation_store.truncate(session.session_id, remaining)
+    return jsonify({"success": True, "remaining_messages": len(session.interpreter.messages)})
+
+@app.route('/branches', methods=['GET'])
+def list_branches():
+    """The alternative branches at one index of the conversation (?index=<message index>)"""
+    index = request.args.get('index', type=int)
+    if index is None:
+        return jsonify({"error": "No message index provided"}), 400
+    session = get_session()
+    return jsonify({"index": index, "branches": session.tree.branches(session.interpreter.messages, index)})
+
+@app.route('/branches/switch', methods=['POST'])
+def switch_branch():
+    """Make the branch through a node the active conversation, without calling the model"""
+    session = get_session()
+    node_id = (request.json or {}).get('node_id')
+    
+    if session.busy:
+        return jsonify({"error": "A response is being generated for this conversation"}), 409
+    try:
+        changed_from = session.tree.switch(session.interpreter.messages, node_id)
+    except KeyError:
+        return jsonify({"error": "Unknown branch"}), 404
+    
+    session.messages_changed()
+    save_conversation(session, changed_from)
+    return jsonify({"success": True, "remaining_messages": len(session.interpreter.messages),
+                    "changed_from": changed_from})
+
+# Distinguishes this process's history versions from those of earlier runs
+HISTORY_EPOCH = uuid.uuid4().hex[:8]
 
 @app.route('/history', methods=['GET'])
 def history():
-    """Get the chat history"""
-    return jsonify(interpreter.messages)
+    """
+    Get the chat history
+    
+    The messages are those of the conversation's active branch. Without
+    parameters the full message list is returned. With any of
+    since=<index>, limit=<count>, fields=<a,b> or preview=<chars> the
+    response is one page: {"messages", "start", "total", "next"}, plus
+    the indices that have other branches ("branches"). Either
+    way the response has an ETag, and If-None-Match gets a 304 while the
+    history is unchanged.
+    """
+    session_id = get_session_id()
+    paged = any(key in request.args for key in ('since', 'limit', 'fields', 'preview'))
+    start = max(0, request.args.get('since', 0, type=int))
+    limit = max(1, min(request.args.get('limit', MAX_PAGE, type=int), MAX_PAGE))
+    fields = parse_fields(request.args.get('fields'))
+    preview = request.args.get('preview', type=int)
+    view = (paged, start, limit, fields, preview)
+    
+    session = session_manager.peek(session_id)
+    if session is not None and session.has_interpreter:
+        version = ('live', HISTORY_EPOCH, session.created_at, session.history_version)
+        messages = None
+    else:
+        # Not loaded into memory: read the store instead of building an interpreter
+        summary = conversation_store.summary(session_id)
+        version = ('stored', summary['updated_at'], summary['message_count']) if summary else ('empty',)
+        messages = []
+    
+    etag = history_etag(session_id, *version, *view)
+    if request.if_none_match.contains(etag):
+        return Response(status=304, headers={'ETag': f'"{etag}"', 'Cache-Control': 'private, no-cache'})
+    
+    branches = None
+    if messages is None:
+        # The active branch of the conversation
+        all_messages = session.interpreter.messages
+        total = len(all_messages)
+        messages = all_messages[start:start + limit] if paged else all_messages
+        branches = session.tree.branch_points(all_messages)
+    elif version[0] == 'stored':
+        total = summary['message_count']
+        messages = without_output_handles(conversation_store.load(session_id, start, limit if paged else None) or [])
+    else:
+        total = 0
+    
+    response = jsonify(history_page(messages, start, total, fields, preview, branches) if paged else messages)
+    response.set_etag(etag)
+    # Cached, but revalidated on every use
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+@app.route('/conversations', methods=['GET'])
+def list_conversations():
+    """The client's stored conversations, most recently updated first (page with ?before=<updated_at>)"""
+    limit = max(1, min(request.args.get('limit', 50, type=int), 200))
+    before = request.args.get('before', type=float)
+    return jsonify(conversation_store.list(get_owner(), limit=limit, before=before))
+
+@app.route('/history/<conversation_id>', methods=['GET'])
+def get_conversation(conversation_id):
+    """
+    One of the client's stored conversations, by public id, with its messages
+    
+    The response's session_id lets the client continue the conversation;
+    conversations of other clients are reported as unknown.
+    """
+    session_id = conversation_store.find(conversation_id, get_owner())
+    if session_id is None:
+        return jsonify({"error": "Unknown conversation"}), 404
+    conversation = conversation_store.get(session_id)
+    if conversation is None:
+        return jsonify({"error": "Unknown conversation"}), 404
+    session = session_manager.peek(session_id)
+    if session is not None and session.has_interpreter:
+        # A live session is authoritative; mid-generation the store trails it by up to one block
+        conversation['messages'] = session.interpreter.messages
+    conversation['session_id'] = session_id
+    return jsonify(conversation)
+
+@app.route('/history/<conversation_id>', methods=['DELETE'])
+def delete_conversation(conversation_id):
+    """Delete one of the client's stored conversations, by public id, and drop its session"""
+    session_id = conversation_store.find(conversation_id, get_owner())
+    if session_id is None:
+        return jsonify({"error": "Unknown conversation"}), 404
+    session = session_manager.peek(session_id)
+    if session is not None and session.busy:
+        return jsonify({"error": "A response is being generated for this conversation"}), 409
+    session_manager.remove(session_id)
+    conversation_store.delete(session_id)
+    return jsonify({"success": True})
+
+@app.route('/output/<handle>', methods=['GET'])
+def get_output(handle):
+    """Serve spilled code output, honouring a byte Range header"""
+    if not HANDLE_PATTERN.match(handle):
+        return jsonify({"error": "Invalid output handle"}), 400
+    
+    session_id = get_session_id()
+    try:
+        size = output_store.size(handle, session_id)
+        byte_range = request.range.range_for_length(size) if request.range else (0, size)
+        if byte_range is None:
+            return Response(status=416, headers={'Content-Range': f"bytes */{size}"})
+        data, size = output_store.read(handle, session_id, byte_range[0], byte_range[1] - 1)
+    except OutputNotFound as e:
+        return jsonify({"error": str(e)}), 404
+    
+    headers = {'Accept-Ranges': 'bytes', 'X-Output-Size': str(size)}
+    if request.range:
+        headers['Content-Range'] = f"bytes {byte_range[0]}-{byte_range[0] + len(data) - 1}/{size}"
+    return Response(data, status=206 if request.range else 200,
+                    mimetype='text/plain; charset=utf-8', headers=headers)
+
+@app.route('/blobs/<blob_id>', methods=['GET'])
+def get_blob(blob_id):
+    """Serve an image or large payload a message refers to"""
+    if not BLOB_ID_PATTERN.match(blob_id):
+        return jsonify({"error": "Invalid blob id"}), 400
+    
+    # Ids are content hashes, so a blob never changes and the browser never needs to ask again
+    headers = {'ETag': f'"{blob_id}"', 'Cache-Control': 'private, max-age=31536000, immutable',
+               'X-Content-Type-Options': 'nosniff'}
+    if request.if_none_match.contains(blob_id):
+        return Response(status=304, headers=headers)
+    data = blob_store.get(blob_id)
+    if data is None:
+        return jsonify({"error": "Unknown blob"}), 404
+    return Response(data, mimetype=blob_media_type(data), headers=headers)
+
+@app.route('/api/stats', methods=['GET'])
+def get_stats():
+    """Session pool usage, stream queue depths and overflow counters, TTS stats and upstream health"""
+    streams = [session.generation.stats for session in session_manager.sessions()
+               if session.generation is not None]
+    return jsonify({"sessions": session_manager.stats(), "streams": streams, "tts_cache": tts_cache.stats,
+                    "tts_prefetch": tts_prefetcher.stats, "speech_rewrite": speech_rewriter.stats,
+                    "upstreams": upstreams.stats(), "models": model_catalogue.stats, "llm_router": llm_router.stats,
+                    "admission": admission.stats, "conversations": conversation_store.stats,
+                    "context": context_manager.stats, "blobs": blob_store.stats})
+
+def local_model_upstream(api_base):
+    """The upstream client for a local model server"""
+    # Configured backends each get their own pool and breaker, with the shared local_model settings;
+    # any other API base a client asks about shares one client, so requests can't add clients without limit
+    if llm_router.routes(api_base):
+        return upstreams.get(f"local_model {api_base}", profile='local_model')
+    return upstreams.get('local_model')
+
+def fetch_model_list(api_base):
+    """Fetch the /models list of an OpenAI-compatible API base"""
+    response = local_model_upstream(api_base).get(f"{api_base}/models")
+    if response.status_code != 200:
+        raise UpstreamError(f"Failed to fetch models: {response.status_code}")
+    return response.json()
+
+def probe_llm_backend(api_base):
+    """Health check of a local model server: its /models must answer quickly, without retries"""
+    response = local_model_upstream(api_base).get(f"{api_base}/models", retry=False, timeout=(2, LLM_PROBE_TIMEOUT))
+    response.close()
+    if response.status_code != 200:
+        raise UpstreamError(f"/models returned {response.status_code}")
+
+# Model lists per API base, refreshed in the background at most once per MODEL_LIST_TTL seconds
+model_catalogue = ModelCatalogue(
+    fetch_model_list,
+    ttl=float(os.environ.get('MODEL_LIST_TTL', 60)),
+    error_ttl=float(os.environ.get('MODEL_LIST_ERROR_TTL', 10))
+)
+# Seconds /api/models waits for an API base's first fetch before answering with an empty, pending list
+MODEL_LIST_WAIT = float(os.environ.get('MODEL_LIST_WAIT', 2))
+
+# Local model servers; each chat goes to the least-loaded healthy one and fails over before its first token
+LLM_PROBE_TIMEOUT = float(os.environ.get('LLM_PROBE_TIMEOUT', 5))
+llm_router = LlmRouter(
+    parse_api_bases(os.environ.get('LOCAL_MODEL_API_BASES') or os.environ.get('LOCAL_MODEL_API_BASE')),
+    probe_llm_backend,
+    probe_interval=float(os.environ.get('LLM_PROBE_INTERVAL', 15))
+)
 
 @app.route('/api/models', methods=['GET'])
 def get_models():
-    """Fetch available models from the API"""
-    try:
-        api_base = request.args.get('api_base', os.environ.get('LOCAL_MODEL_API_BASE', 'http://192.168.1.118:1234/v1'))
-        
-        # Make sure api_base ends with /v1
-        if not api_base.endswith('/v1'):
-            api_base = api_base.rstrip('/') + '/v1'
-            
-        # Request models from the API
-        response = requests.get(f"{api_base}/models")
-        
-        if response.status_code == 200:
-            return jsonify(response.json())
-        else:
-            return jsonify({'error': f"Failed to fetch models: {response.status_code}"}), 500
-    except Exception as e:
-        return jsonify({'error': f"Error fetching models: {str(e)}"}), 500
+    """Available models from the API, served from the catalogue cache"""
+    api_base = request.args.get('api_base', llm_router.primary or 'http://192.168.1.118:1234/v1')
+    
+    # Make sure api_base ends with /v1
+    if not api_base.endswith('/v1'):
+        api_base = api_base.rstrip('/') + '/v1'
+    
+    catalogue = model_catalogue.get(api_base, timeout=MODEL_LIST_WAIT)
+    if catalogue['payload'] is None:
+        if catalogue['error']:
+            return jsonify({'error': f"Error fetching models: {catalogue['error']}"}), 502
+        # The first fetch is still running; the client asks again shortly
+        return jsonify({'object': 'list', 'data': [], 'pending': True})
+    
+    response = jsonify(catalogue['payload'])
+    response.headers['X-Models-Age'] = str(int(catalogue['age']))
+    if catalogue['stale']:
+        response.headers['X-Models-Stale'] = '1'
+    return response
         
+def read_tts_request(engine):
+    """Text and voice of a TTS request, from the JSON body or the query string"""
+    data = request.get_json(silent=True) or {}
+    text = data.get('text') or request.args.get('text')
+    voice = data.get('voice') or request.args.get('voice') or engine.default_voice
+    return text, voice
+
+def synthesize_speech_json(engine, log_prefix):
+    """Synthesize a whole clip and return it base64-encoded in JSON"""
+    text, voice = read_tts_request(engine)
+    if not text:
+        print(f"{log_prefix} Error: No text provided", file=sys.stderr)
+        return jsonify({'error': 'No text provided'}), 400
+    
+    print(f"{log_prefix} Request data - Voice: {voice}, Text: '{text[:50]}...'", file=sys.stderr)
+    try:
+        result = synthesize_cached(engine, tts_cache, text, voice)
+    except TtsError as e:
+        print(f"{log_prefix} Error during API call: {str(e)}", file=sys.stderr)
+        return jsonify({'error': str(e), 'success': False}), e.status_code
+    
+    return jsonify({
+        'success': True,
+        'audio': base64.b64encode(result['audio']).decode('utf-8'),
+        'cached': result['cached']
+    })
+
+def stream_speech(engine, log_prefix):
+    """Stream a clip's audio bytes as they arrive from the TTS backend"""
+    text, voice = read_tts_request(engine)
+    if not text:
+        return jsonify({'error': 'No text provided'}), 400
+    
+    print(f"{log_prefix} Streaming request - Voice: {voice}, Text: '{text[:50]}...'", file=sys.stderr)
+    try:
+        chunks = stream_cached(engine, tts_cache, text, voice)
+    except TtsError as e:
+        print(f"{log_prefix} Error during API call: {str(e)}", file=sys.stderr)
+        return jsonify({'error': str(e), 'success': False}), e.status_code
+    
+    # The URL fully determines the audio, so the browser may reuse it
+    return Response(chunks, mimetype=engine.media_type, headers={'Cache-Control': 'private, max-age=86400'})
+
+def synthesize_speech_batch(engine, log_prefix):
+    """Synthesize an ordered list of segments concurrently, streaming each clip back in order"""
+    data = request.get_json(silent=True) or {}
+    segments = data.get('segments')
+    if segments is None and data.get('text'):
+        segments = split_sentences(data['text'])
+    if not isinstance(segments, list) or not segments or \
+            not all(isinstance(segment, str) and segment.strip() for segment in segments):
+        return jsonify({'error': 'Provide "segments" as a list of non-empty strings, or "text"'}), 400
+    if len(segments) > MAX_BATCH_SEGMENTS:
+        return jsonify({'error': f"At most {MAX_BATCH_SEGMENTS} segments per request"}), 400
+    
+    voice = data.get('voice') or engine.default_voice
+    print(f"{log_prefix} Batch request - Voice: {voice}, Segments: {len(segments)}", file=sys.stderr)
+    results = tts_batch.synthesize(engine, segments, voice)
+    
+    def frames():
+        try:
+            for result in results:
+                audio = result.pop('audio', b'')
+                if audio:
+                    result['media_type'] = engine.media_type
+                else:
+                    print(f"{log_prefix} Batch segment {result['index']} failed: {result.get('error')}", file=sys.stderr)
+                yield encode_batch_frame(result, audio)
+        finally:
+            # Cancels segments that haven't started if the client went away
+            results.close()
+    
+    return Response(frames(), mimetype=BATCH_MEDIA_TYPE, headers={'X-Segment-Count': str(len(segments))})
+
 @app.route('/api/text-to-speech', methods=['POST'])
+@admitted('tts')
 def text_to_speech():
     """Convert text to speech using OpenAI API"""
-    try:
-        print(f"[TTS] Text-to-speech API called", file=sys.stderr)
-        
-        data = request.json
-        text = data.get('text')
-        voice = data.get('voice', 'alloy')  # Default voice
-        
-        print(f"[TTS] Request data - Voice: {voice}, Text: '{text[:50]}...'", file=sys.stderr)
-        
-        if not text:
-            print(f"[TTS] Error: No text provided", file=sys.stderr)
-            return jsonify({'error': 'No text provided'}), 400
-            
-        # Import OpenAI
-        from openai import OpenAI
-        import base64
-        import os
-        import time
-        import tempfile
-        
-        # Generate a unique filename for debugging
-        debug_file = os.path.join(tempfile.gettempdir(), f"tts_debug_{int(time.time())}.mp3")
-        
-        # Check for API key
-        api_key = os.environ.get('OPENAI_API_KEY')
-        if not api_key:
-            print(f"[TTS] Warning: No OPENAI_API_KEY found in environment variables", file=sys.stderr)
-            return jsonify({'error': 'OpenAI API key not configured', 'success': False}), 500
-        else:
-            print(f"[TTS] Found OPENAI_API_KEY in environment variables (first few chars): {api_key[:4]}...", file=sys.stderr)
-        
-        # Initialize OpenAI client
-        try:
-            print(f"[TTS] Initializing OpenAI client", file=sys.stderr)
-            client = OpenAI()
-            
-            # Generate speech
-            print(f"[TTS] Calling OpenAI TTS API with model: tts-1, voice: {voice}", file=sys.stderr)
-            start_time = time.time()
-            response = client.audio.speech.create(
-                model="tts-1",
-                voice=voice,
-                input=text
-            )
-            
-            # Log timing
-            duration = time.time() - start_time
-            print(f"[TTS] API call completed in {duration:.2f} seconds", file=sys.stderr)
-            
-            # Save to debug file
-            try:
-                response.stream_to_file(debug_file)
-                print(f"[TTS] Debug audio saved to {debug_file}", file=sys.stderr)
-                print(f"[TTS] File size: {os.path.getsize(debug_file)} bytes", file=sys.stderr)
-            except Exception as save_error:
-                print(f"[TTS] Error saving debug file: {str(save_error)}", file=sys.stderr)
-            
-            # Get audio data as base64
-            print(f"[TTS] Converting response to base64", file=sys.stderr)
-            audio_data = base64.b64encode(response.content).decode('utf-8')
-            print(f"[TTS] Successfully generated audio data (length: {len(audio_data)})", file=sys.stderr)
-            
-            # Return success response
-            print(f"[TTS] Returning success response with audio data", file=sys.stderr)
-            return jsonify({
-                'success': True,
-                'audio': audio_data,
-                'debug_file': debug_file
-            })
-        except Exception as inner_e:
-            print(f"[TTS] Error during API call: {str(inner_e)}", file=sys.stderr)
-            return jsonify({'error': str(inner_e), 'success': False}), 500
-            
-    except Exception as e:
-        import traceback
-        print(f"[TTS] Error in text-to-speech: {str(e)}", file=sys.stderr)
-        traceback.print_exc(file=sys.stderr)
-        return jsonify({'error': str(e), 'success': False}), 500        
-        traceback.print_exc(file=sys.stderr)
-        return jsonify({'error': str(e)}), 500
+    return synthesize_speech_json(openai_tts, '[TTS]')
+
+@app.route('/api/text-to-speech/stream', methods=['GET', 'POST'])
+@admitted('tts')
+def text_to_speech_stream():
+    """Stream OpenAI text to speech as audio/mpeg"""
+    return stream_speech(openai_tts, '[TTS]')
+
+@app.route('/api/text-to-speech/batch', methods=['POST'])
+@admitted('tts')
+def text_to_speech_batch():
+    """Synthesize several sentences with OpenAI, streamed back in order as length-prefixed frames"""
+    return synthesize_speech_batch(openai_tts, '[TTS]')
 
 @app.route('/api/text-to-speech-orpheus', methods=['POST'])
+@admitted('tts')
 def text_to_speech_orpheus():
     """Convert text to speech using Orpheus local API"""
-    try:
-        print(f"[TTS-Orpheus] Text-to-speech API called", file=sys.stderr)
-        
-        data = request.json
-        text = data.get('text')
-        voice = data.get('voice', 'tara')  # Default voice for Orpheus
-        
-        print(f"[TTS-Orpheus] Request data - Voice: {voice}, Text: '{text[:50]}...'", file=sys.stderr)
-        
-        if not text:
-            print(f"[TTS-Orpheus] Error: No text provided", file=sys.stderr)
-            return jsonify({'error': 'No text provided'}), 400
-            
-        import requests
-        import base64
-        import os
-        import time
-        import tempfile
-        
-        # Generate a unique filename for debugging
-        debug_file = os.path.join(tempfile.gettempdir(), f"tts_orpheus_debug_{int(time.time())}.mp3")
-          # Get local API base URL
-        api_base = os.environ.get('ORPEUS_MODEL_API_BASE', 'http://127.0.0.1:5005')
-        
-        # Make sure api_base doesn't have trailing slash
-        api_base = api_base.rstrip('/')
-            
-        orpheus_url = f"{api_base}/v1/audio/speech"
-        print(f"[TTS-Orpheus] Using Orpheus endpoint: {orpheus_url}", file=sys.stderr)
-        
-        # Prepare payload for Orpheus
-        payload = {
-            "input": text,
-            "model": "orpheus-3b-0.1-ft",
-            "voice": "tara",
-            "response_format": "wav",
-            "speed": 1
-        }
+    return synthesize_speech_json(orpheus_tts, '[TTS-Orpheus]')
 
+@app.route('/api/text-to-speech-orpheus/stream', methods=['GET', 'POST'])
+@admitted('tts')
+def text_to_speech_orpheus_stream():
+    """Stream Orpheus text to speech as audio/wav"""
+    return stream_speech(orpheus_tts, '[TTS-Orpheus]')
+
+@app.route('/api/text-to-speech-orpheus/batch', methods=['POST'])
+@admitted('tts')
+def text_to_speech_orpheus_batch():
+    """Synthesize several sentences with Orpheus, streamed back in order as length-prefixed frames"""
+    return synthesize_speech_batch(orpheus_tts, '[TTS-Orpheus]')
         
-        try:
-            # Call Orpheus TTS API
-            print(f"[TTS-Orpheus] Calling Orpheus TTS API with voice: {voice}", file=sys.stderr)
-            start_time = time.time()
-            response = requests.post(orpheus_url, json=payload)
-            
-            # Log timing and check response status
-            duration = time.time() - start_time
-            print(f"[TTS-Orpheus] API call completed in {duration:.2f} seconds", file=sys.stderr)
-            print(f"[TTS-Orpheus] Status code: {response.status_code}", file=sys.stderr)
-            
-            if response.status_code != 200:
-                error_msg = f"Orpheus API returned error: {response.status_code}, {response.text}"
-                print(f"[TTS-Orpheus] {error_msg}", file=sys.stderr)
-                return jsonify({'error': error_msg, 'success': False}), response.status_code
-            
-            # Save to debug file
-            try:
-                with open(debug_file, 'wb') as f:
-                    f.write(response.content)
-                print(f"[TTS-Orpheus] Debug audio saved to {debug_file}", file=sys.stderr)
-                print(f"[TTS-Orpheus] File size: {os.path.getsize(debug_file)} bytes", file=sys.stderr)
-            except Exception as save_error:
-                print(f"[TTS-Orpheus] Error saving debug file: {str(save_error)}", file=sys.stderr)
-            
-            # Get audio data as base64
-            print(f"[TTS-Orpheus] Converting response to base64", file=sys.stderr)
-            audio_data = base64.b64encode(response.content).decode('utf-8')
-            print(f"[TTS-Orpheus] Successfully generated audio data (length: {len(audio_data)})", file=sys.stderr)
-            
-            # Return success response in the same format as OpenAI endpoint
-            print(f"[TTS-Orpheus] Returning success response with audio data", file=sys.stderr)
-            return jsonify({
-                'success': True,
-                'audio': audio_data,
-                'debug_file': debug_file
-            })
-        except Exception as inner_e:
-            print(f"[TTS-Orpheus] Error during API call: {str(inner_e)}", file=sys.stderr)
-            return jsonify({'error': str(inner_e), 'success': False}), 500
-            
-    except Exception as e:
-        import traceback
-        print(f"[TTS-Orpheus] Error in text-to-speech-orpheus: {str(e)}", file=sys.stderr)
-        traceback.print_exc(file=sys.stderr)
-        return jsonify({'error': str(e), 'success': False}), 500
-        
+@app.route('/api/tts/audio/<handle>', methods=['GET'])
+def get_speech_audio(handle):
+    """Serve the audio of a speech chunk, waiting for its synthesis if it is still running"""
+    if not AUDIO_HANDLE_PATTERN.match(handle):
+        return jsonify({'error': 'Invalid audio handle'}), 400
+    
+    try:
+        audio = tts_prefetcher.get(handle, timeout=TTS_PREFETCH_WAIT)
+    except TtsError as e:
+        print(f"[TTS] Error serving prefetched audio {handle}: {str(e)}", file=sys.stderr)
+        return jsonify({'error': str(e), 'success': False}), e.status_code
+    if audio is None:
+        return jsonify({'error': 'Unknown or expired audio handle'}), 404
+    
+    # Handles are content hashes, so the audio behind one never changes
+    headers = {'Cache-Control': 'private, max-age=86400'}
+    emotion = tts_prefetcher.emotion(handle)
+    if emotion:
+        headers['X-Speech-Emotion'] = emotion
+    return Response(audio, mimetype=audio_media_type(audio), headers=headers)
+
+@app.route('/api/speech/prepare', methods=['POST'])
+@admitted('aux')
+def prepare_speech():
+    """Rewrite text the way a person would say it and pick its emotion (cached)"""
+    data = request.get_json(silent=True) or {}
+    text = data.get('text')
+    if not text or not isinstance(text, str):
+        return jsonify({'error': 'No text provided'}), 400
+    
+    result = speech_rewriter.rewrite(text)
+    return jsonify({'success': True, 'text': result['text'], 'emotion': result['emotion'],
+                    'cached': result['cached']})
+
 @app.route('/openai/completions', methods=['POST'])    
+@admitted('aux')
 def completions():
     """Send prompt to openai completions endpoint"""
-    from openai import OpenAI
-    import os
-    
-    # Check for API key
-    api_key = os.environ.get('OPENAI_API_KEY')
-    if not api_key:
-        print(f"[Completions] Warning: No OPENAI_API_KEY found in environment variables", file=sys.stderr)
-        return jsonify({'error': 'OpenAI API key not configured', 'success': False}), 500
-    else:
-        print(f"[Completions] Found OPENAI_API_KEY in environment variables (first few chars): {api_key[:4]}...", file=sys.stderr)
-        # Initialize OpenAI client
-        try:
-            data = request.json
-            prompt = data.get('prompt')
-            model = data.get('model', 'gpt-4o-mini')
-
-            client = OpenAI(api_key=api_key)
-            # Send prompt to completions endpoint
+    try:
+        client = upstreams.openai()
+    except UpstreamError as e:
+        print(f"[Completions] Warning: {str(e)}", file=sys.stderr)
+        return jsonify({'error': str(e), 'success': False}), 500
+    
+    try:
+        data = request.json
+        prompt = data.get('prompt')
+        model = data.get('model', 'gpt-4o-mini')
+        
+        # Send prompt to completions endpoint through the shared client
+        with upstreams.get('openai').guard():
             response = client.completions.create(
                 model=model,
                 prompt=prompt,
                 max_tokens=50
             )
-            # Return the response
-            return jsonify({
-                'success': True,
-                'response': response.choices[0].text.strip()
-            })
-        except Exception as e:
-            print(f"[Completions] Error during API call: {str(e)}", file=sys.stderr)
-            return jsonify({'error': str(e), 'success': False}), 500
-        traceback.print_exc(file=sys.stderr)
-        return jsonify({'error': str(e)}), 500
+        # Return the response
+        return jsonify({
+            'success': True,
+            'response': response.choices[0].text.strip()
+        })
+    except Exception as e:
+        print(f"[Completions] Error during API call: {str(e)}", file=sys.stderr)
+        return jsonify({'error': str(e), 'success': False}), getattr(e, 'status_code', None) or 500
 
 if __name__ == '__main__':
     # Default to port 5000 if not specified
@@ -531,44 +1095,39 @@ if __name__ == '__main__':
         print("!"*60 + "\n")
     
     # Initialize API settings for local models
-    default_model = os.environ.get('DEFAULT_MODEL', interpreter.llm.model)
-    local_api_base = os.environ.get('LOCAL_MODEL_API_BASE')
+    default_model = os.environ.get('DEFAULT_MODEL', interpreter_defaults['model'])
+    local_api_base = llm_router.primary
     
     # Check if we're using a local model by default
     if default_model == 'local' and local_api_base:
-        # Try to get the list of available models from the local API
-        try:
-            import requests
-            models_response = requests.get(f"{local_api_base}/models", timeout=5)
-            if models_response.status_code == 200:
-                available_models = models_response.json().get('data', [])
-                if available_models:
-                    # Use the first available model as default
-                    interpreter.llm.model = available_models[0]['id']
-                    print(f"Found local models: {[m['id'] for m in available_models]}", file=sys.stderr)
-                else:
-                    interpreter.llm.model = "openai/custom"  # Generic model identifier
-            else:
-                interpreter.llm.model = "openai/custom"  # Generic model identifier
-        except Exception as e:
-            print(f"Error fetching local models: {str(e)}", file=sys.stderr)
-            interpreter.llm.model = "openai/custom"  # Generic model identifier
+        # Try to get the list of available models from the local API (this also warms the catalogue)
+        catalogue = model_catalogue.get(local_api_base, timeout=5)
+        available_models = (catalogue['payload'] or {}).get('data', [])
+        if available_models:
+            # Use the first available model as default
+            interpreter_defaults['model'] = available_models[0]['id']
+            print(f"Found local models: {[m['id'] for m in available_models]}", file=sys.stderr)
+        else:
+            if catalogue['error']:
+                print(f"Error fetching local models: {catalogue['error']}", file=sys.stderr)
+            interpreter_defaults['model'] = "openai/custom"  # Generic model identifier
         
         # Set API base and format for local model
-        interpreter.llm.offline = True
-        interpreter.llm.api_base = local_api_base
-        interpreter.llm.format = "openai"  # Configure chat format for OpenAI compatibility
-        print(f"Using local model with API base: {local_api_base}", file=sys.stderr)
+        interpreter_defaults['offline'] = True
+        interpreter_defaults['api_base'] = local_api_base
+        interpreter_defaults['format'] = "openai"  # Configure chat format for OpenAI compatibility
+        print(f"Using local model with API bases: {', '.join(llm_router.api_bases)}", file=sys.stderr)
     
     # Print startup information
     print("\n" + "="*60)
     print(f"Open Interpreter Web Bridge is running!")
     print(f"Local URL: http://localhost:{port}")
     print(f"Network URL: http://{host}:{port} (if accessible on your network)")
-    print(f"Current model: {interpreter.llm.model}")
-    if hasattr(interpreter.llm, 'api_base') and interpreter.llm.api_base:
-        print(f"API base: {interpreter.llm.api_base}")
-    print(f"Auto-run code: {'Enabled' if interpreter.auto_run else 'Disabled'}")
+    print(f"Current model: {interpreter_defaults['model']}")
+    if interpreter_defaults.get('api_base'):
+        print(f"API base: {interpreter_defaults['api_base']}")
+    print(f"Auto-run code: {'Enabled' if interpreter_defaults['auto_run'] else 'Disabled'}")
+    print(f"Max concurrent sessions: {session_manager.max_sessions}")
     print("="*60)
     print("\nPress Ctrl+C to quit\n")
     # Start the Flask app
@@ -0,0 +1,185 @@
+"""
+ASGI entry point for the asyncio serving mode
+
+/chat (and resuming a chat stream) is served natively on the event loop so
+thousands of idle or slow SSE connections can stay open in one process. Every other route is handed to the
+Flask app through asgiref's WSGI adapter.
+
+Run with ``python -m src --async`` or ``uvicorn asgi:application`` from src/.
+"""
+import asyncio
+import json
+import re
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs
+
+from asgiref.wsgi import WsgiToAsgi
+
+from app import app, admission, session_manager, start_generation, create_coalescer
+from utils.markdown_stream import markdown_available
+from utils.async_streaming import iter_sse_frames, until_disconnect
+from utils.admission import AdmissionRejected
+from utils.session_manager import SessionLimitError, DEFAULT_SESSION_ID
+from utils.conversation_store import owner_key
+from utils.wire_format import negotiate_stream_encoder, UnsupportedStreamFormat
+
+flask_application = WsgiToAsgi(app)
+
+RESUME_PATH = re.compile(r'^/chat/([^/]+)/stream$')
+
+# Threads that wait for chat admission slots, one per request the chat queue admits (plus one that
+# isn't waiting), so waiting chats never take the threads of the loop's default executor
+admission_executor = ThreadPoolExecutor(max_workers=admission.max_queue('chat') + 1,
+                                        thread_name_prefix='admission')
+
+
+async def application(scope, receive, send):
+    """Route /chat to the async streamer and everything else to Flask"""
+    if scope['type'] == 'lifespan':
+        await lifespan(receive, send)
+    elif scope['type'] == 'http' and scope['method'] == 'POST' and scope['path'] == '/chat':
+        await chat(scope, receive, send)
+    elif scope['type'] == 'http' and scope['method'] == 'GET' and RESUME_PATH.match(scope['path']):
+        await resume_chat(scope, receive, send, RESUME_PATH.match(scope['path']).group(1))
+    else:
+        await flask_application(scope, receive, send)
+
+
+async def lifespan(receive, send):
+    """Acknowledge server startup and shutdown"""
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def read_body(receive):
+    """Read the full request body"""
+    body = b''
+    while True:
+        message = await receive()
+        body += message.get('body', b'')
+        if not message.get('more_body'):
+            return body
+
+
+async def send_json(send, status, payload, headers=()):
+    """Send a complete JSON response"""
+    body = json.dumps(payload).encode('utf-8')
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [(b'content-type', b'application/json'), (b'content-length', str(len(body)).encode())]
+                   + list(headers)
+    })
+    await send({'type': 'http.response.body', 'body': body})
+
+
+def parse_request(scope):
+    """Lower-cased headers and parsed query string of a request"""
+    headers = {key.decode('latin-1').lower(): value.decode('latin-1') for key, value in scope['headers']}
+    query = parse_qs(scope.get('query_string', b'').decode('latin-1'))
+    return headers, query
+
+
+async def stream_generation(receive, send, generation, after_id, encoder, headers=()):
+    """Send a generation's frames after after_id as a streaming response"""
+    await send({
+        'type': 'http.response.start',
+        'status': 200,
+        'headers': [
+            (b'content-type', encoder.media_type.encode()),
+            (b'cache-control', b'no-cache'),
+            (b'x-stream-format', encoder.name.encode()),
+            (b'x-chat-id', generation.chat_id.encode()),
+        ] + list(headers)
+    })
+    try:
+        frames = iter_sse_frames(generation, after_id, create_coalescer(), encoder)
+        async for frame in until_disconnect(frames, receive):
+            if isinstance(frame, str):
+                frame = frame.encode('utf-8')
+            await send({'type': 'http.response.body', 'body': frame, 'more_body': True})
+        await send({'type': 'http.response.body', 'body': b''})
+    except Exception as e:
+        print(f"Error in async chat stream: {str(e)}", file=sys.stderr)
+
+
+async def chat(scope, receive, send):
+    """Process a chat message and stream the response as SSE from the event loop"""
+    try:
+        data = json.loads(await read_body(receive) or b'{}')
+    except json.JSONDecodeError:
+        await send_json(send, 400, {"error": "Invalid JSON body"})
+        return
+
+    prompt = data.get('prompt')
+    if not prompt:
+        await send_json(send, 400, {"error": "No prompt provided"})
+        return
+
+    # Same session resolution as app.get_session_id(): header, query string, then body
+    headers, query = parse_request(scope)
+    session_id = headers.get('x-session-id') or query.get('session_id', [None])[0] or data.get('session_id')
+
+    # Pick the wire encoding (full JSON, compact or MessagePack)
+    try:
+        encoder = negotiate_stream_encoder(headers.get('accept'), query.get('stream_format', [None])[0])
+    except UnsupportedStreamFormat as e:
+        await send_json(send, 406, {"error": str(e)})
+        return
+
+    try:
+        session = session_manager.get(session_id)
+    except SessionLimitError as e:
+        await send_json(send, 503, {"error": str(e)})
+        return
+    if session.owner is None:
+        # Same owner as app.get_owner(): the client id, else the session id
+        session.owner = owner_key(headers.get('x-client-id') or session_id or DEFAULT_SESSION_ID)
+
+    # Server-side markdown rendering, when asked for and available
+    render_html = data.get('render') == 'html' and markdown_available()
+    
+    # Waiting for an admission slot blocks, so it happens off the event loop, on its own threads
+    try:
+        generation = await asyncio.get_running_loop().run_in_executor(
+            admission_executor, lambda: start_generation(session, prompt, speak=bool(data.get('speak')), voice=data.get('voice'),
+                                           render_html=render_html))
+    except AdmissionRejected as e:
+        await send_json(send, 429, {"error": str(e)}, [(b'retry-after', str(e.retry_after).encode())])
+        return
+    if generation is None:
+        await send_json(send, 409, {"error": "A response is already being generated for this conversation"})
+        return
+
+    await stream_generation(receive, send, generation, 0, encoder,
+                            [(b'x-markdown-render', b'html')] if render_html else ())
+
+
+async def resume_chat(scope, receive, send, chat_id):
+    """Resume a dropped chat stream after the client's Last-Event-ID"""
+    headers, query = parse_request(scope)
+    session = session_manager.peek(headers.get('x-session-id') or query.get('session_id', [None])[0])
+    generation = session.generation if session is not None else None
+    if generation is None or generation.chat_id != chat_id:
+        await send_json(send, 404, {"error": "Unknown or expired chat"})
+        return
+
+    last_event_id = headers.get('last-event-id') or query.get('last_event_id', ['0'])[0]
+    if not last_event_id.isdigit():
+        await send_json(send, 400, {"error": "Last-Event-ID must be a number"})
+        return
+
+    try:
+        encoder = negotiate_stream_encoder(headers.get('accept'), query.get('stream_format', [None])[0])
+    except UnsupportedStreamFormat as e:
+        await send_json(send, 406, {"error": str(e)})
+        return
+
+    print(f"Resuming chat {chat_id} after event {last_event_id}", file=sys.stderr)
+    await stream_generation(receive, send, generation, int(last_event_id), encoder)
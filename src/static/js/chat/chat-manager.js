@@ -2,6 +2,7 @@
  * Chat Manager - Handles chat messages and interactions
  */
 import MessageProcessor from './message-processor.js';
+import ApiUtils from '../utils/api.js';
 
 class ChatManager {
     constructor(codeManager) {
@@ -18,6 +19,7 @@ class ChatManager {
         
         // State
         this.currentEventSource = null;
+        this.currentChatId = null;
         
         this.initEventListeners();
     }
@@ -39,16 +41,37 @@ class ChatManager {
                 // Shift+Enter sends the message too (keyboard shortcut)
                 e.preventDefault();
                 this.sendMessage();
+            } else if (e.key === 'Escape' && this.currentChatId) {
+                // Escape stops the response that is being generated
+                e.preventDefault();
+                this.cancelChat();
             }
         });
     }
     
+    /**
+     * Stop the response that is currently being generated, including any code it is running
+     * @returns {Promise} Promise that resolves once the server has been asked to stop
+     */
+    cancelChat() {
+        const chatId = this.currentChatId;
+        if (!chatId) return Promise.resolve();
+        this.currentChatId = null;
+        
+        return fetch(`/chat/${chatId}/cancel`, {
+            method: 'POST',
+            headers: ApiUtils.sessionHeaders()
+        }).catch(error => console.error('Error cancelling chat:', error));
+    }
+    
     /**
      * Reset the chat conversation
      */
     resetChat() {
+        this.currentChatId = null;
         fetch('/reset', {
-            method: 'POST'
+            method: 'POST',
+            headers: ApiUtils.sessionHeaders()
         })
         .then(() => {
             this.chatContainer.innerHTML = `
@@ -108,23 +131,59 @@ class ChatManager {
         // Make API request
         fetch('/chat', {
             method: 'POST',
-            headers: {
+            headers: ApiUtils.sessionHeaders({
                 'Content-Type': 'application/json',
-                'Accept': 'text/event-stream'
-            },
-            body: JSON.stringify({ prompt: message })
+                // Ask for the compact stream format; the server falls back to full JSON chunks
+                'Accept': 'application/vnd.oi-stream.compact, text/event-stream'
+            }),
+            // With speech on, the server segments the reply and synthesizes each sentence as it completes;
+            // render: 'html' asks it to render finished markdown blocks too
+            body: JSON.stringify({
+                prompt: message,
+                speak: !!(window.speechManager && !window.speechManager.isMuted),
+                voice: window.speechManager ? window.speechManager.currentVoice : undefined,
+                render: 'html'
+            })
         }).then(response => {
+            if (response.status === 429) {
+                // The server is at capacity; it says when to try again
+                const retryAfter = response.headers.get('Retry-After') || 'a few';
+                throw new Error(`The server is busy, please try again in ${retryAfter} seconds`);
+            }
             if (!response.ok) {
                 throw new Error('Failed to send message to server');
             }
             
+            // The server only renders markdown when it can; otherwise the client renders everything
+            this.messageProcessor.serverMarkdown = response.headers.get('X-Markdown-Render') === 'html';
+            
             // Process streaming response
             const reader = response.body.getReader();
             const textDecoder = new TextDecoder();
             let buffer = '';
             
+            // Reconnect to the same generation if the connection drops mid-stream
+            const chatId = response.headers.get('X-Chat-ID');
+            this.currentChatId = chatId;
+            const resume = chatId ? (lastEventId) => fetch(`/chat/${chatId}/stream`, {
+                headers: ApiUtils.sessionHeaders({
+                    'Last-Event-ID': String(lastEventId),
+                    'Accept': 'application/vnd.oi-stream.compact, text/event-stream'
+                })
+            }).then(resumed => {
+                if (!resumed.ok) {
+                    throw new Error('Failed to resume the response stream');
+                }
+                return resumed.body.getReader();
+            }) : null;
+            
             // Start processing the stream
-            return this.messageProcessor.processStream(reader, textDecoder, buffer, aiMessageDiv);
+            return this.messageProcessor.processStream(reader, textDecoder, buffer, aiMessageDiv, resume)
+                .finally(() => {
+                    if (this.currentChatId === chatId) {
+                        this.currentChatId = null;
+                    }
+                });
         }).catch(error => {
             console.error('Error processing chat:', error);
             const contentDiv = aiMessageDiv.querySelector('.markdown-content');
@@ -254,6 +313,13 @@ class ChatManager {
             'Delete Message', 
             'Are you sure you want to delete this message and all subsequent messages?',
             () => {
+                // The server finds the message by its turn: the user messages shown before it
+                let turn = 0;
+                for (let previous = messageDiv.previousElementSibling; previous; previous = previous.previousElementSibling) {
+                    if (previous.classList.contains('message') && previous.dataset.role === 'user') turn++;
+                }
+                const role = messageDiv.dataset.role;
+                
                 // Find all messages after this one
                 let nextMessage = messageDiv.nextElementSibling;
                 while (nextMessage) {
@@ -265,20 +331,8 @@ class ChatManager {
                 // Remove the message itself
                 this.chatContainer.removeChild(messageDiv);
                 
-                // Reset the chat state on the server
-                fetch('/reset_to_message', {
-                    method: 'POST',
-                    headers: {
-                        'Content-Type': 'application/json'
-                    },
-                    body: JSON.stringify({
-                        messages: Array.from(this.chatContainer.querySelectorAll('.message'))
-                            .map(msg => ({
-                                role: msg.dataset.role,
-                                content: msg.dataset.content
-                            }))
-                    })
-                });
+                // Cut the conversation on the server too; what was deleted stays as a branch
+                ApiUtils.deleteFromTurn(turn, role);
                 
                 // Reset code tracking
                 this.codeManager.resetAllTracking();
@@ -383,25 +437,39 @@ class ChatManager {
     /**
      * Load chat history from the server
      */
-    loadHistory() {
-        fetch('/history')
-            .then(response => response.json())
-            .then(data => {
-                if (data && data.length > 0) {
+    async loadHistory() {
+        try {
+            // Page through the history with only the fields we render, and huge contents cut short
+            let page = { next: 0 };
+            let cleared = false;
+            while (page.next !== null) {
+                page = await ApiUtils.fetchHistoryPage({
+                    since: page.next,
+                    limit: 100,
+                    fields: ['role', 'type', 'content', 'blob'],
+                    preview: 4000
+                });
+                if (page.messages.length > 0 && !cleared) {
                     // Clear welcome message
                     this.chatContainer.innerHTML = '';
-                    
-                    // Add all messages to chat
-                    data.forEach(msg => {
-                        if (msg.role && msg.content) {
-                            this.addMessageToChat(msg.role, msg.content);
-                        }
-                    });
+                    cleared = true;
                 }
-            })
-            .catch(error => {
-                console.error("Error loading chat history:", error);
-            });
+                
+                // Add the page's messages to chat
+                page.messages.forEach(msg => {
+                    if (msg.role && msg.blob && msg.type === 'image') {
+                        // Images stay on the server; the browser loads (and caches) them by URL
+                        this.addMessageToChat(msg.role, `<img src="${ApiUtils.blobUrl(msg.blob)}" alt="image" loading="lazy">`);
+                    } else if (msg.role && msg.blob) {
+                        this.addMessageToChat(msg.role, `<a href="${ApiUtils.blobUrl(msg.blob)}" target="_blank" rel="noopener">Show full ${this.escapeHtml(msg.type || 'content')}</a>`);
+                    } else if (msg.role && msg.content) {
+                        this.addMessageToChat(msg.role, msg.truncated ? `${msg.content}\n\n…` : msg.content);
+                    }
+                });
+            }
+        } catch (error) {
+            console.error("Error loading chat history:", error);
+        }
     }
     
     /**
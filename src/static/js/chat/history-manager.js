@@ -20,8 +20,12 @@ class HistoryManager {
         if (!this.sidebarHistoryContainer) return;
         
         try {
-            const historyData = await ApiUtils.fetchHistory();
-            this.renderHistory(historyData);
+            // Stored conversations, with timestamps in milliseconds for display
+            const conversations = await ApiUtils.fetchConversations();
+            this.renderHistory(conversations.map(conversation => ({
+                ...conversation,
+                timestamp: conversation.updated_at * 1000
+            })));
         } catch (error) {
             console.error('Error loading history:', error);
         }
@@ -149,6 +153,10 @@ class HistoryManager {
      * @returns {string} Title for the history item
      */
     getHistoryItemTitle(item) {
+        // Stored conversations come with a title
+        if (item.title) {
+            return item.title.length > 40 ? item.title.substring(0, 40) + '...' : item.title;
+        }
         if (!item.messages || item.messages.length === 0) {
             return 'Empty conversation';
         }
@@ -175,10 +183,13 @@ class HistoryManager {
     async loadConversation(item) {
         if (confirm('Load this conversation? Current chat will be replaced.')) {
             try {
-                await ApiUtils.resetToMessages(item.messages);
+                const conversation = await ApiUtils.fetchConversation(item.id);
+                
+                // Continue in the conversation's own session; the server restores it from the store
+                ApiUtils.setSessionId(conversation.session_id);
                 
                 // Update the UI
-                this.chatManager.loadConversation(item.messages);
+                this.chatManager.loadConversation(conversation.messages);
                 
                 // Close sidebar on mobile
                 const sidebar = document.getElementById('sidebar');
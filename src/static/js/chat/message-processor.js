@@ -13,6 +13,11 @@ class MessageProcessor {
         this.thinkingStartTime = 0;
         this.thinkingInterval = null;
         this.thinkingHandler = null;
+        this.wireBlocks = {};
+        this.lastEventId = 0;
+        
+        // Set when the server renders finished markdown blocks itself (markdown chunks)
+        this.serverMarkdown = false;
     }
     
     /**
@@ -74,15 +79,141 @@ class MessageProcessor {
         return text.trim();
     }
     
+    /**
+     * Expand a compact-format frame into a regular chunk object
+     * 
+     * Compact streams send a block's metadata once in a header frame
+     * ({b, m, d[, e]}) and then only [blockId, delta(, 1)] frames.
+     * Regular chunk objects are returned unchanged.
+     * @param {Object|Array} frame Parsed frame from the stream
+     * @returns {Object} Chunk with type, content and flags
+     */
+    decodeWireChunk(frame) {
+        if (Array.isArray(frame)) {
+            const meta = this.wireBlocks[frame[0]] || {};
+            return { ...meta, content: frame[1], is_end: frame[2] === 1 };
+        }
+        
+        if (frame && frame.b !== undefined && frame.m) {
+            // Flags that only apply to the header chunk aren't carried into later deltas
+            const { is_new_block, new_message, new_ui_element, code_block_completed,
+                    new_message_after_code, ...meta } = frame.m;
+            this.wireBlocks[frame.b] = meta;
+            return { ...frame.m, content: frame.d, is_end: frame.e === 1 };
+        }
+        
+        return frame;
+    }
+    
+    /**
+     * Server-rendered markdown state of a message element
+     * 
+     * The element holds the HTML of finished blocks, which is only ever
+     * appended to, and a tail element re-rendered from the text after it.
+     * @param {HTMLElement} contentDiv Message content element
+     * @returns {Object} {finished, tail, renderedUpTo, messageText}
+     */
+    markdownState(contentDiv) {
+        if (!contentDiv.markdownState) {
+            const finished = document.createElement('div');
+            const tail = document.createElement('div');
+            contentDiv.innerHTML = '';
+            contentDiv.appendChild(finished);
+            contentDiv.appendChild(tail);
+            contentDiv.markdownState = {
+                finished,
+                tail,
+                // Length of the message content covered by the finished HTML
+                renderedUpTo: 0,
+                // Characters of message text after that, which the server will render
+                messageText: 0
+            };
+        }
+        return contentDiv.markdownState;
+    }
+    
+    /**
+     * Append rendered HTML to a message's finished blocks, highlighting only its code
+     * @param {Object} state Markdown state from markdownState()
+     * @param {string} html Rendered HTML
+     */
+    appendMarkdownFragment(state, html) {
+        const template = document.createElement('template');
+        template.innerHTML = html;
+        template.content.querySelectorAll('pre code').forEach((block) => {
+            hljs.highlightBlock(block);
+        });
+        state.finished.appendChild(template.content);
+    }
+    
+    /**
+     * Apply a markdown chunk: its HTML replaces the message text before its tail
+     * @param {HTMLElement} contentDiv Message content element
+     * @param {string} messageContent The message's content so far
+     * @param {Object} chunk Chunk with the HTML (content) and the raw tail
+     */
+    applyMarkdownChunk(contentDiv, messageContent, chunk) {
+        const state = this.markdownState(contentDiv);
+        const tail = chunk.tail || '';
+        if (chunk.content) {
+            this.appendMarkdownFragment(state, chunk.content);
+        }
+        state.renderedUpTo = messageContent.length - tail.length;
+        state.messageText = tail.length;
+    }
+    
+    /**
+     * Move content the client added itself (code, output) into the finished blocks
+     * 
+     * The server only renders message text, so anything else after the
+     * rendered part is rendered here once the next message text starts.
+     * @param {HTMLElement} contentDiv Message content element
+     * @param {string} messageContent The message's content so far
+     */
+    sealClientMarkdown(contentDiv, messageContent) {
+        const state = this.markdownState(contentDiv);
+        if (messageContent.length - state.renderedUpTo > state.messageText) {
+            this.appendMarkdownFragment(state, marked.parse(messageContent.slice(state.renderedUpTo)));
+            state.renderedUpTo = messageContent.length;
+            state.messageText = 0;
+        }
+    }
+    
+    /**
+     * Render a message's markdown with code highlighting
+     * 
+     * With server rendering only the part after the finished blocks is
+     * rendered, so the cost per chunk doesn't grow with the message.
+     * @param {HTMLElement} contentDiv Message content element
+     * @param {string} messageContent The message's content so far
+     */
+    renderMessage(contentDiv, messageContent) {
+        let target = contentDiv;
+        let markdownText = messageContent;
+        if (this.serverMarkdown) {
+            const state = this.markdownState(contentDiv);
+            target = state.tail;
+            markdownText = messageContent.slice(state.renderedUpTo);
+        }
+        target.innerHTML = markdownText ? marked.parse(markdownText) : '';
+        
+        // Apply syntax highlighting to code blocks
+        target.querySelectorAll('pre code').forEach((block) => {
+            hljs.highlightBlock(block);
+        });
+    }
+    
     /**
      * Process a stream of message chunks from the server
      * @param {ReadableStreamDefaultReader} reader Stream reader
      * @param {TextDecoder} textDecoder Text decoder for the stream
      * @param {string} buffer Initial buffer content
      * @param {HTMLElement} aiMessageDiv Container for AI message
+     * @param {Function} [resume] Called with the last event id when the connection drops;
+     *     resolves to a reader for the rest of the stream
      * @returns {Promise} Promise that resolves when stream is fully processed
      */
-    processStream(reader, textDecoder, buffer, aiMessageDiv) {
+    processStream(reader, textDecoder, buffer, aiMessageDiv, resume = null) {
         // Get UI components
         const thinkingSection = aiMessageDiv.querySelector('.thinking-section');
         const thinkingContentDiv = thinkingSection.querySelector('.thinking-content');
@@ -94,6 +225,32 @@ class MessageProcessor {
         let messageContent = '';
         let thinkingContent = '';
         
+        // Set once the server sends speech chunks, which replace speaking the whole reply at the end
+        let speechChunksReceived = false;
+        
+        // Block metadata for the compact stream format, keyed by block id
+        this.wireBlocks = {};
+        
+        // Id of the last complete event, used to resume a dropped stream
+        this.lastEventId = 0;
+        let resumeAttempts = 0;
+        
+        // Read the next piece of the stream, reconnecting after a dropped connection
+        const readNext = () => reader.read().catch(error => {
+            if (!resume || resumeAttempts >= 3) {
+                throw error;
+            }
+            resumeAttempts++;
+            console.warn(`Stream interrupted, resuming after event ${this.lastEventId}:`, error);
+            
+            // Any partial event is replayed by the server
+            buffer = '';
+            return resume(this.lastEventId).then(newReader => {
+                reader = newReader;
+                return reader.read();
+            });
+        });
+        
         // Create a ThinkingHandler
         this.thinkingHandler = {
             section: thinkingSection,
@@ -165,10 +322,7 @@ class MessageProcessor {
                 // Close any open code blocks
                 if (this.isInCodeBlock) {
                     messageContent += '\n```';
-                    contentDiv.innerHTML = marked.parse(messageContent);
-                    contentDiv.querySelectorAll('pre code').forEach((block) => {
-                        hljs.highlightBlock(block);
-                    });
+                    this.renderMessage(contentDiv, messageContent);
                 }
                 
                 // Clean up thinking mode if still active
@@ -207,6 +361,12 @@ class MessageProcessor {
             for (const event of events) {
                 if (!event.trim()) continue; // Skip empty events
                 
+                // Remember the event id so a dropped stream can be resumed
+                const idMatch = event.match(/^id: (\d+)$/m);
+                if (idMatch) {
+                    this.lastEventId = parseInt(idMatch[1], 10);
+                }
+                
                 // Extract data from SSE format
                 const dataMatch = event.match(/data: (.*)/);
                 if (!dataMatch) continue;
@@ -219,10 +379,7 @@ class MessageProcessor {
                     // Close any open code blocks
                     if (this.isInCodeBlock) {
                         messageContent += '\n```';
-                        contentDiv.innerHTML = marked.parse(messageContent);
-                        contentDiv.querySelectorAll('pre code').forEach((block) => {
-                            hljs.highlightBlock(block);
-                        });
+                        this.renderMessage(contentDiv, messageContent);
                     }
                     
                     // Clean up thinking mode if still active
@@ -235,7 +392,10 @@ class MessageProcessor {
                     this.thinkingHandler.ensureVisible();
                     
                     // Speak the message text using the avatar (extract plain text from messageContent)
-                    this.speakResponseText(messageContent);
+                    // unless it was already spoken sentence by sentence
+                    if (!speechChunksReceived) {
+                        this.speakResponseText(messageContent);
+                    }
 
                     return;
                 }
@@ -312,7 +472,7 @@ class MessageProcessor {
                 
                 // Parse the data
                 try {
-                    const chunk = JSON.parse(eventData);
+                    const chunk = this.decodeWireChunk(JSON.parse(eventData));
                     
                     // Handle thinking mode
                     if (chunk.type === 'thinking_start') {
@@ -325,9 +485,21 @@ class MessageProcessor {
                         continue;
                     }
                     
+                    // A finished sentence whose audio the server is already synthesizing
+                    if (chunk.type === 'speech') {
+                        speechChunksReceived = true;
+                        if (window.speechManager) {
+                            window.speechManager.enqueuePrefetched(chunk.content, chunk.audio);
+                        }
+                        continue;
+                    }
+                    
                     // Process different types of chunks
                     if (typeof chunk === 'object') {
-                        if (chunk.type === 'message') {
+                        if (chunk.type === 'markdown') {
+                            // Finished blocks of the current message, rendered by the server
+                            this.applyMarkdownChunk(contentDiv, messageContent, chunk);
+                        } else if (chunk.type === 'message') {
                             const content = chunk.content || '';
                             
                             // Detect if this message chunk might contain code block markers
@@ -371,10 +543,7 @@ class MessageProcessor {
                                     
                                     // Render the current message content first
                                     if (messageContent.trim()) {
-                                        contentDiv.innerHTML = marked.parse(messageContent);
-                                        contentDiv.querySelectorAll('pre code').forEach((block) => {
-                                            hljs.highlightBlock(block);
-                                        });
+                                        this.renderMessage(contentDiv, messageContent);
                                         
                                         // Create a new content div with clear separation for the next message
                                         const newContentDiv = document.createElement('div');
@@ -392,10 +561,7 @@ class MessageProcessor {
                                 }
                                 // For regular new messages
                                 else if (messageContent.trim()) {
-                                    contentDiv.innerHTML = marked.parse(messageContent);
-                                    contentDiv.querySelectorAll('pre code').forEach((block) => {
-                                        hljs.highlightBlock(block);
-                                    });
+                                    this.renderMessage(contentDiv, messageContent);
                                     
                                     // Create a new content div for the next message
                                     const newContentDiv = document.createElement('div');
@@ -413,6 +579,16 @@ class MessageProcessor {
                                 thinkingContent += content;
                                 this.thinkingHandler.addContent(content);
                             } else {
+                                if (this.serverMarkdown) {
+                                    // The server renders this text; anything the client added before it is final
+                                    if (this.isInCodeBlock) {
+                                        messageContent += '\n```';
+                                        this.isInCodeBlock = false;
+                                    }
+                                    this.sealClientMarkdown(contentDiv, messageContent);
+                                    this.markdownState(contentDiv).messageText += content.length;
+                                }
+                                
                                 // Add to normal message content
                                 messageContent += content;
                             }                            
@@ -543,6 +719,11 @@ class MessageProcessor {
                                         this.codeManager.updatePanel(null, null, formattedOutput);
                                     }
                                 }
+                                
+                                // Large output is saved on the server; let the panel page through it
+                                if (chunk.output_handle) {
+                                    this.codeManager.showSpilledOutput(chunk.output_handle);
+                                }
                             }
                         } else if (chunk.type === 'console') {
                             // Handle console messages (like active line indicators)
@@ -659,12 +840,7 @@ class MessageProcessor {
                 
                 // Render message with markdown and code highlighting if not in thinking mode
                 if (!this.isThinking) {
-                    contentDiv.innerHTML = marked.parse(messageContent);
-                    
-                    // Apply syntax highlighting to code blocks
-                    contentDiv.querySelectorAll('pre code').forEach((block) => {
-                        hljs.highlightBlock(block);
-                    });
+                    this.renderMessage(contentDiv, messageContent);
                 }
                 
                 // Scroll to bottom of chat container
@@ -672,11 +848,11 @@ class MessageProcessor {
             }
             
             // Continue reading
-            return reader.read().then(processChunk);
+            return readNext().then(processChunk);
         };
         
         // Start reading the stream
-        return reader.read().then(processChunk)
+        return readNext().then(processChunk)
             .catch(error => {
                 console.error('Error processing stream:', error);
                 contentDiv.innerHTML = `<p class="error">Error: ${error.message}</p>`;
@@ -1,6 +1,10 @@
 /**
  * Code Manager - Handles code execution and display
  */
+import ApiUtils from '../utils/api.js';
+
+// Bytes of spilled output fetched per page
+const OUTPUT_PAGE_BYTES = 65536;
 
 class CodeManager {    constructor() {
         // DOM elements
@@ -58,6 +62,7 @@ class CodeManager {    constructor() {
     clearContent() {
         this.codeContent.textContent = '';
         this.outputContent.textContent = '';
+        this.removeSpilledOutputControl();
         this.currentCodeExecution = {
             code: '',
             language: '',
@@ -65,6 +70,74 @@ class CodeManager {    constructor() {
         };
     }
     
+    /**
+     * Offer to page through output that the server saved to disk instead of streaming
+     * @param {string} handle Output handle from the stream
+     */
+    showSpilledOutput(handle) {
+        if (this.spilledOutput && this.spilledOutput.handle === handle) return;
+        this.removeSpilledOutputControl();
+        
+        const button = document.createElement('button');
+        button.className = 'btn btn-secondary load-full-output';
+        button.textContent = 'Load full output';
+        button.addEventListener('click', () => this.loadSpilledOutputPage());
+        this.outputContent.insertAdjacentElement('afterend', button);
+        
+        this.spilledOutput = { handle, offset: 0, button, decoder: new TextDecoder() };
+    }
+    
+    /**
+     * Fetch the next page of spilled output and append it to the output panel
+     */
+    loadSpilledOutputPage() {
+        const spilled = this.spilledOutput;
+        if (!spilled) return;
+        spilled.button.disabled = true;
+        
+        const end = spilled.offset + OUTPUT_PAGE_BYTES - 1;
+        fetch(`/output/${spilled.handle}`, {
+            headers: ApiUtils.sessionHeaders({ 'Range': `bytes=${spilled.offset}-${end}` })
+        })
+        .then(response => {
+            if (!response.ok) {
+                throw new Error(`Output request failed with status ${response.status}`);
+            }
+            const total = parseInt(response.headers.get('X-Output-Size'), 10);
+            return response.arrayBuffer().then(buffer => ({ buffer, total }));
+        })
+        .then(({ buffer, total }) => {
+            if (spilled.offset === 0) {
+                // Replace the head/tail summary with the full output
+                this.outputContent.textContent = '';
+            }
+            spilled.offset += buffer.byteLength;
+            const done = buffer.byteLength === 0 || spilled.offset >= total;
+            this.outputContent.textContent += spilled.decoder.decode(buffer, { stream: !done });
+            
+            if (done) {
+                this.removeSpilledOutputControl();
+            } else {
+                spilled.button.textContent = `Load more (${spilled.offset} of ${total} bytes)`;
+                spilled.button.disabled = false;
+            }
+        })
+        .catch(error => {
+            console.error('Error loading spilled output:', error);
+            spilled.button.disabled = false;
+        });
+    }
+    
+    /**
+     * Remove the spilled output pager, if any
+     */
+    removeSpilledOutputControl() {
+        if (this.spilledOutput) {
+            this.spilledOutput.button.remove();
+            this.spilledOutput = null;
+        }
+    }
+    
     /**
      * Reset code execution tracking
      * Used when a completely new code execution is starting
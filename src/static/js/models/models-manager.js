@@ -1,6 +1,7 @@
 /**
  * Models and Settings Manager - Handles model selection and application settings
  */
+import ApiUtils from '../utils/api.js';
 
 class ModelsManager {
     constructor() {
@@ -9,6 +10,7 @@ class ModelsManager {
         this.modelList = document.getElementById('available-models-list');
         this.contextWindow = document.getElementById('context-window');
         this.maxTokens = document.getElementById('max-tokens');
+        this.contextPolicy = document.getElementById('context-policy');
         this.autoRun = document.getElementById('auto-run');
         this.applySettings = document.getElementById('apply-settings');
 
@@ -61,8 +63,9 @@ class ModelsManager {
 
     /**
      * Fetch and display available models from the API
+     * @param {number} attempt Retries so far while the server's first fetch is pending
      */
-    async fetchAndDisplayModels() {
+    async fetchAndDisplayModels(attempt = 0) {
         try {
             const response = await fetch(`api/models`);
 
@@ -74,6 +77,11 @@ class ModelsManager {
             const models = data.data || [];
 
             this.displayModels(models);
+
+            // The server hasn't heard back from the model API yet; ask again shortly
+            if (data.pending && attempt < 5) {
+                setTimeout(() => this.fetchAndDisplayModels(attempt + 1), 2000);
+            }
         } catch (error) {
             console.error("Error fetching local models:", error);
             this.displayModels([]);
@@ -127,6 +135,7 @@ class ModelsManager {
             model: this.getSelectedModel(),
             context_window: this.contextWindow.value,
             max_tokens: this.maxTokens.value,
+            context_policy: this.contextPolicy.value,
             auto_run: this.autoRun.checked,
             custom: this.modelSelect.value === 'custom' ? true : false
         };
@@ -134,9 +143,9 @@ class ModelsManager {
 
         fetch('/settings', {
             method: 'POST',
-            headers: {
+            headers: ApiUtils.sessionHeaders({
                 'Content-Type': 'application/json'
-            },
+            }),
             body: JSON.stringify(settings)
         })
             .then(response => response.json())
@@ -154,12 +163,13 @@ class ModelsManager {
      */
     async loadSettings() {
         try {
-            const response = await fetch('/settings');
+            const response = await fetch('/settings', { headers: ApiUtils.sessionHeaders() });
             const data = await response.json();
 
             this.modelSelect.value = data.model || 'gpt-4';
             this.contextWindow.value = data.context_window || 8000;
             this.maxTokens.value = data.max_tokens || 1000;
+            this.contextPolicy.value = data.context_policy || 'trim';
             this.autoRun.checked = data.auto_run !== undefined ? data.auto_run : true;
 
 
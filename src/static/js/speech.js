@@ -2,6 +2,8 @@
 /**
  * Text-to-Speech functionality for Open Interpreter Web Bridge
  */
+import ApiUtils from './utils/api.js';
+
 class SpeechManager {
     constructor() {
         console.log('[SpeechManager] Initializing speech manager...');
@@ -361,6 +363,102 @@ class SpeechManager {
         }
     }
 
+    /**
+     * Queue a sentence whose audio the server is already synthesizing
+     * @param {string} text - The sentence (shown while it plays).
+     * @param {?string} audioHandle - Handle of the prefetched audio, or null if the
+     *     server couldn't prefetch it (the text is then synthesized on demand).
+     */
+    enqueuePrefetched(text, audioHandle) {
+        if (!text || text.trim() === '') return;
+
+        // Sentences of one reply accumulate into the replayable text block
+        if (this.audioQueue.length === 0 && !this.isPlaying) {
+            this.lastSpokenText = text;
+            this.managePanelsForSpeech();
+        } else {
+            this.lastSpokenText += ' ' + text;
+        }
+
+        this.enqueueAudio(text, audioHandle ? `/api/tts/audio/${audioHandle}` : null);
+    }
+
+    /**
+     * Queue a sentence whose audio is already synthesized (or being synthesized)
+     * @param {string} text - The sentence.
+     * @param {?string} audioUrl - URL of its audio, or null to synthesize the text on demand.
+     */
+    enqueueAudio(text, audioUrl) {
+        this.audioQueue.push({
+            text: text.trim(),
+            voice: this.currentVoice,
+            audioUrl: audioUrl,
+            prefetched: true
+        });
+        console.log(`[SpeechManager] Queued synthesized sentence: "${text.substring(0, 30)}..."`);
+
+        // A clip that is still loading hasn't set isPlaying yet, but has already unpaused the element
+        const elementIdle = !this.audioElement || this.audioElement.paused || this.audioElement.ended;
+        if (!this.isPlaying && !this.isMuted && elementIdle) {
+            this.playNext();
+        }
+    }
+
+    /**
+     * Synthesize a block of text with one batched request and queue each
+     * sentence as soon as it and the ones before it are ready
+     * @param {string} text - The text to speak.
+     * @returns {Promise<number>} Number of sentences received.
+     */
+    async speakBatch(text) {
+        const response = await fetch('/api/text-to-speech-orpheus/batch', {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify({ text: text, voice: this.currentVoice })
+        });
+        if (!response.ok) {
+            const errorText = await response.text();
+            throw new Error(`Batch TTS request failed with status ${response.status}: ${errorText}`);
+        }
+
+        return ApiUtils.readTtsBatch(response, (header, audio) => {
+            if (!audio) {
+                console.error(`[SpeechManager] Sentence ${header.index} failed: ${header.error}`);
+                return;
+            }
+            this.enqueueAudio(header.text, URL.createObjectURL(audio));
+        });
+    }
+
+    /**
+     * Fetch synthesized audio and base64-encode it for the avatar
+     * @param {string} audioUrl - URL of the clip.
+     * @returns {Promise<object>} {success, audio} like the base64 TTS endpoints.
+     */
+    async fetchPrefetchedAudio(audioUrl) {
+        const response = await fetch(audioUrl);
+        if (!response.ok) {
+            const errorText = await response.text();
+            throw new Error(`Prefetched audio request failed with status ${response.status}: ${errorText}`);
+        }
+        const bytes = new Uint8Array(await response.arrayBuffer());
+        let binary = '';
+        for (let i = 0; i < bytes.length; i += 0x8000) {
+            binary += String.fromCharCode.apply(null, bytes.subarray(i, i + 0x8000));
+        }
+        return { success: true, audio: btoa(binary), emotion: response.headers.get('X-Speech-Emotion') };
+    }
+
+    /**
+     * Start rewriting the next queued sentence so it is ready when its turn comes
+     */
+    prepareAhead() {
+        const upcoming = this.audioQueue[0];
+        if (upcoming && !upcoming.prefetched && !upcoming.preparing) {
+            upcoming.preparing = this.prepareAvatarSpeech(upcoming.text);
+        }
+    }
+
     /**
      * Plays the next audio item from the queue. Handles API calls,
      * avatar integration (if available), and standard audio playback.
@@ -398,7 +496,13 @@ class SpeechManager {
         this.isPlaying = true;
         const nextItem = this.audioQueue.shift();
         console.log(`[SpeechManager] playNext: Processing next item: "${nextItem.text.substring(0, 30)}..." (Voice: ${nextItem.voice})`);        //prepare the out for avatar speech
-        const humanSpeech = await this.prepareAvatarSpeech(nextItem.text);
+        // Rewrite the following sentence while this one loads and plays
+        this.prepareAhead();
+
+        // Prefetched audio was already rewritten on the server (its emotion comes with the audio)
+        const humanSpeech = nextItem.prefetched
+            ? { text: nextItem.text, emotion: 'neutral' }
+            : await (nextItem.preparing || this.prepareAvatarSpeech(nextItem.text));
 
         console.log(`[SpeechManager] Summary: ${humanSpeech.text}, Emotion: ${humanSpeech.emotion}`);
 
@@ -407,21 +511,39 @@ class SpeechManager {
         if (this.placeholderText) this.placeholderText.textContent = 'Loading audio...';
 
 
+        // Without the avatar, play the audio as it streams in instead of waiting for the whole clip
+        const avatarAvailable = this.avatarManager && this.avatarManager.eventTarget &&
+            typeof this.avatarManager.speakWithAvatar === 'function';
+        if (!avatarAvailable) {
+            if (nextItem.audioUrl) {
+                this.playAudioSource(nextItem.audioUrl);
+            } else {
+                this.playStreamingAudio(humanSpeech.text, nextItem.voice);
+            }
+            return;
+        }
+
         try {
-            console.log('[SpeechManager] Requesting TTS from API...');
-            const response = await fetch('/api/text-to-speech-orpheus', {
-                method: 'POST',
-                headers: { 'Content-Type': 'application/json' },
-                body: JSON.stringify({ text: humanSpeech.text, voice: nextItem.voice })
-            });
+            let data;
+            if (nextItem.audioUrl) {
+                console.log('[SpeechManager] Fetching prefetched audio...');
+                data = await this.fetchPrefetchedAudio(nextItem.audioUrl);
+            } else {
+                console.log('[SpeechManager] Requesting TTS from API...');
+                const response = await fetch('/api/text-to-speech-orpheus', {
+                    method: 'POST',
+                    headers: { 'Content-Type': 'application/json' },
+                    body: JSON.stringify({ text: humanSpeech.text, voice: nextItem.voice })
+                });
 
-            // Check for network/server errors (e.g., 4xx, 5xx)
-            if (!response.ok) {
-                const errorText = await response.text();
-                throw new Error(`API request failed with status ${response.status}: ${errorText}`);
-            }
+                // Check for network/server errors (e.g., 4xx, 5xx)
+                if (!response.ok) {
+                    const errorText = await response.text();
+                    throw new Error(`API request failed with status ${response.status}: ${errorText}`);
+                }
 
-            const data = await response.json();
+                data = await response.json();
+            }
             console.log('[SpeechManager] API response received:', data.success ? 'Success' : 'Failed');
 
             if (data.success && data.audio) {
@@ -434,7 +556,7 @@ class SpeechManager {
                         console.log('[SpeechManager] Attempting speech with Avatar...');
                         // Assume speakWithAvatar starts the process and returns quickly (e.g., true if attempted).
                         // We rely on 'avatar-speech-started' and 'avatar-speech-ended'/'error' events now.
-                        const attemptStarted = await this.avatarManager.speakWithAvatar(humanSpeech.text, data.audio, humanSpeech.emotion);
+                        const attemptStarted = await this.avatarManager.speakWithAvatar(humanSpeech.text, data.audio, data.emotion || humanSpeech.emotion);
 
                         if (attemptStarted) {
                             console.log('[SpeechManager] Avatar speech initiated. Waiting for avatar events.');
@@ -496,6 +618,36 @@ class SpeechManager {
         }
     }
 
+    /**
+     * Play a clip from the streaming TTS endpoint through the audio element
+     * @param {string} text Text to speak
+     * @param {string} voice Voice to use
+     */
+    playStreamingAudio(text, voice) {
+        const params = new URLSearchParams({ text, voice });
+        console.log('[SpeechManager] Using streaming AudioElement playback.');
+        this.playAudioSource(`/api/text-to-speech-orpheus/stream?${params}`);
+    }
+
+    /**
+     * Play an audio URL through the audio element
+     * @param {string} src Audio URL
+     */
+    playAudioSource(src) {
+        this.isPlaying = false; // The 'play' event listener sets this once audio starts
+        this.audioElement.src = src;
+        const playPromise = this.audioElement.play();
+
+        if (playPromise !== undefined) {
+            playPromise.catch(error => {
+                console.error('[SpeechManager] Error playing streamed audio:', error);
+                this.isPlaying = false;
+                this.updateVisualization(false);
+                setTimeout(() => this.playNext(), 100); // Try next after delay
+            });
+        }
+    }
+
     /**
      * Helper function to break text into sentences.
      * This is a basic implementation and might not cover all edge cases.
@@ -588,8 +740,11 @@ class SpeechManager {
                 // Don't call toggleMute() as it saves state and has side effects
             }
 
-            // Use speakText to queue and potentially start the replay
-            this.speakText(this.lastSpokenText);
+            // Synthesize all sentences in one batched request, falling back to one request per sentence
+            this.speakBatch(this.lastSpokenText).catch(error => {
+                console.error('[SpeechManager] Batched replay failed, speaking sentence by sentence:', error);
+                this.speakText(this.lastSpokenText);
+            });
 
             // After speakText has finished queuing
             if (wasMuted) {
@@ -695,51 +850,25 @@ class SpeechManager {
      */
     async prepareAvatarSpeech(text) {
         try {
-            console.log('[SpeechManager] Using OpenAIService to extract emotion and summary');
-
-            const prompt = `
-Analyze the following text and provide:
-1. Change the provided text to the way a human would say it.
-2. You can use the following emotion tags where appropriate <laugh>, <sigh>, <chuckle>, <cough>, <sniffle>, <groan>, <yawn>, <gasp>
-3. Choose primary emotion that best represents the tone (One of: happy, sad, angry, fear, disgust, love, neutral)
-4. No markdown or code blocks.
-
-Return your response in JSON format with properties "emotion" and "summary" only:
-{"emotion": "emotion_here", "summary": "<sigh>speech<laugh>"}
-
-Text to analyze:
-"${text}"
-`;
-
-            const data = {
-                "prompt": prompt,
-                "model": "gpt-4o-mini",
-                "temperature": 0.7,
-                "max_tokens": 100
-            }
-
-
-            const response = await fetch('/openai/completions', {
+            // The server caches rewrites and shares in-flight ones between identical requests
+            const response = await fetch('/api/speech/prepare', {
                 method: 'POST',
                 headers: { 'Content-Type': 'application/json' },
-                body: JSON.stringify(data)
+                body: JSON.stringify({ text: text })
             });
             const result = await response.json();
 
-            console.log('[SpeechManager] OpenAI response:', result);
-            if (result.error) {
-                console.error('[SpeechManager] OpenAI API error:', result.error);
+            if (!response.ok || result.error) {
+                console.error('[SpeechManager] Speech rewrite error:', result.error);
                 return {
                     text: text,
                     emotion: "neutral",
                 };
             }
-            // Parse the completion field which contains a JSON string
-            const { emotion, summary } = JSON.parse(result.response);
-            console.log('[SpeechManager] Emotion and summary extracted:', emotion, summary);
+            console.log(`[SpeechManager] Emotion and summary extracted (cached: ${result.cached}):`, result.emotion, result.text);
             return {
-                text: summary,
-                emotion: emotion || "neutral", // Default to neutral if no emotion found
+                text: result.text,
+                emotion: result.emotion || "neutral", // Default to neutral if no emotion found
             };
 
         } catch (error) {
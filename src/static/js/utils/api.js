@@ -3,6 +3,55 @@
  */
 
 class ApiUtils {
+    /**
+     * Get the id of this tab's conversation session, creating one if needed
+     * @returns {string} Session ID sent to the server with every request
+     */
+    static getSessionId() {
+        let sessionId = sessionStorage.getItem('oi-session-id');
+        if (!sessionId) {
+            sessionId = (window.crypto && crypto.randomUUID)
+                ? crypto.randomUUID()
+                : Date.now().toString(36) + Math.random().toString(36).slice(2);
+            sessionStorage.setItem('oi-session-id', sessionId);
+        }
+        return sessionId;
+    }
+    
+    /**
+     * Switch this tab to another conversation session
+     * The server reloads the conversation from its store when the session is next used
+     * @param {string} sessionId Session (conversation) ID to use from now on
+     */
+    static setSessionId(sessionId) {
+        sessionStorage.setItem('oi-session-id', sessionId);
+    }
+    
+    /**
+     * Get the id of this browser, creating one if needed
+     * Saved conversations belong to it: only this browser can list and load them
+     * @returns {string} Client ID sent to the server with every request
+     */
+    static getClientId() {
+        let clientId = localStorage.getItem('oi-client-id');
+        if (!clientId) {
+            clientId = (window.crypto && crypto.randomUUID)
+                ? crypto.randomUUID()
+                : Date.now().toString(36) + Math.random().toString(36).slice(2);
+            localStorage.setItem('oi-client-id', clientId);
+        }
+        return clientId;
+    }
+    
+    /**
+     * Build request headers that identify this tab's session
+     * @param {Object} headers Additional headers to include
+     * @returns {Object} Headers object with the session and client IDs added
+     */
+    static sessionHeaders(headers = {}) {
+        return { ...headers, 'X-Session-ID': ApiUtils.getSessionId(), 'X-Client-ID': ApiUtils.getClientId() };
+    }
+    
     /**
      * Fetch available models from local API
      * @param {string} apiBase Base URL of the API
@@ -30,7 +79,9 @@ class ApiUtils {
      */
     static async fetchHistory() {
         try {
-            const response = await fetch('/history');
+            const response = await fetch('/history', {
+                headers: ApiUtils.sessionHeaders()
+            });
             const data = await response.json();
             return data || [];
         } catch (error) {
@@ -39,6 +90,69 @@ class ApiUtils {
         }
     }
     
+    /**
+     * Fetch one page of this tab's chat history
+     * Unchanged pages are revalidated with their ETag and come back as 304s from the browser cache
+     * @param {Object} options {since: first index, limit: page size, fields: array of fields, preview: max content chars}
+     * @returns {Promise<Object>} Promise that resolves to {messages (each with its index), start, total, next}
+     */
+    static async fetchHistoryPage({ since = 0, limit = 100, fields = null, preview = null } = {}) {
+        const params = new URLSearchParams({ since: String(since), limit: String(limit) });
+        if (fields) params.set('fields', fields.join(','));
+        if (preview !== null) params.set('preview', String(preview));
+        const response = await fetch(`/history?${params}`, {
+            headers: ApiUtils.sessionHeaders()
+        });
+        if (!response.ok) {
+            throw new Error(`Failed to load history: ${response.status}`);
+        }
+        return await response.json();
+    }
+    
+    /**
+     * URL of an image or large payload that a message refers to
+     * Blobs never change, so the browser caches them for good
+     * @param {string} blobId The message's blob id
+     * @returns {string} URL of the blob
+     */
+    static blobUrl(blobId) {
+        return `/blobs/${encodeURIComponent(blobId)}`;
+    }
+    
+    /**
+     * Fetch summaries of the stored conversations, most recently updated first
+     * @returns {Promise<Array>} Promise that resolves to [{id, title, created_at, updated_at, message_count}]
+     */
+    static async fetchConversations() {
+        try {
+            const response = await fetch('/conversations', {
+                headers: ApiUtils.sessionHeaders()
+            });
+            if (!response.ok) {
+                throw new Error(`Server returned status ${response.status}`);
+            }
+            return await response.json();
+        } catch (error) {
+            console.error("Error loading conversations:", error);
+            return [];
+        }
+    }
+    
+    /**
+     * Fetch a stored conversation with its messages
+     * @param {string} conversationId ID of the conversation
+     * @returns {Promise<Object>} Promise that resolves to {id, title, ..., messages, session_id}
+     */
+    static async fetchConversation(conversationId) {
+        const response = await fetch(`/history/${encodeURIComponent(conversationId)}`, {
+            headers: ApiUtils.sessionHeaders()
+        });
+        if (!response.ok) {
+            throw new Error(`Failed to load conversation: ${response.status}`);
+        }
+        return await response.json();
+    }
+    
     /**
      * Reset the chat conversation
      * @returns {Promise} Promise that resolves when reset is complete
@@ -46,7 +160,8 @@ class ApiUtils {
     static async resetChat() {
         try {
             await fetch('/reset', {
-                method: 'POST'
+                method: 'POST',
+                headers: ApiUtils.sessionHeaders()
             });
             return true;
         } catch (error) {
@@ -64,9 +179,9 @@ class ApiUtils {
         try {
             const response = await fetch('/reset_from_index', {
                 method: 'POST',
-                headers: {
+                headers: ApiUtils.sessionHeaders({
                     'Content-Type': 'application/json'
-                },
+                }),
                 body: JSON.stringify({ message_index: messageIndex })
             });
             
@@ -76,18 +191,74 @@ class ApiUtils {
             throw error;
         }
     }
+    /**
+     * List the alternative branches at a message index
+     * @param {number} messageIndex Index of the message
+     * @returns {Promise<Array>} Branches as {id, role, type, preview, active}
+     */
+    static async fetchBranches(messageIndex) {
+        const response = await fetch(`/branches?index=${messageIndex}`, {
+            headers: ApiUtils.sessionHeaders()
+        });
+        if (!response.ok) {
+            throw new Error('Failed to load branches');
+        }
+        return (await response.json()).branches;
+    }
+    
+    /**
+     * Switch the conversation to another branch, without asking the model again
+     * @param {number} nodeId Id of a message on the branch
+     * @returns {Promise} Promise that resolves to response data
+     */
+    static async switchBranch(nodeId) {
+        const response = await fetch('/branches/switch', {
+            method: 'POST',
+            headers: ApiUtils.sessionHeaders({
+                'Content-Type': 'application/json'
+            }),
+            body: JSON.stringify({ node_id: nodeId })
+        });
+        if (!response.ok) {
+            throw new Error('Failed to switch branch');
+        }
+        return await response.json();
+    }
+    
+    /**
+     * Delete a message shown in the chat and everything after it
+     * @param {number} turn Number of user messages shown before the message
+     * @param {string} role Role of the message ('user' drops its whole turn)
+     * @returns {Promise} Promise that resolves to true if the server accepted it
+     */
+    static async deleteFromTurn(turn, role) {
+        try {
+            const response = await fetch('/reset_to_message', {
+                method: 'POST',
+                headers: ApiUtils.sessionHeaders({
+                    'Content-Type': 'application/json'
+                }),
+                body: JSON.stringify({ turn, role })
+            });
+            return response.ok;
+        } catch (error) {
+            console.error("Error deleting messages:", error);
+            return false;
+        }
+    }
+    
       /**
      * Reset chat to specified messages
-     * @param {Array} messages Array of message objects
+     * @param {Array} messages Array of message objects, each with its role, type and content
      * @returns {Promise} Promise that resolves when reset is complete
      */
     static async resetToMessages(messages) {
         try {
             await fetch('/reset_to_message', {
                 method: 'POST',
-                headers: {
+                headers: ApiUtils.sessionHeaders({
                     'Content-Type': 'application/json'
-                },
+                }),
                 body: JSON.stringify({ messages })
             });
             return true;
@@ -104,8 +275,9 @@ class ApiUtils {
      */
     static async deleteConversation(conversationId) {
         try {
-            await fetch(`/history/${conversationId}`, {
-                method: 'DELETE'
+            await fetch(`/history/${encodeURIComponent(conversationId)}`, {
+                method: 'DELETE',
+                headers: ApiUtils.sessionHeaders()
             });
             return true;
         } catch (error) {
@@ -123,9 +295,9 @@ class ApiUtils {
         try {
             const response = await fetch('/settings', {
                 method: 'POST',
-                headers: {
+                headers: ApiUtils.sessionHeaders({
                     'Content-Type': 'application/json'
-                },
+                }),
                 body: JSON.stringify(settings)
             });
             
@@ -139,6 +311,47 @@ class ApiUtils {
             throw error;
         }
     }
+    
+    /**
+     * Read a batched TTS response, handing over each sentence's clip in order as it arrives
+     * Frames are [4-byte header length][header JSON][4-byte audio length][audio], big-endian
+     * @param {Response} response Response from a /batch text-to-speech endpoint
+     * @param {Function} onClip Called with (header, audio Blob, or null if the sentence failed)
+     * @returns {Promise<number>} Number of frames read
+     */
+    static async readTtsBatch(response, onClip) {
+        const reader = response.body.getReader();
+        const decoder = new TextDecoder();
+        let buffer = new Uint8Array(0);
+        let frames = 0;
+        const readLength = offset => new DataView(buffer.buffer, buffer.byteOffset + offset, 4).getUint32(0);
+        
+        while (true) {
+            // Hand over every complete frame in the buffer
+            while (buffer.length >= 4) {
+                const headerLength = readLength(0);
+                if (buffer.length < 8 + headerLength) break;
+                const frameLength = 8 + headerLength + readLength(4 + headerLength);
+                if (buffer.length < frameLength) break;
+                
+                const header = JSON.parse(decoder.decode(buffer.subarray(4, 4 + headerLength)));
+                const audio = header.error
+                    ? null
+                    : new Blob([buffer.slice(8 + headerLength, frameLength)], { type: header.media_type });
+                buffer = buffer.slice(frameLength);
+                frames++;
+                onClip(header, audio);
+            }
+            
+            const { done, value } = await reader.read();
+            if (done) break;
+            const next = new Uint8Array(buffer.length + value.length);
+            next.set(buffer);
+            next.set(value, buffer.length);
+            buffer = next;
+        }
+        return frames;
+    }
 }
 
 export default ApiUtils;
@@ -0,0 +1,92 @@
+"""
+Micro-benchmark for chunk normalization
+
+Compares the old parse_interpreter_chunk + process_chunk_for_ui + json.dumps
+path with the fused ChunkTranslator + StreamChunk.to_json path on a synthetic
+stream shaped like a typical reply (message deltas, a code block, console
+output and active line markers).
+
+Run from the src directory:
+    python tests/bench_chunk_pipeline.py
+"""
+import contextlib
+import io
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.helpers import parse_interpreter_chunk
+from utils.message_handler import process_chunk_for_ui
+from utils.chunk_pipeline import ChunkTranslator
+
+
+def synthetic_stream():
+    """One reply's worth of raw interpreter chunks"""
+    chunks = [{"role": "assistant", "type": "message", "start": True}]
+    chunks += [{"role": "assistant", "type": "message", "content": f"word{i} "} for i in range(400)]
+    chunks.append({"role": "assistant", "type": "message", "end": True})
+    chunks.append({"role": "assistant", "type": "code", "format": "python", "start": True})
+    chunks += [{"role": "assistant", "type": "code", "format": "python", "content": "print(i)\n"} for _ in range(100)]
+    chunks.append({"role": "assistant", "type": "code", "format": "python", "end": True})
+    chunks.append({"role": "computer", "type": "console", "start": True})
+    for i in range(100):
+        chunks.append({"role": "computer", "type": "console", "format": "active_line", "content": str(i)})
+        chunks.append({"role": "computer", "type": "console", "format": "output", "content": f"{i}\n"})
+    chunks.append({"role": "computer", "type": "console", "end": True})
+    chunks.append({"role": "assistant", "type": "message", "start": True})
+    chunks += [{"role": "assistant", "type": "message", "content": f"done{i} "} for i in range(200)]
+    chunks.append({"role": "assistant", "type": "message", "end": True})
+    return chunks
+
+
+def old_pipeline(chunks):
+    """The previous per-chunk path from process_chat()"""
+    for chunk in chunks:
+        processed_chunk = parse_interpreter_chunk(chunk)
+        if processed_chunk['type'] in ['code', 'console', 'output']:
+            processed_chunk['skip_chat'] = True
+        enhanced_chunk = process_chunk_for_ui(processed_chunk)
+        if enhanced_chunk['type'] == 'code' and enhanced_chunk.get('is_new_block'):
+            enhanced_chunk['new_ui_element'] = True
+        if enhanced_chunk['type'] == 'code' and enhanced_chunk.get('is_end'):
+            enhanced_chunk['code_block_completed'] = True
+        json.dumps(enhanced_chunk)
+
+
+def new_pipeline(chunks):
+    """The fused translator path"""
+    translator = ChunkTranslator()
+    for chunk in chunks:
+        for item in translator.translate(chunk):
+            item.to_json()
+
+
+def measure(func, chunks, rounds=200):
+    """Best-of-three chunks/sec for func over the stream"""
+    best = None
+    for _ in range(3):
+        start = time.perf_counter()
+        for _ in range(rounds):
+            func(chunks)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return len(chunks) * rounds / best
+
+
+def main():
+    chunks = synthetic_stream()
+    # Silence the debug prints for unknown chunk shapes
+    with contextlib.redirect_stderr(io.StringIO()):
+        before = measure(old_pipeline, chunks)
+        after = measure(new_pipeline, chunks)
+    print(f"Chunks per reply: {len(chunks)}")
+    print(f"Before (parse + process_chunk_for_ui + json.dumps): {before:,.0f} chunks/sec")
+    print(f"After (ChunkTranslator + to_json):                  {after:,.0f} chunks/sec")
+    print(f"Speedup: {after / before:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
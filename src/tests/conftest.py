@@ -0,0 +1,10 @@
+"""
+Shared setup for the unit tests
+
+Run from the src directory:
+    python -m pytest tests
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
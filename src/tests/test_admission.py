@@ -0,0 +1,83 @@
+"""Tests for admission control and priority scheduling"""
+import threading
+import time
+
+import pytest
+
+from utils.admission import AdmissionController, AdmissionRejected, CodeExecutionGate
+
+
+def wait_until(condition, timeout=1.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.005)
+
+
+def test_full_queue_is_rejected_with_retry_after():
+    controller = AdmissionController()
+    controller.configure('tts', limit=1, max_queue=0)
+    slot = controller.acquire('tts')
+    with pytest.raises(AdmissionRejected) as rejected:
+        controller.acquire('tts')
+    assert rejected.value.status_code == 429 and rejected.value.retry_after >= 1
+    slot.release()
+    slot.release()
+    controller.acquire('tts').release()
+    assert controller.stats['classes']['tts']['rejected'] == 1
+
+
+def test_wait_times_out():
+    controller = AdmissionController()
+    controller.configure('aux', limit=1, max_wait=0.05)
+    with controller.acquire('aux'):
+        with pytest.raises(AdmissionRejected):
+            controller.acquire('aux')
+    assert controller.stats['classes']['aux']['timed_out'] == 1
+
+
+def test_shared_pool_admits_the_best_priority_first():
+    controller = AdmissionController(max_active=1)
+    controller.configure('chat', limit=4, priority=0)
+    controller.configure('tts', limit=4, priority=2)
+    order = []
+
+    def run(name):
+        with controller.acquire(name):
+            order.append(name)
+
+    slot = controller.acquire('tts')
+    threads = [threading.Thread(target=run, args=(name,), daemon=True) for name in ('tts', 'chat')]
+    threads[0].start()
+    wait_until(lambda: controller.stats['classes']['tts']['waiting'] == 1)
+    threads[1].start()
+    wait_until(lambda: controller.stats['classes']['chat']['waiting'] == 1)
+    slot.release()
+    for thread in threads:
+        thread.join(1)
+    assert order == ['chat', 'tts']
+
+
+def test_nested_class_skips_the_shared_pool():
+    controller = AdmissionController(max_active=1)
+    controller.configure('chat', limit=1)
+    controller.configure('code', limit=1, max_wait=0, shared=False)
+    with controller.acquire('chat'):
+        with controller.acquire('code'):
+            assert controller.stats['shared_active'] == 1
+
+
+def test_code_gate_holds_a_slot_while_a_block_runs():
+    controller = AdmissionController()
+    controller.configure('code', limit=1, shared=False)
+    gate = CodeExecutionGate(controller)
+
+    def active():
+        return controller.stats['classes']['code']['active']
+
+    gate.observe({"role": "assistant", "type": "code", "content": "x"})
+    assert active() == 0
+    gate.observe({"role": "assistant", "type": "code", "end": True})
+    assert active() == 1
+    gate.observe({"role": "computer", "type": "console", "end": True})
+    assert active() == 0
@@ -0,0 +1,85 @@
+"""Tests for the content-addressed blob store"""
+import base64
+
+from utils.blob_store import BlobStore, blob_media_type
+
+PNG = b'\x89PNG\r\n\x1a\n' + bytes(range(256)) * 8
+
+
+def image_message():
+    return {"role": "computer", "type": "image", "format": "base64.png",
+            "content": base64.b64encode(PNG).decode('ascii')}
+
+
+def console_message(size):
+    return {"role": "computer", "type": "console", "format": "output", "content": "x" * size}
+
+
+def test_externalize_and_resolve_round_trip(tmp_path):
+    store = BlobStore(str(tmp_path), threshold=100)
+    messages = [
+        {"role": "user", "type": "message", "content": "y" * 500},
+        image_message(),
+        console_message(1000),
+        console_message(10),
+    ]
+    originals = [dict(message) for message in messages]
+
+    assert store.externalize(messages) == 2
+    assert messages[0] == originals[0] and messages[3] == originals[3]
+    assert messages[1]['content'] is None and messages[1]['blob_size'] == len(PNG)
+    assert messages[2]['content'] is None and messages[2]['blob_size'] == 1000
+
+    resolved = store.resolve(messages)
+    assert resolved == originals
+    # Messages without references are passed through, and the stored ones are left alone
+    assert resolved[0] is messages[0]
+    assert messages[1]['content'] is None
+
+
+def test_resolve_without_references_returns_the_same_list(tmp_path):
+    store = BlobStore(str(tmp_path))
+    messages = [console_message(10)]
+    assert store.resolve(messages) is messages
+
+
+def test_identical_payloads_are_stored_once(tmp_path):
+    store = BlobStore(str(tmp_path))
+    first, second = image_message(), image_message()
+    store.externalize([first, second])
+    assert first['blob'] == second['blob']
+    assert store.stats['stored'] == 1 and store.stats['deduplicated'] == 1
+
+
+def test_disk_tier_survives_a_new_store(tmp_path):
+    messages = [image_message()]
+    BlobStore(str(tmp_path)).externalize(messages)
+
+    store = BlobStore(str(tmp_path), memory_bytes=0)
+    assert store.get(messages[0]['blob']) == PNG
+    assert store.stats['disk_hits'] == 1 and store.stats['memory_entries'] == 0
+
+
+def test_missing_blobs(tmp_path):
+    store = BlobStore(str(tmp_path))
+    text = {"role": "computer", "type": "console", "format": "output", "content": None,
+            "blob": "0" * 64, "blob_size": 5}
+    image = dict(text, type="image", format="base64.png")
+    resolved = store.resolve([text, image])
+    # Missing text gets a placeholder, a missing image is left out of the request
+    assert len(resolved) == 1 and resolved[0]['content']
+
+
+def test_disabled_store_changes_nothing(tmp_path):
+    store = BlobStore(str(tmp_path / 'blobs'), threshold=0)
+    messages = [image_message()]
+    assert store.externalize(messages) == 0
+    assert messages[0]['content']
+
+
+def test_media_types():
+    assert blob_media_type(PNG) == 'image/png'
+    assert blob_media_type(b'\xff\xd8\xff\xe0') == 'image/jpeg'
+    assert blob_media_type(b'RIFF\0\0\0\0WEBPVP8 ') == 'image/webp'
+    assert blob_media_type(b'RIFF\0\0\0\0WAVEfmt ') == 'text/plain; charset=utf-8'
+    assert blob_media_type(b'<svg onload=alert(1)>') == 'text/plain; charset=utf-8'
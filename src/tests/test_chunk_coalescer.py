@@ -0,0 +1,70 @@
+"""Tests for the adaptive chunk coalescer"""
+from utils.chunk_coalescer import ChunkCoalescer, merge_key
+
+
+def message(text, **flags):
+    return dict({"role": "assistant", "type": "message", "content": text}, **flags)
+
+
+def code(text, **flags):
+    return dict({"role": "assistant", "type": "code", "format": "python", "content": text}, **flags)
+
+
+def feed(coalescer, chunks):
+    ready = []
+    for event_id, chunk in enumerate(chunks, 1):
+        ready += coalescer.add(chunk, event_id)
+    return ready + coalescer.flush()
+
+
+def test_first_chunk_is_sent_immediately_and_the_burst_is_merged():
+    coalescer = ChunkCoalescer(window_ms=10000)
+    assert coalescer.add(message("a"), 1) == [(1, message("a"))]
+    assert coalescer.add(message("b"), 2) == []
+    assert coalescer.add(message("c"), 3) == []
+    # The merged chunk carries the id of the last chunk folded into it
+    assert coalescer.flush() == [(3, message("bc"))]
+    assert coalescer.stats == {'chunks_in': 3, 'frames_out': 2}
+
+
+def test_content_and_order_are_preserved():
+    chunks = [message("a"), message("b"), code("x = 1", is_new_block=True), code("\n"),
+              message("c", new_message_after_code=True), message("d"), "raw string", message("e")]
+    ready = feed(ChunkCoalescer(window_ms=10000), chunks)
+    assert [event_id for event_id, _ in ready] == sorted(event_id for event_id, _ in ready)
+    assert ready[-1][0] == len(chunks)
+    text = ''.join(chunk['content'] for _, chunk in ready if hasattr(chunk, 'get'))
+    assert text == ''.join(chunk['content'] for chunk in chunks if hasattr(chunk, 'get'))
+
+
+def test_boundaries_and_different_chunks_are_not_merged():
+    ready = feed(ChunkCoalescer(window_ms=10000), [message("a"), message("b"), code("x"), code("y", is_new_block=True)])
+    assert [chunk['content'] for _, chunk in ready] == ["a", "b", "x", "y"]
+
+
+def test_end_of_block_flushes_the_batch():
+    coalescer = ChunkCoalescer(window_ms=10000)
+    coalescer.add(code("a"), 1)
+    coalescer.add(code("b"), 2)
+    ready = coalescer.add(code("c", is_end=True, code_block_completed=True), 3)
+    assert ready == [(3, code("bc", is_end=True, code_block_completed=True))]
+
+
+def test_byte_budget_flushes_the_batch():
+    coalescer = ChunkCoalescer(window_ms=10000, max_bytes=4)
+    coalescer.add(message("a"), 1)
+    assert coalescer.add(message("bc"), 2) == []
+    assert coalescer.add(message("de"), 3) == [(3, message("bcde"))]
+
+
+def test_zero_window_disables_batching():
+    chunks = [message(text) for text in "abc"]
+    assert feed(ChunkCoalescer(window_ms=0), chunks) == list(enumerate(chunks, 1))
+
+
+def test_merge_key():
+    assert merge_key("text") is None
+    assert merge_key({"type": "image", "content": "..."}) is None
+    assert merge_key(code("1", format="active_line")) is None
+    assert merge_key(message("a")) == merge_key(message("b"))
+    assert merge_key(message("a")) != merge_key(message("a", thinking=True))
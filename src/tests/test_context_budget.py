@@ -0,0 +1,166 @@
+"""Tests for the token ledger and the context policy"""
+import pytest
+
+pytest.importorskip('requests')
+
+from utils.context_budget import ContextManager, ContextPolicy, TokenLedger, message_tokens  # noqa: E402
+
+
+def user(text):
+    return {"role": "user", "type": "message", "content": text}
+
+
+def reply(text):
+    return {"role": "assistant", "type": "message", "content": text}
+
+
+def output(text):
+    return {"role": "computer", "type": "console", "format": "output", "content": text}
+
+
+def conversation(turns, output_size=400):
+    messages = [{"role": "system", "type": "message", "content": "system prompt"}]
+    for turn in range(turns):
+        messages += [user(f"question {turn}"), reply(f"answer {turn}"), output("o" * output_size)]
+    return messages
+
+
+def total(messages):
+    return sum(message_tokens(message) for message in messages)
+
+
+class FakeClient:
+    """Chat completions client that answers every request with the same summary"""
+
+    def __init__(self):
+        self.calls = 0
+        self.chat = self
+        self.completions = self
+
+    def create(self, **kwargs):
+        self.calls += 1
+        message = type('Message', (), {'content': 'the summary'})()
+        choice = type('Choice', (), {'message': message})()
+        return type('Response', (), {'choices': [choice]})()
+
+
+def test_ledger_follows_appends_and_truncations():
+    ledger = TokenLedger()
+    messages = conversation(2)
+    assert ledger.sync(messages) == [message_tokens(m) for m in messages]
+    assert ledger.total == total(messages)
+
+    messages.append(user("more"))
+    ledger.sync(messages)
+    assert ledger.total == total(messages)
+    del messages[3:]
+    ledger.sync(messages)
+    assert ledger.total == total(messages) and len(ledger) == 3
+
+
+def test_off_policy_sends_everything():
+    manager = ContextManager(policy='off')
+    messages = conversation(5)
+    assert manager.compact(messages, TokenLedger(), budget=10) is messages
+
+
+def test_messages_that_fit_are_sent_unchanged():
+    manager = ContextManager(elide_tokens=0)
+    messages = conversation(2)
+    assert manager.compact(messages, TokenLedger(), budget=total(messages)) is messages
+
+
+def test_huge_output_is_elided_without_changing_history():
+    manager = ContextManager(elide_tokens=50)
+    messages = conversation(1, output_size=4000)
+    original = messages[-1]['content']
+    out = manager.compact(messages, TokenLedger(), budget=None)
+    assert out is not messages
+    assert 'elided' in out[-1]['content'] and len(out[-1]['content']) < len(original)
+    assert messages[-1]['content'] == original
+
+
+def test_trim_drops_old_output_then_old_turns():
+    manager = ContextManager(policy='trim', elide_tokens=0, keep_turns=1)
+    messages = conversation(6)
+    current = messages[-3:]
+
+    budget = total(messages) - 50
+    out = manager.compact(messages, TokenLedger(), budget)
+    assert total(out) <= budget
+    assert out[-3:] == current
+    assert any('omitted' in m['content'] for m in out if m['role'] == 'computer')
+
+    budget = total(messages[:1] + current) + 40
+    out = manager.compact(messages, TokenLedger(), budget)
+    assert total(out) <= budget
+    assert out[0] == messages[0] and out[-3:] == current
+    assert 'left out' in out[1]['content']
+    assert manager.stats['compacted'] == 2 and manager.stats['tokens_saved'] > 0
+
+
+def test_summarize_replaces_old_turns_and_caches_the_summary():
+    client = FakeClient()
+    manager = ContextManager(policy='summarize', elide_tokens=0, keep_turns=1, get_client=lambda: client)
+    ledger = TokenLedger()
+    messages = conversation(6)
+    budget = total(messages[:1] + messages[-3:]) + 40
+
+    out = manager.compact(messages, ledger, budget)
+    assert 'the summary' in out[1]['content']
+    assert out[-3:] == messages[-3:]
+    manager.compact(messages, ledger, budget)
+    assert client.calls == 1
+
+
+def test_attach_budgets_every_model_request():
+    sent = []
+
+    class Llm:
+        context_window = 200
+        max_tokens = 50
+
+        def run(self, messages):
+            sent.append(messages)
+
+    interpreter = type('Interpreter', (), {})()
+    interpreter.llm = Llm()
+    manager = ContextManager(policy='trim', elide_tokens=0, keep_turns=1)
+    manager.attach(interpreter)
+
+    messages = conversation(10)
+    interpreter.llm.run(messages)
+    assert total(sent[0]) <= 150
+    assert manager.ledger(interpreter).total == total(messages)
+
+
+def test_each_interpreter_has_its_own_policy():
+    sent = []
+
+    class Llm:
+        context_window = 200
+        max_tokens = 50
+
+        def run(self, messages):
+            sent.append(messages)
+
+    manager = ContextManager(policy='trim', elide_tokens=0, keep_turns=1)
+    first, second = type('Interpreter', (), {})(), type('Interpreter', (), {})()
+    for interpreter in (first, second):
+        interpreter.llm = Llm()
+        manager.attach(interpreter)
+
+    manager.policy(first).configure(policy='off')
+    messages = conversation(10)
+    first.llm.run(messages)
+    second.llm.run(messages)
+    assert sent[0] is messages and total(sent[1]) <= 150
+    assert manager.policy(second).policy == 'trim' and manager.defaults.policy == 'trim'
+
+
+def test_configure_rejects_bad_settings():
+    manager = ContextManager()
+    with pytest.raises(ValueError):
+        manager.configure(policy='everything')
+    with pytest.raises(ValueError):
+        ContextPolicy().configure(keep_turns=-1)
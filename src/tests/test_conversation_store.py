@@ -0,0 +1,58 @@
+"""Tests for the SQLite conversation store"""
+import sqlite3
+
+from utils.conversation_store import ConversationStore, owner_key
+
+
+def messages(*contents):
+    return [{"role": "user", "type": "message", "content": content} for content in contents]
+
+
+def test_conversations_are_listed_and_found_only_by_their_owner():
+    store = ConversationStore(':memory:')
+    alice, bob = owner_key('alice'), owner_key('bob')
+    store.save('session-a', messages('hello'), owner=alice)
+    store.save('session-b', messages('hi'), owner=bob)
+
+    listed = store.list(alice)
+    assert [c['title'] for c in listed] == ['hello']
+    public_id = listed[0]['id']
+    # The session id is the credential; it is never listed
+    assert public_id != 'session-a'
+    assert store.find(public_id, alice) == 'session-a'
+    assert store.find(public_id, bob) is None
+
+
+def test_first_owner_is_kept():
+    store = ConversationStore(':memory:')
+    store.save('session-a', messages('hello'), owner=owner_key('alice'))
+    store.save('session-a', messages('hello', 'again'), 1, owner=owner_key('mallory'))
+    assert store.list(owner_key('mallory')) == []
+    assert store.list(owner_key('alice'))[0]['message_count'] == 2
+
+
+def test_save_replaces_messages_from_start():
+    store = ConversationStore(':memory:')
+    store.save('s', messages('a', 'b', 'c'))
+    store.save('s', messages('a', 'x'), 1)
+    assert [m['content'] for m in store.load('s')] == ['a', 'x']
+    store.truncate('s', 1)
+    assert [m['content'] for m in store.load('s')] == ['a']
+
+
+def test_older_database_is_migrated(tmp_path):
+    path = str(tmp_path / 'conversations.db')
+    db = sqlite3.connect(path)
+    db.executescript("""
+        CREATE TABLE conversations (id TEXT PRIMARY KEY, title TEXT, created_at REAL NOT NULL,
+                                    updated_at REAL NOT NULL, message_count INTEGER NOT NULL DEFAULT 0);
+        INSERT INTO conversations VALUES ('old-session', 'old', 1, 1, 1);
+    """)
+    db.close()
+
+    store = ConversationStore(path)
+    # Unowned until its session saves again
+    assert store.list(owner_key('anyone')) == []
+    store.save('old-session', messages('old'), owner=owner_key('owner'))
+    listed = store.list(owner_key('owner'))
+    assert len(listed) == 1 and listed[0]['id']
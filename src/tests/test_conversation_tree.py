@@ -0,0 +1,100 @@
+"""Tests for the copy-on-write conversation tree"""
+from utils.conversation_tree import ConversationTree, turn_start
+
+
+def message(role, content, type='message'):
+    return {"role": role, "type": type, "content": content}
+
+
+def contents(messages):
+    return [m['content'] for m in messages]
+
+
+def conversation():
+    return [message('user', 'q1'), message('assistant', 'a1'),
+            message('assistant', 'print(1)', 'code'), message('computer', '1', 'console'),
+            message('user', 'q2'), message('assistant', 'a2')]
+
+
+def test_fork_truncates_in_place_and_keeps_branch():
+    tree = ConversationTree()
+    messages = conversation()
+    original = messages
+    assert tree.fork(messages, 3) == 4
+    assert messages is original
+    assert contents(messages) == ['q1', 'a1', 'print(1)', '1']
+
+    messages.append(message('user', 'q2b'))
+    tree.sync(messages)
+    assert tree.branch_points(messages) == [{"index": 4, "count": 2, "active": 1}]
+    assert [b['preview'] for b in tree.branches(messages, 4)] == ['q2', 'q2b']
+
+
+def test_fork_before_first_message_keeps_nothing():
+    tree = ConversationTree()
+    messages = conversation()
+    assert tree.fork(messages, -1) == 0
+    assert messages == []
+    assert len(tree.branches(messages, 0)) == 1
+
+
+def test_switch_restores_branch_and_its_last_active_tail():
+    tree = ConversationTree()
+    messages = conversation()
+    tree.fork(messages, 3)
+    messages += [message('user', 'q2b'), message('assistant', 'a2b')]
+    old = [b['id'] for b in tree.branches(messages, 4) if b['preview'] == 'q2'][0]
+
+    assert tree.switch(messages, old) == 4
+    assert contents(messages) == contents(conversation())
+
+    new = [b['id'] for b in tree.branches(messages, 4) if b['preview'] == 'q2b'][0]
+    assert tree.switch(messages, new) == 4
+    assert contents(messages)[4:] == ['q2b', 'a2b']
+
+
+def test_switch_unknown_node_raises():
+    tree = ConversationTree()
+    messages = conversation()
+    try:
+        tree.switch(messages, 999)
+    except KeyError:
+        pass
+    else:
+        raise AssertionError("expected KeyError")
+
+
+def test_replace_shares_common_prefix():
+    tree = ConversationTree()
+    messages = conversation()
+    replacement = [dict(m) for m in messages[:4]] + [message('user', 'other')]
+    assert tree.replace(messages, replacement) == 4
+    assert contents(messages)[4:] == ['other']
+    assert tree.stats['nodes'] == 7
+
+
+def test_replace_with_untyped_messages_shares_nothing():
+    # What the chat UI used to post: role and content only
+    tree = ConversationTree()
+    messages = conversation()
+    dom = [{"role": m['role'], "content": m['content']} for m in messages[:2]]
+    assert tree.replace(messages, dom) == 0
+
+
+def test_rolled_back_messages_are_dropped():
+    tree = ConversationTree()
+    messages = conversation()
+    tree.sync(messages)
+    messages.append(message('user', 'failed'))
+    tree.sync(messages)
+    del messages[-1]
+    tree.sync(messages)
+    assert tree.stats == {"nodes": 6, "active_path": 6}
+    assert tree.branch_points(messages) == []
+
+
+def test_turn_start():
+    messages = conversation()
+    assert turn_start(messages, 0) == 0
+    assert turn_start(messages, 1) == 4
+    assert turn_start(messages, 2) == len(messages)
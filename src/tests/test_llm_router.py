@@ -0,0 +1,100 @@
+"""Tests for routing local-model chats across backends"""
+import threading
+
+import pytest
+
+from utils.llm_router import LlmRouter, parse_api_bases
+
+A, B = 'http://a:1234/v1', 'http://b:1234/v1'
+
+
+class FakeInterpreter:
+    """Interpreter whose chat fails before its first chunk on the given API bases"""
+
+    def __init__(self, api_base, failing=()):
+        self.llm = type('Llm', (), {})()
+        self.llm.api_base = api_base
+        self.messages = [{"role": "user", "type": "message", "content": "earlier"}]
+        self.failing = set(failing)
+        self.calls = []
+
+    def chat(self, prompt, stream=True, display=False):
+        api_base = self.llm.api_base
+        self.calls.append(api_base)
+        self.messages.append({"role": "user", "type": "message", "content": prompt})
+        if api_base in self.failing:
+            raise ConnectionError(f"{api_base} is down")
+        self.messages.append({"role": "assistant", "type": "message", "content": f"reply from {api_base}"})
+        yield {"role": "assistant", "type": "message", "content": f"reply from {api_base}"}
+
+
+def router(*api_bases):
+    # The probe never returns, so only the chats themselves change a backend's health
+    never = threading.Event()
+    return LlmRouter(api_bases, probe=lambda api_base: never.wait(), probe_interval=3600)
+
+
+def test_parse_api_bases():
+    assert parse_api_bases(f"{A}/, {B} {A}") == [A, B]
+    assert parse_api_bases(None) == []
+
+
+def test_failover_before_the_first_token_rolls_back_messages():
+    llm_router = router(A, B)
+    interpreter = FakeInterpreter(A, failing=[A])
+    chunks = list(llm_router.chat(interpreter, "hello"))
+
+    assert interpreter.calls == [A, B]
+    assert chunks == [{"role": "assistant", "type": "message", "content": f"reply from {B}"}]
+    # The failed attempt's prompt is gone, so the conversation has the prompt once
+    assert [m['content'] for m in interpreter.messages] == ["earlier", "hello", f"reply from {B}"]
+    stats = llm_router.stats
+    assert stats['failovers'] == 1
+    assert [backend['healthy'] for backend in stats['backends']] == [False, True]
+    assert all(backend['in_flight'] == 0 for backend in stats['backends'])
+
+
+def test_every_backend_failing_raises():
+    llm_router = router(A, B)
+    interpreter = FakeInterpreter(A, failing=[A, B])
+    with pytest.raises(ConnectionError):
+        list(llm_router.chat(interpreter, "hello"))
+    assert interpreter.calls == [A, B]
+
+
+def test_errors_after_the_first_token_are_not_retried():
+    llm_router = router(A, B)
+    interpreter = FakeInterpreter(A)
+
+    def chat(prompt, stream=True, display=False):
+        interpreter.calls.append(interpreter.llm.api_base)
+        yield {"role": "assistant", "type": "message", "content": "partial"}
+        raise ConnectionError("dropped")
+
+    interpreter.chat = chat
+    chunks = []
+    with pytest.raises(ConnectionError):
+        for chunk in llm_router.chat(interpreter, "hello"):
+            chunks.append(chunk)
+    assert len(chunks) == 1 and len(interpreter.calls) == 1
+
+
+def test_unrouted_api_base_is_passed_through():
+    llm_router = router(A)
+    interpreter = FakeInterpreter('http://elsewhere/v1')
+    list(llm_router.chat(interpreter, "hello"))
+    assert interpreter.calls == ['http://elsewhere/v1']
+
+
+def test_least_loaded_healthy_backend_is_chosen():
+    llm_router = router(A, B)
+    first = llm_router.acquire()
+    second = llm_router.acquire()
+    assert {first.api_base, second.api_base} == {A, B}
+    llm_router.release(first)
+    llm_router.release(second)
+
+    llm_router.record_failure(llm_router.backends[0], ConnectionError("down"))
+    assert llm_router.acquire().api_base == B
+    # An unhealthy backend is still tried once the healthy ones are excluded
+    assert llm_router.acquire(exclude=[llm_router.backends[1]]).api_base == A
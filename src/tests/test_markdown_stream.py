@@ -0,0 +1,73 @@
+"""Tests for incremental server-side markdown rendering"""
+import random
+
+import pytest
+
+pytest.importorskip('markdown')
+
+from utils.markdown_stream import IncrementalMarkdown, MarkdownStream  # noqa: E402
+
+REPLY = (
+    "Here is the plan:\n\n"
+    "- first\n\n"
+    "- second\n"
+    "  continued\n\n"
+    "```python\n"
+    "x = 1\n\n"
+    "y = 2\n"
+    "```\n"
+    "| a | b |\n"
+    "|---|---|\n"
+    "| 1 | 2 |\n\n"
+    "Done."
+)
+
+
+def render(chunks):
+    renderer = IncrementalMarkdown()
+    return ''.join(renderer.feed(chunk) for chunk in chunks) + renderer.flush()
+
+
+def test_a_block_is_rendered_once_it_is_closed():
+    renderer = IncrementalMarkdown()
+    assert renderer.feed("para one\n\n") == ''
+    assert renderer.feed("para two\n") == "<p>para one</p>\n"
+    assert renderer.tail == "para two\n"
+    assert renderer.flush() == "<p>para two</p>\n"
+
+
+def test_blank_lines_inside_fences_and_lists_do_not_split_them():
+    renderer = IncrementalMarkdown()
+    html = renderer.feed(REPLY)
+    assert html.count('<ul>') == 1 and html.count('<li>') == 2
+    assert html.count('<pre>') == 1 and 'y = 2' in html
+    # The table is only closed once a complete line follows the blank one
+    assert renderer.tail.startswith("| a | b |") and '<table>' not in html
+    rest = renderer.flush()
+    assert '<table>' in rest and rest.endswith("<p>Done.</p>\n")
+
+
+def test_output_does_not_depend_on_chunking():
+    whole = render([REPLY])
+    rng = random.Random(0)
+    for _ in range(20):
+        cuts = sorted(rng.sample(range(1, len(REPLY)), 15))
+        assert render([REPLY[a:b] for a, b in zip([0] + cuts, cuts + [len(REPLY)])]) == whole
+
+
+def test_unterminated_fence_is_closed_on_flush():
+    assert '<code' in render(["```python\nprint(1)\n"])
+
+
+def test_stream_ends_messages_at_other_chunks_and_skips_thinking():
+    stream = MarkdownStream()
+    out = stream.process({"type": "thinking_start"})
+    out += stream.process({"type": "message", "content": "hidden\n\n"})
+    out += stream.process({"type": "thinking_end"})
+    out += stream.process({"type": "message", "content": "shown"})
+    out += stream.process({"type": "code", "content": "x"})
+    rendered = [chunk for chunk in out if chunk['type'] == 'markdown']
+    assert len(rendered) == 1
+    assert rendered[0]['content'] == "<p>shown</p>\n" and rendered[0]['tail'] == ''
+    assert out[-1]['type'] == 'code'
+    assert stream.finish() == []
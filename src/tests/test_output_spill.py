@@ -0,0 +1,91 @@
+"""Tests for spilling large code output to disk"""
+import pytest
+
+from utils.output_spill import OutputNotFound, OutputSpillStore, attach_output_handles, without_output_handles
+
+
+def output(text, **flags):
+    return dict({"type": "output", "panel": "output", "content": text}, **flags)
+
+
+def run(spiller, chunks):
+    published = []
+    for chunk in chunks:
+        published += spiller.process(chunk)
+    return published + spiller.finish()
+
+
+def test_small_output_streams_unchanged(tmp_path):
+    spiller = OutputSpillStore(str(tmp_path), threshold=100).spiller('s')
+    chunks = [output("a" * 10), output("b" * 10)]
+    assert run(spiller, chunks) == chunks
+    assert spiller.handles == [None]
+
+
+def test_large_output_is_spilled_and_readable_by_range(tmp_path):
+    store = OutputSpillStore(str(tmp_path), threshold=10, tail_bytes=4)
+    spiller = store.spiller('s')
+    chunks = [output("0123456"), output("789abc"), output("defgh"), output("ijkl", is_end=True)]
+    published = run(spiller, chunks)
+
+    handle = spiller.handles[0]
+    assert handle
+    assert published[0] == chunks[0]
+    assert published[1]['output_handle'] == handle
+    # The end flag still goes out, without its content
+    assert published[2] == output("", is_end=True)
+    summary = published[-1]
+    assert summary['output_size'] == 22 and summary['content'].endswith("ijkl")
+    assert "11 bytes omitted" in summary['content']
+
+    assert store.read(handle, 's') == (b"0123456789abcdefghijkl", 22)
+    assert store.read(handle, 's', 7, 12) == (b"789abc", 22)
+    assert store.read(handle, 's', 30) == (b'', 22)
+
+
+def test_handles_are_private_to_their_session(tmp_path):
+    store = OutputSpillStore(str(tmp_path), threshold=1)
+    spiller = store.spiller('s')
+    run(spiller, [output("spilled output")])
+    with pytest.raises(OutputNotFound):
+        store.read(spiller.handles[0], 'other')
+    store.remove_session('s')
+    with pytest.raises(OutputNotFound):
+        store.size(spiller.handles[0], 's')
+
+
+def test_full_file_truncates_the_output(tmp_path):
+    store = OutputSpillStore(str(tmp_path), threshold=2, max_file_bytes=8)
+    spiller = store.spiller('s')
+    published = run(spiller, [output("abcd"), output("efgh"), output("ijkl")])
+    assert "discarded" in published[-1]['content']
+    assert store.size(spiller.handles[0], 's') == 8
+
+
+def test_history_keeps_only_what_was_streamed(tmp_path):
+    spiller = OutputSpillStore(str(tmp_path), threshold=3, tail_bytes=2).spiller('s')
+    published = run(spiller, [output("ab"), {"type": "message", "content": "next"}, output("abc"), output("defgh")])
+    messages = [{"role": "computer", "type": "console", "format": "output", "content": c} for c in ("ab", "abcdefgh")]
+    attach_output_handles(messages, spiller)
+    assert messages[0] == {"role": "computer", "type": "console", "format": "output", "content": "ab"}
+    assert messages[1]['output_handle'] == spiller.handles[1]
+    # The head, the notices and the tail, as the stream showed them
+    streamed = ''.join(chunk['content'] for chunk in published[2:])
+    assert messages[1]['content'] == streamed
+    assert streamed.startswith("abc") and streamed.endswith("gh") and "defgh" not in streamed
+
+
+def test_stored_messages_drop_their_handles():
+    plain = {"role": "user", "type": "message", "content": "hi"}
+    spilled = {"role": "computer", "type": "console", "format": "output", "content": "...", "output_handle": "0" * 32}
+    messages = [plain, spilled]
+    assert without_output_handles([plain]) == [plain]
+    stored = without_output_handles(messages)
+    assert stored[0] is plain and 'output_handle' not in stored[1]
+    assert messages[1]['output_handle']
+
+
+def test_disabled_store_passes_chunks_through(tmp_path):
+    spiller = OutputSpillStore(str(tmp_path), threshold=0).spiller('s')
+    chunks = [output("x" * 1000)]
+    assert run(spiller, chunks) == chunks
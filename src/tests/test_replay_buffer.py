@@ -0,0 +1,98 @@
+"""Tests for the resumable, bounded replay buffer"""
+import threading
+import time
+
+from utils.replay_buffer import ReplayBuffer, REPLAY_GAP_CHUNK, iter_events
+
+
+def message(text):
+    return {"type": "message", "content": text}
+
+
+def output(text):
+    return {"type": "output", "panel": "output", "content": text}
+
+
+def test_resume_after_last_event_id():
+    buffer = ReplayBuffer('chat')
+    for text in 'abc':
+        buffer.put(message(text))
+    buffer.put(None)
+
+    first = list(iter_events(buffer))
+    assert [event_id for event_id, _ in first] == [1, 2, 3]
+    resumed = list(iter_events(buffer, after_id=2))
+    assert resumed == [(3, message('c'))]
+
+
+def test_resume_past_trimmed_events_reports_gap():
+    buffer = ReplayBuffer('chat', capacity=2)
+    for text in 'abcd':
+        buffer.put(message(text))
+    buffer.put(None)
+    list(iter_events(buffer))
+
+    resumed = list(iter_events(buffer, after_id=0))
+    assert resumed[0] == (None, REPLAY_GAP_CHUNK)
+    assert [chunk['content'] for _, chunk in resumed[1:]] == ['c', 'd']
+
+
+def test_overflowing_output_is_merged_then_dropped_with_a_notice():
+    buffer = ReplayBuffer('chat', max_pending=2, overflow_chunk_bytes=4)
+    buffer.put(message('m'))
+    buffer.put(output('ab'))
+    buffer.put(output('cd'))
+    buffer.put(output('ef'))
+    assert buffer.coalesced_chunks == 1
+    assert buffer.dropped_chunks == 1 and buffer.dropped_bytes == 2
+
+    buffer.put(None)
+    chunks = [chunk for _, chunk in iter_events(buffer)]
+    assert chunks[1]['content'] == 'abcd'
+    assert '2 bytes of output dropped' in chunks[2]['content']
+
+
+def test_full_buffer_blocks_text_until_read():
+    buffer = ReplayBuffer('chat', max_pending=1)
+    buffer.put(message('a'))
+    done = threading.Event()
+
+    def produce():
+        buffer.put(message('b'))
+        done.set()
+
+    threading.Thread(target=produce, daemon=True).start()
+    assert not done.wait(0.1)
+    events = iter_events(buffer)
+    next(events)
+    next(events)  # Marks the first event delivered
+    assert done.wait(1)
+    assert buffer.blocked_seconds > 0
+
+
+def test_cancel_unblocks_a_producer_nobody_reads():
+    buffer = ReplayBuffer('chat', max_pending=1)
+    buffer.put(message('a'))
+    done = threading.Event()
+
+    def produce():
+        buffer.put(message('b'))
+        done.set()
+
+    threading.Thread(target=produce, daemon=True).start()
+    time.sleep(0.05)
+    assert buffer.readers == 0 and not buffer.ever_attached
+    assert buffer.cancel()
+    assert done.wait(1)
+
+
+def test_last_reader_detaching_abandons_an_open_stream():
+    buffer = ReplayBuffer('chat')
+    abandoned = []
+    buffer.on_abandoned = lambda: abandoned.append(True)
+    buffer.put(message('a'))
+    events = iter_events(buffer)
+    next(events)
+    events.close()
+    assert abandoned == [True]
+    assert buffer.readers == 0 and buffer.ever_attached
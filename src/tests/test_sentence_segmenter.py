@@ -0,0 +1,59 @@
+"""Tests for incremental sentence segmentation of streamed replies"""
+import pytest
+
+from utils.sentence_segmenter import SentenceSegmenter, strip_markdown
+
+
+def segment(chunks, **settings):
+    segmenter = SentenceSegmenter(**dict({'min_chars': 0}, **settings))
+    sentences = []
+    for chunk in chunks:
+        sentences += segmenter.feed(chunk)
+    return sentences + segmenter.flush()
+
+
+def test_sentences_are_split_at_terminal_punctuation():
+    assert segment(["Hello there. How are", " you? Fine!"]) == ["Hello there.", "How are you?", "Fine!"]
+
+
+def test_abbreviations_and_initials_do_not_end_a_sentence():
+    text = "Dr. Smith met Mr. J. Doe, e.g. at noon. Then they left."
+    assert segment([text]) == ["Dr. Smith met Mr. J. Doe, e.g. at noon.", "Then they left."]
+
+
+def test_decimals_and_file_names_are_not_split():
+    assert segment(["Pi is 3", ".", "14 and the file is notes", ".txt today. Done."]) == [
+        "Pi is 3.14 and the file is notes.txt today.", "Done."]
+
+
+def test_code_fences_are_not_spoken():
+    chunks = ["Run this:\n``", "`python\nprint('a. b. c.')\n`", "``\nIt prints letters."]
+    assert segment(chunks) == ["Run this:", "It prints letters."]
+
+
+def test_unclosed_fence_is_dropped_on_flush():
+    assert segment(["Here it is.\n```bash\necho hi. bye."]) == ["Here it is."]
+
+
+def test_short_sentences_are_joined():
+    assert segment(["Yes. No. This one is long enough."], min_chars=10) == ["Yes. No. This one is long enough."]
+
+
+def test_long_runs_are_split_at_a_comma():
+    text = "word " * 10 + "and then, " + "more " * 20
+    sentences = segment([text], max_chars=60)
+    assert all(len(sentence) <= 60 for sentence in sentences)
+    assert sentences[0].endswith("then,")
+
+
+@pytest.mark.parametrize('text', [
+    "Hello there. How are you? I'm fine, thanks.",
+    "Dr. Who said 2.5 is e.g. fine.\n```\ncode. here.\n```\nAnd done.",
+])
+def test_chunking_does_not_change_the_sentences(text):
+    assert segment(list(text)) == segment([text])
+
+
+def test_strip_markdown():
+    assert strip_markdown("## **Bold** [link](http://x) `code`") == "Bold link code"
+    assert strip_markdown("- * ---") == ''
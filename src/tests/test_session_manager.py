@@ -0,0 +1,76 @@
+"""Tests for the per-session interpreter pool"""
+import pytest
+
+from utils.session_manager import SessionLimitError, SessionManager, DEFAULT_SESSION_ID
+
+
+class FakeInterpreter:
+    def __init__(self):
+        self.messages = []
+
+
+def test_sessions_are_isolated_and_built_lazily():
+    built = []
+
+    def factory():
+        built.append(FakeInterpreter())
+        return built[-1]
+
+    manager = SessionManager(factory)
+    first, second = manager.get('a'), manager.get('b')
+    assert built == [] and manager.get('a') is first
+    first.interpreter.messages.append("hello")
+    assert second.interpreter.messages == [] and len(built) == 2
+    assert manager.get(None).session_id == DEFAULT_SESSION_ID
+
+
+def test_least_recently_used_idle_session_is_evicted():
+    manager = SessionManager(FakeInterpreter, max_sessions=2)
+    manager.get('a')
+    manager.get('b')
+    manager.get('a')
+    manager.get('c')
+    assert [session.session_id for session in manager.sessions()] == ['a', 'c']
+
+
+def test_busy_sessions_are_never_evicted():
+    manager = SessionManager(FakeInterpreter, max_sessions=2)
+    busy = manager.get('a')
+    busy.generation_lock.acquire()
+    manager.get('b')
+    manager.get('c')
+    assert [session.session_id for session in manager.sessions()] == ['a', 'c']
+
+    manager.get('c').generation_lock.acquire()
+    with pytest.raises(SessionLimitError):
+        manager.get('d')
+    assert manager.stats()['busy_sessions'] == 2
+
+
+def test_idle_sessions_expire_unless_busy():
+    manager = SessionManager(FakeInterpreter, idle_timeout=60)
+    idle, busy = manager.get('idle'), manager.get('busy')
+    busy.generation_lock.acquire()
+    idle.last_used -= 120
+    busy.last_used -= 120
+    manager.get('other')
+    assert manager.peek('idle') is None and manager.peek('busy') is busy
+
+
+def test_closed_sessions_release_their_interpreter_and_run_the_callback():
+    closed = []
+    manager = SessionManager(FakeInterpreter, max_sessions=1, on_close=lambda session: closed.append(session))
+    session = manager.get('a')
+    session.interpreter
+    manager.get('b')
+    assert closed == [session] and not session.has_interpreter
+    assert manager.remove('b') and not manager.remove('b')
+    assert [s.session_id for s in closed] == ['a', 'b']
+
+
+def test_new_interpreters_are_restored():
+    def restore(session_id, interpreter):
+        interpreter.messages.append(session_id)
+
+    manager = SessionManager(FakeInterpreter, restore=restore)
+    assert manager.get('saved').interpreter.messages == ['saved']
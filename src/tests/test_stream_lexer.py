@@ -0,0 +1,79 @@
+"""Tests for the incremental thinking/fence lexer and code block extraction"""
+import random
+
+import pytest
+
+from utils.helpers import extract_code_blocks
+from utils.stream_lexer import StreamLexer
+
+SAMPLES = [
+    "plain text with no markup",
+    "<think>plan the reply</think>Here it is.",
+    "Intro\n```python\nprint('hi')\n```\nAfter the code.",
+    "```\nno language\n```",
+    "~~~~bash\necho ~~~\n~~~~\ntext",
+    "<think>thinking with a fence\n```python\nx = 1\n</think>reply\n```js\nlet y;\n```\n",
+    "a < b and </thin but not a tag <thinking> either",
+    "inline ```x``` is not a fence\n    ```indented four is not either\n",
+    "unclosed\n```python\nstill code",
+]
+
+
+def lex(chunks):
+    """Events of a chunked stream, with adjacent text merged (chunking may split text anywhere)"""
+    lexer = StreamLexer()
+    events = []
+    for chunk in chunks:
+        events += lexer.feed(chunk)
+    events += lexer.flush()
+    merged = []
+    for kind, value in events:
+        if kind == 'text' and merged and merged[-1][0] == 'text':
+            merged[-1] = ('text', merged[-1][1] + value)
+        elif kind != 'text' or value:
+            merged.append((kind, value))
+    return merged
+
+
+def splits(text, rng):
+    cuts = sorted(rng.sample(range(1, len(text)), min(len(text) - 1, rng.randint(1, 12))))
+    return [text[start:end] for start, end in zip([0] + cuts, cuts + [len(text)])]
+
+
+@pytest.mark.parametrize('text', SAMPLES)
+def test_events_do_not_depend_on_chunking(text):
+    whole = lex([text])
+    assert lex(list(text)) == whole
+    rng = random.Random(text)
+    for _ in range(50):
+        assert lex(splits(text, rng)) == whole
+
+
+def test_thinking_tags_are_removed_from_text():
+    assert lex(["<thi", "nk>hmm</th", "ink>ok"]) == [
+        ('thinking_start', ''), ('text', 'hmm'), ('thinking_end', ''), ('text', 'ok')]
+
+
+def test_fence_events_surround_the_fence_lines():
+    assert lex(["say\n```py\nx\n```\nend"]) == [
+        ('text', 'say\n'), ('fence_open', 'py'), ('text', '```py\nx\n```\n'), ('fence_close', ''), ('text', 'end')]
+
+
+def test_thinking_end_closes_an_open_fence():
+    events = lex(["<think>\n```\ncode</think>reply"])
+    assert events[-3:] == [('fence_close', ''), ('thinking_end', ''), ('text', 'reply')]
+
+
+def test_extract_code_blocks():
+    text = "a\n```python\nprint(1)\n```\nb\n```\nplain\n```"
+    assert extract_code_blocks(text) == [
+        {"language": "python", "code": "print(1)"},
+        {"language": "text", "code": "plain"},
+    ]
+
+
+def test_extract_code_blocks_keeps_regex_results():
+    # A closing fence on the same line as the code still ends the block
+    assert extract_code_blocks("```js\nlet x = 1;```") == [{"language": "js", "code": "let x = 1;"}]
+    # An unclosed block isn't extracted
+    assert extract_code_blocks("```python\nprint(1)\n") == []
@@ -0,0 +1,89 @@
+"""Tests for batched, ordered speech synthesis"""
+import json
+import struct
+import threading
+import time
+
+import pytest
+
+pytest.importorskip('requests')
+
+from utils.tts_batch import TtsBatchSynthesizer, encode_batch_frame, split_sentences  # noqa: E402
+from utils.tts_cache import TtsCache  # noqa: E402
+from utils.tts_engines import TtsError  # noqa: E402
+
+
+class FakeEngine:
+    """Engine whose clips finish only when their text's event is set"""
+
+    name = 'fake'
+
+    def __init__(self, *texts):
+        self.release = {text: threading.Event() for text in texts}
+        self.calls = []
+
+    def cache_key(self, text, voice):
+        return f"{voice}:{text}"
+
+    def synthesize(self, text, voice):
+        self.calls.append(text)
+        if not self.release[text].wait(2):
+            raise AssertionError(f"{text} was never released")
+        if text == 'bad':
+            raise TtsError("synthesis failed", 502)
+        return text.encode()
+
+
+def test_results_come_back_in_order_when_synthesis_finishes_out_of_order():
+    engine = FakeEngine('one', 'two', 'three')
+    batch = TtsBatchSynthesizer(TtsCache(), concurrency={'fake': 3})
+    results = batch.synthesize(engine, ['one', 'two', 'three'], 'alloy')
+
+    # The last clip finishes first
+    while len(engine.calls) < 3:
+        time.sleep(0.005)
+    for text in ('three', 'two', 'one'):
+        engine.release[text].set()
+    assert [(r['index'], r['audio']) for r in results] == [(0, b'one'), (1, b'two'), (2, b'three')]
+
+
+def test_repeated_segments_and_cached_clips_are_synthesized_once():
+    engine = FakeEngine('again')
+    engine.release['again'].set()
+    cache = TtsCache()
+    batch = TtsBatchSynthesizer(cache)
+    assert [r['cached'] for r in batch.synthesize(engine, ['again', 'again'], 'alloy')] == [False, False]
+    assert [r['cached'] for r in batch.synthesize(engine, ['again'], 'alloy')] == [True]
+    assert engine.calls == ['again']
+
+
+def test_a_failed_segment_is_reported_in_place():
+    engine = FakeEngine('ok', 'bad')
+    for event in engine.release.values():
+        event.set()
+    results = list(TtsBatchSynthesizer(TtsCache()).synthesize(engine, ['bad', 'ok'], 'alloy'))
+    assert results[0]['error'] and results[0]['status'] == 502
+    assert results[1]['audio'] == b'ok'
+
+
+def test_closing_early_cancels_segments_that_have_not_started():
+    engine = FakeEngine('a', 'b', 'c')
+    engine.release['a'].set()
+    results = TtsBatchSynthesizer(TtsCache(), concurrency={'fake': 1}).synthesize(engine, ['a', 'b', 'c'], 'alloy')
+    assert next(results)['audio'] == b'a'
+    while len(engine.calls) < 2:
+        time.sleep(0.005)
+    # 'b' is running and can't be cancelled; 'c' is still queued behind it
+    results.close()
+    engine.release['b'].set()
+    time.sleep(0.05)
+    assert engine.calls == ['a', 'b']
+
+
+def test_frames_and_sentences():
+    frame = encode_batch_frame({"index": 0, "text": "hi"}, b'audio')
+    (head_length,) = struct.unpack('>I', frame[:4])
+    assert json.loads(frame[4:4 + head_length]) == {"index": 0, "text": "hi"}
+    assert frame[4 + head_length:] == struct.pack('>I', 5) + b'audio'
+    assert split_sentences("This is the first sentence. And this is the second one.") == [
+        "This is the first sentence.", "And this is the second one."]
@@ -0,0 +1,48 @@
+"""Tests for the two-tier speech cache"""
+from utils.tts_cache import TtsCache, tts_cache_key
+
+
+def key(text, voice='alloy'):
+    return tts_cache_key('openai', 'tts-1', voice, text)
+
+
+def test_key_covers_every_parameter():
+    assert key('hello') == key('hello')
+    assert key('hello') != key('hello', voice='nova')
+    assert key('hello') != tts_cache_key('openai', 'tts-1', 'alloy', 'hello', 'opus')
+
+
+def test_memory_tier_evicts_least_recently_used():
+    cache = TtsCache(memory_bytes=10)
+    cache.put(key('a'), b'aaaa')
+    cache.put(key('b'), b'bbbb')
+    assert cache.get(key('a')) == b'aaaa'
+    cache.put(key('c'), b'cccc')
+    assert cache.get(key('b')) is None
+    assert cache.get(key('a')) == b'aaaa' and cache.get(key('c')) == b'cccc'
+    assert cache.stats['memory_bytes'] == 8 and cache.stats['misses'] == 1
+
+
+def test_disk_tier_survives_restarts_and_is_promoted(tmp_path):
+    TtsCache(directory=str(tmp_path)).put(key('a'), b'audio')
+
+    cache = TtsCache(memory_bytes=1024, directory=str(tmp_path))
+    assert cache.stats['disk_entries'] == 1
+    assert cache.get(key('a')) == b'audio'
+    assert cache.get(key('a')) == b'audio'
+    assert cache.stats['disk_hits'] == 1 and cache.stats['memory_hits'] == 1
+
+
+def test_disk_tier_evicts_down_to_budget(tmp_path):
+    cache = TtsCache(memory_bytes=0, directory=str(tmp_path), disk_bytes=10)
+    for text in 'abc':
+        cache.put(key(text), text.encode() * 4)
+    assert cache.stats['disk_bytes'] <= 10
+    assert cache.get(key('a')) is None
+    assert cache.get(key('c')) == b'cccc'
+
+
+def test_empty_audio_is_not_cached():
+    cache = TtsCache()
+    cache.put(key('a'), b'')
+    assert cache.get(key('a')) is None
@@ -0,0 +1,100 @@
+"""Tests for the upstream clients' retries and circuit breaker"""
+import time
+
+import pytest
+
+requests = pytest.importorskip('requests')
+
+from utils.upstream import CircuitOpenError, UpstreamClient, UpstreamError  # noqa: E402
+
+
+class FakeSession:
+    """Stands in for the pooled session, answering with the given statuses (an exception is raised)"""
+
+    def __init__(self, *outcomes):
+        self.outcomes = list(outcomes)
+        self.calls = 0
+
+    def request(self, method, url, **kwargs):
+        self.calls += 1
+        outcome = self.outcomes.pop(0) if len(self.outcomes) > 1 else self.outcomes[0]
+        if isinstance(outcome, Exception):
+            raise outcome
+        response = requests.Response()
+        response.status_code = outcome
+        response._content, response._content_consumed = b'', True
+        return response
+
+
+def client(*outcomes, **settings):
+    settings = dict({'retries': 2, 'backoff': 0, 'breaker_threshold': 3, 'breaker_cooldown': 30}, **settings)
+    upstream = UpstreamClient('test', **settings)
+    upstream.session = FakeSession(*outcomes)
+    return upstream
+
+
+def test_retryable_statuses_and_errors_are_retried():
+    upstream = client(503, requests.ConnectionError("refused"), 200)
+    assert upstream.get('http://upstream/').status_code == 200
+    assert upstream.session.calls == 3 and upstream.stats['retries'] == 2
+
+
+def test_retries_are_bounded():
+    upstream = client(503)
+    assert upstream.get('http://upstream/').status_code == 503
+    assert upstream.session.calls == 3
+
+
+def test_posts_and_client_errors_are_not_retried():
+    upstream = client(503)
+    assert upstream.post('http://upstream/').status_code == 503
+    assert upstream.session.calls == 1
+
+    upstream = client(404)
+    assert upstream.get('http://upstream/').status_code == 404
+    assert upstream.session.calls == 1 and upstream.state == 'closed'
+
+
+def test_breaker_opens_then_half_opens_for_one_trial():
+    upstream = client(requests.ConnectionError("refused"), retries=0)
+    for _ in range(3):
+        with pytest.raises(UpstreamError):
+            upstream.get('http://upstream/')
+    assert upstream.state == 'open'
+    with pytest.raises(CircuitOpenError):
+        upstream.get('http://upstream/')
+    assert upstream.session.calls == 3 and upstream.stats['rejected'] == 1
+
+    # Once the cooldown is over, one trial request goes through and others are still turned away
+    upstream._open_until = time.monotonic() - 1
+    assert upstream.state == 'half_open'
+    with upstream.guard():
+        with pytest.raises(CircuitOpenError):
+            upstream.get('http://upstream/')
+
+
+def test_failed_trial_reopens_and_a_successful_one_closes():
+    upstream = client(requests.ConnectionError("refused"), retries=0, breaker_threshold=1)
+    with pytest.raises(UpstreamError):
+        upstream.get('http://upstream/')
+    upstream._open_until = time.monotonic() - 1
+    with pytest.raises(UpstreamError):
+        upstream.get('http://upstream/')
+    assert upstream.state == 'open'
+
+    upstream._open_until = time.monotonic() - 1
+    upstream.session.outcomes = [200]
+    assert upstream.get('http://upstream/').status_code == 200
+    assert upstream.state == 'closed'
+
+
+def test_guard_counts_server_errors_only():
+    upstream = client(200, breaker_threshold=1)
+    with pytest.raises(UpstreamError):
+        with upstream.guard():
+            raise UpstreamError("bad request", 400)
+    assert upstream.state == 'closed'
+    with pytest.raises(UpstreamError):
+        with upstream.guard():
+            raise UpstreamError("unavailable", 503)
+    assert upstream.state == 'open'
@@ -0,0 +1,71 @@
+"""Tests for the chat stream wire encodings"""
+import json
+
+import pytest
+
+from utils.wire_format import (CompactFramer, SseCompactEncoder, SseJsonEncoder, UnsupportedStreamFormat,
+                               COMPACT_MEDIA_TYPE, ONE_SHOT_FLAGS, negotiate_stream_encoder)
+
+CHUNKS = [
+    {"role": "assistant", "type": "message", "content": "Let me ", "is_new_block": True},
+    {"role": "assistant", "type": "message", "content": "check."},
+    {"role": "assistant", "type": "code", "format": "python", "content": "import os", "is_new_block": True},
+    {"role": "assistant", "type": "code", "format": "python", "content": "\n", "is_end": True},
+    {"role": "computer", "type": "console", "format": "output", "content": "ok"},
+    {"role": "computer", "type": "console", "format": "output", "content": "!"},
+]
+
+
+def decode(frames):
+    """Rebuild the chunks a compact stream describes"""
+    metadata, chunks = {}, []
+    for frame in frames:
+        if isinstance(frame, dict):
+            chunk = dict(frame['m'], content=frame['d'])
+            # One-shot flags only belong to the chunk that opened the block
+            metadata[frame['b']] = {k: v for k, v in frame['m'].items() if k not in ONE_SHOT_FLAGS}
+            is_end = frame.get('e')
+        else:
+            chunk = dict(metadata[frame[0]], content=frame[1])
+            is_end = len(frame) > 2
+        if is_end:
+            chunk['is_end'] = True
+        chunks.append(chunk)
+    return chunks
+
+
+def test_compact_frames_round_trip():
+    framer = CompactFramer()
+    frames = [framer.frame(chunk) for chunk in CHUNKS]
+    assert decode(frames) == CHUNKS
+
+
+def test_metadata_is_sent_once_per_block():
+    framer = CompactFramer()
+    frames = [framer.frame(chunk) for chunk in CHUNKS]
+    assert [isinstance(frame, dict) for frame in frames] == [True, False, True, False, True, False]
+    assert frames[1] == [1, "check."]
+    assert frames[3] == [2, "\n", 1]
+
+
+def test_one_shot_flags_open_a_new_block():
+    framer = CompactFramer()
+    framer.frame(CHUNKS[0])
+    frame = framer.frame(dict(CHUNKS[1], new_message=True))
+    assert frame['b'] == 2 and frame['m']['new_message'] is True
+
+
+def test_sse_compact_frames_carry_event_ids():
+    frame = SseCompactEncoder().encode(CHUNKS[0], event_id=7)
+    lines = frame.split('\n')
+    assert lines[0] == 'id: 7' and frame.endswith('\n\n')
+    assert json.loads(lines[1][len('data: '):])['d'] == "Let me "
+
+
+def test_negotiation():
+    assert isinstance(negotiate_stream_encoder(), SseJsonEncoder)
+    assert isinstance(negotiate_stream_encoder(accept=f'{COMPACT_MEDIA_TYPE}, */*'), SseCompactEncoder)
+    # The query parameter wins over the Accept header
+    assert isinstance(negotiate_stream_encoder(accept=COMPACT_MEDIA_TYPE, requested='json'), SseJsonEncoder)
+    with pytest.raises(UnsupportedStreamFormat):
+        negotiate_stream_encoder(requested='xml')
@@ -0,0 +1,272 @@
+"""
+Admission control and priority scheduling for the server's work
+
+Work is split into classes (chat generations, code execution, TTS and
+auxiliary completions), each with its own concurrency limit and bounded
+wait queue. Classes that aren't nested inside another also share one pool
+of slots. When a slot frees up, the waiting request with the best priority
+whose class has room runs next, so interactive chat goes ahead of TTS and
+auxiliary work, and a class at its limit doesn't hold up the others.
+
+A request that finds its class's queue full, or waits longer than the class
+allows, is turned away straight away with a 429 and a Retry-After estimate,
+so overload shows up as quick refusals rather than a growing backlog.
+
+Limits come from the environment: ``ADMISSION_<CLASS>_LIMIT``, ``_QUEUE``
+and ``_WAIT``, e.g. ``ADMISSION_TTS_LIMIT=4``.
+"""
+import bisect
+import itertools
+import math
+import os
+import threading
+import time
+from typing import Any, Dict, List, Optional
+
+# Weight of the newest sample in the service time moving average
+_SERVICE_TIME_ALPHA = 0.2
+
+
+class AdmissionRejected(Exception):
+    """Raised when a request can't be admitted; maps to 429 with Retry-After"""
+
+    status_code = 429
+
+    def __init__(self, work_class: str, retry_after: int, reason: str):
+        super().__init__(f"The server is busy ({work_class} {reason}), retry in {retry_after}s")
+        self.work_class = work_class
+        self.retry_after = retry_after
+
+
+class WorkClass:
+    """Limits and counters of one class of work"""
+
+    __slots__ = ('name', 'limit', 'max_queue', 'max_wait', 'priority', 'shared', 'active', 'waiting',
+                 'admitted', 'rejected', 'timed_out', 'service_time')
+
+    def __init__(self, name: str, limit: int, max_queue: int, max_wait: float, priority: int, shared: bool):
+        self.name = name
+        self.limit = limit
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.priority = priority
+        self.shared = shared
+        self.active = 0
+        self.waiting = 0
+        self.admitted = 0
+        self.rejected = 0
+        self.timed_out = 0
+        # Moving average of seconds a slot is held, for Retry-After
+        self.service_time = 1.0
+
+
+class Slot:
+    """
+    An admitted unit of work; release it when the work is done
+
+    Can be used as a context manager. Releasing twice is harmless, so the
+    slot may be released from whichever of several cleanup paths runs first.
+    """
+
+    def __init__(self, controller: 'AdmissionController', work_class: WorkClass):
+        self.controller = controller
+        self.work_class = work_class
+        self.started_at = time.monotonic()
+        self.released = False
+
+    def release(self):
+        self.controller._release(self)
+
+    def __enter__(self) -> 'Slot':
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+
+class AdmissionController:
+    """
+    Per-class concurrency pools with priority-ordered wait queues
+
+    Args:
+        max_active: Slots shared by all non-nested classes (0 for no shared limit)
+    """
+
+    def __init__(self, max_active: int = 0):
+        self.max_active = max_active
+        self._classes: Dict[str, WorkClass] = {}
+        # Waiters as (priority, arrival, work class), best first
+        self._waiters: List[tuple] = []
+        self._arrivals = itertools.count()
+        self._shared_active = 0
+        self._condition = threading.Condition()
+
+    def configure(self, name: str, limit: int, max_queue: int = 32, max_wait: float = 10, priority: int = 1,
+                  shared: bool = True) -> WorkClass:
+        """
+        Add a work class, with its limits overridable from the environment
+
+        Args:
+            name: Class name
+            limit: Concurrent slots (``ADMISSION_<NAME>_LIMIT``)
+            max_queue: Requests allowed to wait (``ADMISSION_<NAME>_QUEUE``)
+            max_wait: Seconds a request may wait (``ADMISSION_<NAME>_WAIT``; 0 never waits)
+            priority: Lower runs first when several classes are waiting for the shared pool
+            shared: False for work that runs inside another class's slot (it then skips the shared pool)
+        """
+        prefix = f"ADMISSION_{name.upper()}_"
+        work_class = WorkClass(
+            name,
+            limit=int(os.environ.get(prefix + 'LIMIT', limit)),
+            max_queue=int(os.environ.get(prefix + 'QUEUE', max_queue)),
+            max_wait=float(os.environ.get(prefix + 'WAIT', max_wait)),
+            priority=priority,
+            shared=shared
+        )
+        with self._condition:
+            self._classes[name] = work_class
+        return work_class
+
+    def acquire(self, name: str) -> Slot:
+        """
+        Wait for a slot of a work class
+
+        Args:
+            name: The work class
+
+        Returns:
+            The slot, to be released when the work is done
+
+        Raises:
+            AdmissionRejected: If the queue is full or the wait runs out
+        """
+        with self._condition:
+            work_class = self._classes[name]
+            if self._can_run(work_class) and self._next() is None:
+                return self._admit(work_class)
+            if work_class.waiting >= work_class.max_queue or work_class.max_wait <= 0:
+                work_class.rejected += 1
+                raise AdmissionRejected(name, self._retry_after(work_class), 'queue is full')
+
+            waiter = (work_class.priority, next(self._arrivals), work_class)
+            bisect.insort(self._waiters, waiter)
+            work_class.waiting += 1
+            deadline = time.monotonic() + work_class.max_wait
+            try:
+                while self._next() is not waiter:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        work_class.timed_out += 1
+                        raise AdmissionRejected(name, self._retry_after(work_class), 'wait timed out')
+                    self._condition.wait(remaining)
+            finally:
+                self._waiters.remove(waiter)
+                work_class.waiting -= 1
+                # Whoever is next may be able to run now
+                self._condition.notify_all()
+            return self._admit(work_class)
+
+    def max_queue(self, name: str) -> int:
+        """Requests of a work class allowed to wait at once"""
+        with self._condition:
+            return self._classes[name].max_queue
+
+    def retry_after(self, name: str) -> int:
+        """Seconds a client turned away from a work class should wait before retrying"""
+        with self._condition:
+            return self._retry_after(self._classes[name])
+
+    @property
+    def stats(self) -> Dict[str, Any]:
+        """Active and waiting requests and admission counters per class"""
+        with self._condition:
+            return {
+                "max_active": self.max_active,
+                "shared_active": self._shared_active,
+                "classes": {work_class.name: {
+                    "limit": work_class.limit,
+                    "active": work_class.active,
+                    "waiting": work_class.waiting,
+                    "admitted": work_class.admitted,
+                    "rejected": work_class.rejected,
+                    "timed_out": work_class.timed_out,
+                    "service_time_ms": round(1000 * work_class.service_time, 1),
+                } for work_class in self._classes.values()},
+            }
+
+    def _can_run(self, work_class: WorkClass) -> bool:
+        """Whether a class has a free slot, in its own pool and the shared one (caller holds the lock)"""
+        if work_class.active >= work_class.limit:
+            return False
+        return not (work_class.shared and self.max_active and self._shared_active >= self.max_active)
+
+    def _next(self) -> Optional[tuple]:
+        """The best waiter that could run now (caller holds the lock)"""
+        for waiter in self._waiters:
+            if self._can_run(waiter[2]):
+                return waiter
+        return None
+
+    def _admit(self, work_class: WorkClass) -> Slot:
+        work_class.active += 1
+        work_class.admitted += 1
+        if work_class.shared:
+            self._shared_active += 1
+        return Slot(self, work_class)
+
+    def _release(self, slot: Slot):
+        with self._condition:
+            if slot.released:
+                return
+            slot.released = True
+            work_class = slot.work_class
+            work_class.active -= 1
+            if work_class.shared:
+                self._shared_active -= 1
+            held = time.monotonic() - slot.started_at
+            work_class.service_time = _SERVICE_TIME_ALPHA * held + (1 - _SERVICE_TIME_ALPHA) * work_class.service_time
+            self._condition.notify_all()
+
+    def _retry_after(self, work_class: WorkClass) -> int:
+        """Time for the queue ahead to drain, from the class's average service time (caller holds the lock)"""
+        return max(1, math.ceil(work_class.service_time * (work_class.waiting + 1) / max(1, work_class.limit)))
+
+
+class CodeExecutionGate:
+    """
+    Holds a slot while the interpreter runs a code block
+
+    The interpreter runs a block when its generator is advanced after the
+    block's final code chunk, so feeding every raw chunk to ``observe()``
+    before asking for the next one makes execution wait for a slot.
+
+    Args:
+        controller: The admission controller
+        work_class: Class whose slots code runs in
+    """
+
+    def __init__(self, controller: AdmissionController, work_class: str = 'code'):
+        self.controller = controller
+        self.work_class = work_class
+        self._slot: Optional[Slot] = None
+
+    def observe(self, chunk: Any):
+        """
+        Take a slot after a finished code block and give it back once its console output ends
+
+        Raises:
+            AdmissionRejected: If no slot frees up in time
+        """
+        if not isinstance(chunk, dict) or not chunk.get('end'):
+            return
+        if chunk.get('role') == 'assistant' and chunk.get('type') == 'code':
+            if self._slot is None:
+                self._slot = self.controller.acquire(self.work_class)
+        elif chunk.get('role') == 'computer' and chunk.get('type') == 'console':
+            self.release()
+
+    def release(self):
+        """Give back the slot, if one is held"""
+        if self._slot is not None:
+            self._slot.release()
+            self._slot = None
@@ -0,0 +1,136 @@
+"""
+Asyncio helpers for streaming chat chunks to SSE clients
+
+The interpreter's synchronous generator runs on the bounded chat executor and
+writes into the generation's ReplayBuffer. The buffer wakes waiting
+coroutines through call_soon_threadsafe, so an open SSE connection costs a
+coroutine rather than a blocked thread.
+"""
+import asyncio
+import sys
+from typing import Any, AsyncIterator, Awaitable, Callable, Optional, Tuple, Union
+
+from .chunk_coalescer import ChunkCoalescer
+from .replay_buffer import ReplayBuffer, REPLAY_GAP_CHUNK, collect_ready
+from .wire_format import SseJsonEncoder
+
+
+async def aiter_events(buffer: ReplayBuffer, after_id: int = 0,
+                       coalescer: Optional[ChunkCoalescer] = None) -> AsyncIterator[Tuple[Optional[int], Any]]:
+    """
+    Follow a replay buffer from the event loop until the stream ends
+
+    Args:
+        buffer: The generation's replay buffer
+        after_id: Resume after this event id (0 reads from the start)
+        coalescer: Optional coalescer that merges consecutive chunks
+
+    Yields:
+        (event_id, chunk) pairs, like replay_buffer.iter_events()
+    """
+    loop = asyncio.get_running_loop()
+    wakeup = asyncio.Event()
+
+    def notify():
+        try:
+            loop.call_soon_threadsafe(wakeup.set)
+        except RuntimeError:
+            # The loop has shut down; nobody is listening any more
+            pass
+
+    buffer.add_listener(notify)
+    buffer.attach()
+    try:
+        cursor = after_id
+        if cursor + 1 < buffer.first_id:
+            yield None, REPLAY_GAP_CHUNK
+            cursor = buffer.first_id - 1
+
+        while True:
+            wakeup.clear()
+            events, finished = buffer.read(cursor, 0)
+            if not events and not finished:
+                timeout = coalescer.time_until_flush() if coalescer is not None else None
+                try:
+                    await asyncio.wait_for(wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                events, finished = buffer.read(cursor, 0)
+
+            ready = collect_ready(events, finished, coalescer)
+            if events:
+                cursor = events[-1][0]
+            for event_id, chunk in ready:
+                yield event_id, chunk
+                buffer.mark_delivered(event_id)
+
+            if finished:
+                return
+    finally:
+        buffer.remove_listener(notify)
+        buffer.detach()
+
+
+async def iter_sse_frames(buffer: ReplayBuffer, after_id: int = 0, coalescer: Optional[ChunkCoalescer] = None,
+                          encoder: Any = None) -> AsyncIterator[Union[str, bytes]]:
+    """
+    Yield encoded frames from a generation until the stream ends
+
+    Args:
+        buffer: The generation's replay buffer
+        after_id: Resume after this event id (0 reads from the start)
+        coalescer: Optional coalescer that merges consecutive chunks into larger frames
+        encoder: Wire encoder from wire_format (defaults to full JSON over SSE)
+
+    Yields:
+        Encoded frames, finishing with the encoder's end-of-stream frame
+    """
+    encoder = encoder or SseJsonEncoder()
+    async for event_id, chunk in aiter_events(buffer, after_id, coalescer):
+        try:
+            yield encoder.encode(chunk, event_id)
+        except Exception as e:
+            print(f"Error in iter_sse_frames: {str(e)}", file=sys.stderr)
+            yield encoder.encode({"type": "error", "content": str(e)})
+    yield encoder.done()
+
+
+async def wait_for_disconnect(receive: Callable[[], Awaitable[dict]]):
+    """Wait until the ASGI server reports that the client has gone away"""
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            return
+
+
+async def until_disconnect(frames: AsyncIterator[Any], receive: Callable[[], Awaitable[dict]]) -> AsyncIterator[Any]:
+    """
+    Pass frames through until they run out or the client disconnects
+
+    Waiting for the next frame races against ``http.disconnect``, so a client
+    leaving while the generation is quiet (e.g. running code) is noticed at
+    once and the frame source is closed, detaching it from its buffer.
+
+    Args:
+        frames: Async iterator of frames, e.g. from iter_sse_frames()
+        receive: The ASGI receive callable for the request
+    """
+    frames = frames.__aiter__()
+    disconnect = asyncio.ensure_future(wait_for_disconnect(receive))
+    try:
+        while True:
+            next_frame = asyncio.ensure_future(frames.__anext__())
+            await asyncio.wait({next_frame, disconnect}, return_when=asyncio.FIRST_COMPLETED)
+            if not next_frame.done():
+                next_frame.cancel()
+                await asyncio.gather(next_frame, return_exceptions=True)
+                print("Client disconnected from chat stream", file=sys.stderr)
+                return
+            try:
+                frame = next_frame.result()
+            except StopAsyncIteration:
+                return
+            yield frame
+    finally:
+        disconnect.cancel()
+        await frames.aclose()
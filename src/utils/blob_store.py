@@ -0,0 +1,282 @@
+"""
+Content-addressed storage for images and large payloads in conversation messages
+
+Open Interpreter keeps plots and screenshots as base64 inside its messages,
+next to code and console output that can run to megabytes. All of it stayed
+in each session's ``interpreter.messages``, was written to the conversation
+store, and went out in full with every /history response. Once a turn has
+finished, its images and oversized code and output are moved here instead,
+and the message keeps a reference:
+
+    {"role": "computer", "type": "image", "format": "base64.png",
+     "content": None, "blob": "<sha256>", "blob_size": 48213}
+
+Blobs are keyed by the SHA-256 of their bytes, so an image shown twice, or
+in two conversations, is stored once. Images are stored decoded, so the
+browser can load ``/blobs/<id>`` straight into an ``<img>``. There are two
+tiers:
+
+- memory: an LRU holding up to ``memory_bytes`` of recently used blobs
+- disk: one file per blob under ``directory``, kept for as long as stored
+  conversations may refer to it (never evicted)
+
+Model requests still get the full content: ``attach()`` resolves the
+references in the copy of the messages each request sends.
+"""
+import base64
+import binascii
+import hashlib
+import os
+import re
+import sys
+import tempfile
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional
+
+# Blob ids are SHA-256 hex digests
+BLOB_ID_PATTERN = re.compile(r'^[0-9a-f]{64}$')
+
+# Message types whose long contents are moved out of line
+_TEXT_TYPES = ('code', 'console')
+
+_MISSING_CONTENT = "[Content no longer available]"
+
+# Leading bytes of the image formats Open Interpreter produces
+_IMAGE_SIGNATURES = (
+    (b'\x89PNG\r\n\x1a\n', 'image/png'),
+    (b'\xff\xd8\xff', 'image/jpeg'),
+    (b'GIF8', 'image/gif'),
+)
+
+
+def blob_media_type(data: bytes) -> str:
+    """Media type of a blob, from its leading bytes"""
+    for signature, media_type in _IMAGE_SIGNATURES:
+        if data.startswith(signature):
+            return media_type
+    if data.startswith(b'RIFF') and data[8:12] == b'WEBP':
+        return 'image/webp'
+    return 'text/plain; charset=utf-8'
+
+
+def _is_base64(message: Dict[str, Any]) -> bool:
+    return str(message.get('format') or '').startswith('base64')
+
+
+class BlobStore:
+    """
+    Two-tier (memory + disk) content-addressed store of message payloads
+
+    Args:
+        directory: Directory of the disk tier
+        memory_bytes: Byte budget of the in-memory tier (0 disables it)
+        threshold: Characters of code or console content kept inline; longer
+            contents, and every base64 image, are moved out (0 disables the store)
+    """
+
+    def __init__(self, directory: str, memory_bytes: int = 32 * 1024 * 1024, threshold: int = 16384):
+        self.directory = directory
+        self.memory_bytes = memory_bytes
+        self.threshold = threshold
+        self._memory: "OrderedDict[str, bytes]" = OrderedDict()
+        self._memory_size = 0
+        self._lock = threading.Lock()
+
+        # Stats
+        self.stored = 0
+        self.deduplicated = 0
+        self.bytes_moved = 0
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+        if self.enabled:
+            os.makedirs(self.directory, exist_ok=True)
+            print(f"[Blobs] Storing message payloads over {threshold} characters in {directory}", file=sys.stderr)
+
+    @property
+    def enabled(self) -> bool:
+        """Whether payloads are moved out of messages"""
+        return self.threshold > 0
+
+    def put(self, data: bytes) -> str:
+        """
+        Store a blob, unless one with the same bytes is stored already
+
+        Returns:
+            The blob's id
+
+        Raises:
+            OSError: If the blob can't be written
+        """
+        blob_id = hashlib.sha256(data).hexdigest()
+        path = self._path(blob_id)
+        if os.path.exists(path):
+            with self._lock:
+                self.deduplicated += 1
+            return blob_id
+        # Written atomically, so a blob file is always complete
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except OSError:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            raise
+        with self._lock:
+            self.stored += 1
+            self._remember(blob_id, data)
+        return blob_id
+
+    def get(self, blob_id: str) -> Optional[bytes]:
+        """
+        Look up a blob
+
+        Returns:
+            Its bytes, or None if it isn't stored
+        """
+        with self._lock:
+            data = self._memory.get(blob_id)
+            if data is not None:
+                self._memory.move_to_end(blob_id)
+                self.memory_hits += 1
+                return data
+        try:
+            with open(self._path(blob_id), 'rb') as f:
+                data = f.read()
+        except OSError:
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.disk_hits += 1
+            self._remember(blob_id, data)
+        return data
+
+    def externalize(self, messages: List[Dict[str, Any]]) -> int:
+        """
+        Move the payloads of messages into the store, in place
+
+        Base64 content of any length and code or console content over the
+        threshold is replaced by a reference. Messages that already hold a
+        reference, and user and assistant text, are left alone.
+
+        Returns:
+            Number of messages changed
+        """
+        if not self.enabled:
+            return 0
+        changed = 0
+        for message in messages:
+            content = message.get('content')
+            if not isinstance(content, str) or message.get('blob'):
+                continue
+            if _is_base64(message):
+                try:
+                    data = base64.b64decode(content, validate=True)
+                except (binascii.Error, ValueError):
+                    continue
+            elif message.get('type') in _TEXT_TYPES and len(content) > self.threshold:
+                data = content.encode('utf-8')
+            else:
+                continue
+            try:
+                blob_id = self.put(data)
+            except OSError as e:
+                print(f"[Blobs] Error writing blob: {str(e)}", file=sys.stderr)
+                return changed
+            message['content'] = None
+            message['blob'] = blob_id
+            message['blob_size'] = len(data)
+            changed += 1
+            with self._lock:
+                self.bytes_moved += len(content)
+        return changed
+
+    def resolve(self, messages: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """
+        The messages with their references replaced by the content
+
+        Args:
+            messages: Messages that may hold references; they are left unchanged
+
+        Returns:
+            The messages to use instead (the same list if none held a reference)
+        """
+        if not any(message.get('blob') for message in messages):
+            return messages
+        out = []
+        for message in messages:
+            blob_id = message.get('blob')
+            if not blob_id:
+                out.append(message)
+                continue
+            data = self.get(blob_id)
+            resolved = {key: value for key, value in message.items() if key not in ('blob', 'blob_size')}
+            if data is None:
+                print(f"[Blobs] Blob {blob_id} is missing", file=sys.stderr)
+                if _is_base64(message):
+                    # An image the model can't be shown is better left out than sent broken
+                    continue
+                resolved['content'] = _MISSING_CONTENT
+            elif _is_base64(message):
+                resolved['content'] = base64.b64encode(data).decode('ascii')
+            else:
+                resolved['content'] = data.decode('utf-8', errors='replace')
+            out.append(resolved)
+        return out
+
+    def attach(self, interpreter: Any):
+        """
+        Resolve references in every model request the interpreter makes
+
+        Wraps ``interpreter.llm.run`` like ContextManager.attach(); attach
+        the store last, so the context policy sees the full content.
+        """
+        llm = getattr(interpreter, 'llm', None)
+        run = getattr(llm, 'run', None)
+        if run is None:
+            print("[Blobs] This interpreter has no llm.run, message payloads stay inline", file=sys.stderr)
+            return
+
+        def resolving_run(messages, *args, **kwargs):
+            return run(self.resolve(messages), *args, **kwargs)
+
+        llm.run = resolving_run
+
+    @property
+    def stats(self) -> Dict[str, Any]:
+        """Store and lookup counters and memory tier usage"""
+        with self._lock:
+            return {
+                "stored": self.stored,
+                "deduplicated": self.deduplicated,
+                "bytes_moved": self.bytes_moved,
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "memory_entries": len(self._memory),
+                "memory_bytes": self._memory_size,
+            }
+
+    def _remember(self, blob_id: str, data: bytes):
+        """Insert into the memory tier and evict down to budget (caller holds the lock)"""
+        if len(data) > self.memory_bytes:
+            return
+        previous = self._memory.pop(blob_id, None)
+        if previous is not None:
+            self._memory_size -= len(previous)
+        self._memory[blob_id] = data
+        self._memory_size += len(data)
+        while self._memory_size > self.memory_bytes:
+            _, evicted = self._memory.popitem(last=False)
+            self._memory_size -= len(evicted)
+
+    def _path(self, blob_id: str) -> str:
+        return os.path.join(self.directory, blob_id[:2], blob_id)
@@ -0,0 +1,188 @@
+"""
+Adaptive micro-batching of streamed chunks
+
+Fast local models yield thousands of token-sized chunks per reply. The
+coalescer merges consecutive chunks that would render the same way (same
+type, panel and flags) into one SSE frame, flushing on a time window, a byte
+budget or a block boundary.
+
+It is adaptive: the first chunk after a quiet period is sent straight away,
+so time-to-first-token is unchanged. Only chunks that arrive in quick
+succession get batched.
+
+Chunks go in with their stream event id and come out as (event_id, chunk)
+pairs; a merged chunk carries the id of the last chunk folded into it, so
+resuming after that id never repeats or skips content.
+"""
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+# (event id, chunk) pairs returned by the coalescer
+Ready = List[Tuple[Optional[int], Any]]
+
+# Chunk types whose content is a plain text delta that can be concatenated
+MERGEABLE_TYPES = ('message', 'code', 'output', 'console')
+
+# Flags that mark a chunk as the start of something the UI must see separately
+BOUNDARY_FLAGS = ('is_new_block', 'new_message', 'new_message_after_code', 'new_ui_element')
+
+
+def merge_key(chunk: Any) -> Optional[Tuple]:
+    """
+    Key identifying chunks that can be merged, or None if the chunk must be sent alone
+
+    Args:
+        chunk: A processed chunk from the chat channel
+
+    Returns:
+        A tuple of the fields that must match for two chunks to merge
+    """
+    # Dicts and StreamChunks; raw strings are never merged
+    if not hasattr(chunk, 'get'):
+        return None
+    chunk_type = chunk.get('type')
+    if chunk_type not in MERGEABLE_TYPES or not isinstance(chunk.get('content'), str):
+        return None
+    # Active line markers are state updates, not text
+    if chunk.get('format') == 'active_line':
+        return None
+    return (
+        chunk_type,
+        chunk.get('panel'),
+        chunk.get('format'),
+        chunk.get('language'),
+        bool(chunk.get('skip_chat')),
+        bool(chunk.get('thinking')),
+    )
+
+
+class ChunkCoalescer:
+    """
+    Merge consecutive compatible chunks into larger frames
+
+    Args:
+        window_ms: How long a batch may wait for more chunks before it is flushed
+        max_bytes: Flush once a batch's content reaches this many characters
+    """
+
+    def __init__(self, window_ms: float = 15, max_bytes: int = 4096):
+        self.window = window_ms / 1000.0
+        self.max_bytes = max_bytes
+        self._pending: Optional[Dict[str, Any]] = None
+        self._pending_key: Optional[Tuple] = None
+        self._pending_parts: List[str] = []
+        self._pending_size = 0
+        self._pending_since = 0.0
+        self._pending_id: Optional[int] = None
+        self._last_emit = 0.0
+
+        # Stats
+        self.chunks_in = 0
+        self.frames_out = 0
+
+    def add(self, chunk: Any, event_id: Optional[int] = None) -> Ready:
+        """
+        Add a chunk and return the chunks that are ready to be sent
+
+        Args:
+            chunk: A processed chunk from the chat stream
+            event_id: The chunk's stream event id
+
+        Returns:
+            (event_id, chunk) pairs to send now, in stream order (possibly empty)
+        """
+        self.chunks_in += 1
+        now = time.monotonic()
+        ready: Ready = []
+        key = merge_key(chunk)
+
+        is_boundary = key is None or any(chunk.get(flag) for flag in BOUNDARY_FLAGS)
+
+        # Continue the current batch if this chunk renders the same way
+        if self._pending is not None and not is_boundary and key == self._pending_key:
+            self._append(chunk, event_id)
+            window_expired = now - self._pending_since >= self.window
+            if chunk.get('is_end') or self._pending_size >= self.max_bytes or window_expired:
+                ready.extend(self._take_pending())
+            return self._emitted(ready, now)
+
+        # Anything else closes the current batch first to keep stream order
+        ready.extend(self._take_pending())
+
+        idle = now - self._last_emit >= self.window
+        if key is None or chunk.get('is_end') or idle:
+            # Send immediately: unmergeable, end of block, or first chunk after a pause
+            ready.append((event_id, chunk))
+        else:
+            self._start(chunk, key, now, event_id)
+            if self._pending_size >= self.max_bytes:
+                ready.extend(self._take_pending())
+        return self._emitted(ready, now)
+
+    def flush(self) -> Ready:
+        """Return the pending batch (if any) and clear it"""
+        return self._emitted(self._take_pending(), time.monotonic())
+
+    def _take_pending(self) -> Ready:
+        """Remove the pending batch, joining its content"""
+        if self._pending is None:
+            return []
+        merged = self._pending
+        if len(self._pending_parts) > 1:
+            merged['content'] = ''.join(self._pending_parts)
+        ready = [(self._pending_id, merged)]
+        self._pending = None
+        self._pending_key = None
+        self._pending_parts = []
+        self._pending_size = 0
+        self._pending_id = None
+        return ready
+
+    def time_until_flush(self) -> Optional[float]:
+        """
+        Seconds until the pending batch's window expires
+
+        Returns:
+            None if nothing is pending (wait indefinitely), otherwise a timeout >= 0
+        """
+        if self._pending is None:
+            return None
+        return max(0.0, self._pending_since + self.window - time.monotonic())
+
+    def flush_due(self) -> Ready:
+        """Flush the pending batch if its window has expired"""
+        if self._pending is not None and self.time_until_flush() == 0.0:
+            return self.flush()
+        return []
+
+    @property
+    def stats(self) -> Dict[str, int]:
+        """Chunks received and frames produced so far"""
+        return {'chunks_in': self.chunks_in, 'frames_out': self.frames_out}
+
+    def _start(self, chunk: Dict[str, Any], key: Tuple, now: float, event_id: Optional[int]):
+        """Begin a new batch with this chunk"""
+        self._pending = chunk.copy()
+        self._pending_key = key
+        self._pending_parts = [chunk['content']]
+        self._pending_size = len(chunk['content'])
+        self._pending_since = now
+        self._pending_id = event_id
+
+    def _append(self, chunk: Dict[str, Any], event_id: Optional[int]):
+        """Add a compatible chunk to the current batch"""
+        self._pending_id = event_id
+        self._pending_parts.append(chunk['content'])
+        self._pending_size += len(chunk['content'])
+        if chunk.get('is_end'):
+            self._pending['is_end'] = True
+            if chunk.get('code_block_completed'):
+                self._pending['code_block_completed'] = True
+
+    def _emitted(self, ready: Ready, now: float) -> Ready:
+        """Record emitted frames for the idle detection and stats"""
+        if ready:
+            self._last_emit = now
+            self.frames_out += len(ready)
+        return ready
+
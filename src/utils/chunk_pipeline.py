@@ -0,0 +1,318 @@
+"""
+Single-pass chunk normalization for the chat stream
+
+Replaces the parse_interpreter_chunk -> process_chunk_for_ui -> process_chat
+flag chain with one table-driven translator. Each raw interpreter chunk is
+looked up by (role, type, format), turned into a slotted StreamChunk with all
+UI hints set, and serialized straight to the SSE JSON payload.
+
+The wire format is the same as before, except that false/empty flags are
+omitted (the client only tests them for truthiness).
+"""
+import json
+import sys
+from json.encoder import encode_basestring_ascii as _encode_str
+from typing import Any, Dict, List, Optional, Tuple
+
+from .stream_lexer import StreamLexer
+
+_encode_json = json.JSONEncoder(separators=(',', ':')).encode
+
+# (role, type, format) -> (wire type, panel, skip_chat, meaning of the format field)
+# A format of None matches any format for that role and type.
+TRANSLATION_TABLE: Dict[Tuple[str, str, Optional[str]], Tuple[str, str, bool, Optional[str]]] = {
+    ('assistant', 'code', None): ('code', 'code', True, 'language'),
+    ('computer', 'console', 'output'): ('output', 'output', True, None),
+    ('computer', 'console', 'active_line'): ('console', 'output', True, 'format'),
+    ('computer', 'console', None): ('console', 'output', True, 'format'),
+    ('assistant', 'message', None): ('message', 'chat', False, None),
+}
+
+# Panel for chunk types that don't match a table entry
+PANEL_BY_TYPE = {'code': 'code', 'output': 'output', 'console': 'output'}
+
+# Boolean fields, in wire order; only true values are serialized
+FLAG_FIELDS = (
+    'is_new_block', 'is_end', 'thinking', 'skip_chat', 'new_message',
+    'new_ui_element', 'code_block_completed', 'new_message_after_code',
+)
+_FLAG_JSON = {name: f',"{name}":true' for name in FLAG_FIELDS}
+
+
+def _encode_value(value: Any) -> str:
+    """JSON-encode a value, taking the fast path for strings"""
+    if value.__class__ is str:
+        return _encode_str(value)
+    return _encode_json(value)
+
+
+class StreamChunk:
+    """
+    Compact representation of one UI-ready chunk
+
+    Supports the small part of the dict API the stream stages use (get,
+    item access and copy) so it can flow through the same code as dicts.
+    """
+
+    __slots__ = ('type', 'content', 'panel', 'language', 'format', 'role') + FLAG_FIELDS
+
+    def __init__(self, type: str, content: Any = '', panel: str = 'chat', language: str = '',
+                 format: str = '', role: str = '', is_new_block: bool = False, is_end: bool = False,
+                 thinking: bool = False, skip_chat: bool = False, new_message: bool = False):
+        self.type = type
+        self.content = content
+        self.panel = panel
+        self.language = language
+        self.format = format
+        self.role = role
+        self.is_new_block = is_new_block
+        self.is_end = is_end
+        self.thinking = thinking
+        self.skip_chat = skip_chat
+        self.new_message = new_message
+        self.new_ui_element = False
+        self.code_block_completed = False
+        self.new_message_after_code = False
+
+    def get(self, key: str, default: Any = None) -> Any:
+        """dict.get() equivalent"""
+        return getattr(self, key, default)
+
+    def __getitem__(self, key: str) -> Any:
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key)
+
+    def __setitem__(self, key: str, value: Any):
+        setattr(self, key, value)
+
+    def copy(self) -> "StreamChunk":
+        """Shallow copy"""
+        clone = StreamChunk.__new__(StreamChunk)
+        for name in self.__slots__:
+            setattr(clone, name, getattr(self, name))
+        return clone
+
+    def to_dict(self) -> Dict[str, Any]:
+        """The chunk as a plain dict, with the same fields as the wire payload"""
+        data = {'type': self.type, 'panel': self.panel, 'content': self.content}
+        if self.language:
+            data['language'] = self.language
+        if self.format:
+            data['format'] = self.format
+        if self.role:
+            data['role'] = self.role
+        for name in FLAG_FIELDS:
+            if getattr(self, name):
+                data[name] = True
+        return data
+
+    def to_json(self) -> str:
+        """Serialize directly to the SSE JSON payload without building a dict"""
+        parts = [
+            '{"type":', _encode_value(self.type),
+            ',"panel":', _encode_value(self.panel),
+            ',"content":', _encode_value(self.content),
+        ]
+        if self.language:
+            parts.append(',"language":')
+            parts.append(_encode_value(self.language))
+        if self.format:
+            parts.append(',"format":')
+            parts.append(_encode_value(self.format))
+        if self.role:
+            parts.append(',"role":')
+            parts.append(_encode_value(self.role))
+        for name in FLAG_FIELDS:
+            if getattr(self, name):
+                parts.append(_FLAG_JSON[name])
+        parts.append('}')
+        return ''.join(parts)
+
+    def __repr__(self):
+        return f"StreamChunk({self.to_dict()!r})"
+
+
+class ChunkTranslator:
+    """
+    Translate raw interpreter chunks into StreamChunks for one generation
+
+    Keeps the cross-chunk state needed to mark the first message after a
+    completed code execution, and lexes message text as one stream, so
+    thinking tags and code fences are found even when split across chunks.
+    """
+
+    def __init__(self):
+        self.had_code_execution = False
+        self.code_execution_ended = False
+        self.lexer = StreamLexer()
+        # Whether message text is currently inside <think> ... </think>
+        self.thinking = False
+
+    def translate(self, chunk: Any) -> List[StreamChunk]:
+        """
+        Translate one chunk from interpreter.chat(stream=True)
+
+        Message text is split at thinking tags and code fences, which become
+        thinking_start/thinking_end and fence_open/fence_close chunks. Text
+        that may be the start of a tag is held back until the next chunk.
+
+        Args:
+            chunk: A dict, a (possibly JSON) string, or anything else the interpreter yields
+
+        Returns:
+            The UI-ready chunks, in order (possibly none)
+        """
+        if chunk.__class__ is dict:
+            result = self._translate_dict(chunk)
+        elif isinstance(chunk, str):
+            result = self._translate_str(chunk)
+        elif isinstance(chunk, dict):
+            result = self._translate_dict(chunk)
+        else:
+            return [StreamChunk('error', f"Unknown chunk type: {type(chunk)}")]
+
+        if result.type == 'message' and result.content.__class__ is str:
+            results = self._lex(result)
+        elif self.lexer.held:
+            # Text held back from an unfinished message goes out before whatever follows it
+            results = self._chunks(self.lexer.flush(), StreamChunk('message')) + [result]
+        else:
+            results = [result]
+        for item in results:
+            self._track(item)
+        return results
+
+    def _translate_dict(self, chunk: Dict[str, Any]) -> StreamChunk:
+        """Translate a structured interpreter chunk via the table"""
+        role = chunk.get('role', 'assistant')
+        chunk_type = chunk.get('type', 'message')
+        content = chunk.get('content', '')
+        format_type = chunk.get('format', '')
+        is_start = bool(chunk.get('start', False))
+        is_end = bool(chunk.get('end', False))
+
+        rule = TRANSLATION_TABLE.get((role, chunk_type, format_type)) or TRANSLATION_TABLE.get((role, chunk_type, None))
+        if rule is not None:
+            wire_type, panel, skip_chat, format_as = rule
+            result = StreamChunk(wire_type, content, panel, is_new_block=is_start, is_end=is_end,
+                                 skip_chat=skip_chat, new_message=is_start and panel != 'output')
+            if format_as == 'language':
+                result.language = format_type or chunk.get('language', '')
+            elif format_as == 'format':
+                result.format = format_type
+            return result
+
+        # Default handling for other types
+        print(f"DEBUG: Unknown chunk format - role: {role}, type: {chunk_type}", file=sys.stderr)
+        panel = PANEL_BY_TYPE.get(chunk_type, 'chat')
+        return StreamChunk(chunk_type, content, panel, format=format_type, role=role,
+                           is_new_block=is_start, is_end=is_end, thinking=self.thinking,
+                           skip_chat=chunk_type in PANEL_BY_TYPE,
+                           new_message=is_start and panel != 'output')
+
+    def _translate_str(self, chunk: str) -> StreamChunk:
+        """Translate a string chunk, which may itself be JSON"""
+        try:
+            parsed = json.loads(chunk)
+        except json.JSONDecodeError:
+            parsed = None
+
+        if isinstance(parsed, dict):
+            chunk_type = parsed.get('type', 'message')
+            content = parsed.get('content', chunk)
+            language = parsed.get('language', '')
+        else:
+            # If not valid JSON, treat as plain text message
+            chunk_type, content, language = 'message', chunk, ''
+
+        panel = PANEL_BY_TYPE.get(chunk_type, 'chat')
+        return StreamChunk(chunk_type, content, panel, language=language,
+                           thinking=self.thinking and chunk_type != 'message',
+                           skip_chat=chunk_type in PANEL_BY_TYPE)
+
+    def _lex(self, message: StreamChunk) -> List[StreamChunk]:
+        """Split a message chunk's text at thinking tags and code fences"""
+        results = []
+        if message.is_new_block:
+            # Fences don't carry over from one message to the next
+            if self.lexer.held:
+                results = self._chunks(self.lexer.flush(), StreamChunk('message'))
+            self.lexer.reset()
+        events = self.lexer.feed(message.content)
+        if message.is_end:
+            events += self.lexer.flush()
+        return results + self._chunks(events, message)
+
+    def _chunks(self, events: List[Tuple[str, str]], message: StreamChunk) -> List[StreamChunk]:
+        """
+        StreamChunks for lexer events
+
+        Text becomes copies of the message chunk. Its start flags go on the
+        first chunk and its end flag on the last one, with an empty message
+        chunk carrying them if no text is in the right place.
+        """
+        if len(events) == 1 and events[0][0] == 'text':
+            # Plain text, by far the most common case: the message chunk itself
+            message.content = events[0][1]
+            message.thinking = self.thinking
+            return [message]
+        results = []
+        starts = message.is_new_block or message.new_message
+        if starts and (not events or events[0][0] != 'text'):
+            results.append(self._text(message, '', True))
+            starts = False
+        for kind, value in events:
+            if kind == 'text':
+                if value:
+                    results.append(self._text(message, value, starts))
+                    starts = False
+            elif kind == 'fence_open':
+                results.append(StreamChunk('fence_open', '', language=value, thinking=self.thinking, skip_chat=True))
+            elif kind == 'fence_close':
+                results.append(StreamChunk('fence_close', '', thinking=self.thinking, skip_chat=True))
+            else:
+                self.thinking = kind == 'thinking_start'
+                results.append(StreamChunk(kind, thinking=True))
+        if message.is_end:
+            if results and results[-1].type == 'message':
+                results[-1].is_end = True
+            else:
+                end = self._text(message, '', False)
+                end.is_end = True
+                results.append(end)
+        return results
+
+    def _text(self, message: StreamChunk, text: str, starts: bool) -> StreamChunk:
+        """A copy of a message chunk with some of its text, keeping its start flags if it starts the message"""
+        result = message.copy()
+        result.content = text
+        result.thinking = self.thinking
+        result.is_end = False
+        if not starts:
+            result.is_new_block = False
+            result.new_message = False
+        return result
+
+    def _track(self, chunk: StreamChunk):
+        """Set the flags that depend on earlier chunks in the stream"""
+        chunk_type = chunk.type
+        if chunk_type == 'code':
+            if chunk.is_new_block:
+                self.had_code_execution = True
+                self.code_execution_ended = False
+                # Make sure this is marked as a new element for the UI
+                chunk.new_ui_element = True
+            if chunk.is_end:
+                chunk.code_block_completed = True
+        elif chunk_type == 'output':
+            # End of output indicates the end of code execution
+            if chunk.is_end:
+                self.code_execution_ended = True
+        elif chunk_type == 'message':
+            # Only a truly new message after complete code execution (end of code + end of output)
+            if self.had_code_execution and self.code_execution_ended:
+                chunk.new_message_after_code = True
+                self.had_code_execution = False
+                self.code_execution_ended = False
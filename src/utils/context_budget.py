@@ -0,0 +1,435 @@
+"""
+Token-budgeted context for the interpreter's model requests
+
+Open Interpreter sends the whole of ``interpreter.messages`` to the model on
+every request, so a long session resends an ever-growing history, bulky
+console output included, and time to first token and cost grow with it.
+
+Each interpreter gets a TokenLedger: a token count per message, cached and
+indexed by position, so only messages that were appended or changed since
+the last request are counted and the total follows appends and truncations
+incrementally. Before each model request the manager applies its policy to
+a copy of the messages (the stored history is never changed). Each
+interpreter has its own ContextPolicy, starting from the manager's defaults,
+so changing one session's policy leaves the others alone:
+
+1. The middle of any huge output is elided, keeping its head and tail.
+2. If the context is still over budget, output from older turns is dropped.
+3. With the ``summarize`` policy, older turns are then replaced by a model
+   written summary, cached and extended as the conversation grows.
+4. As a last resort the oldest turns are left out, never the current one.
+
+The budget is the model's context window minus its max_tokens.
+"""
+import sys
+import threading
+import weakref
+from contextlib import nullcontext
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+from .upstream import UpstreamClient
+
+POLICIES = ('off', 'trim', 'summarize')
+
+SUMMARY_PROMPT = """You compress the earlier part of a conversation between a user and an AI assistant that runs code on the user's computer.
+Write a concise summary that keeps every fact, decision, file name, path, value and open task needed to continue the conversation.
+Mention what code was run and what it showed, but not the output itself. If a previous summary is given, fold it into the new one."""
+
+# Flat charge for an image, whose content is base64 rather than tokens
+_IMAGE_TOKENS = 1000
+# Per-message overhead of the chat format
+_MESSAGE_TOKENS = 4
+# Longest transcript sent to the summarizer, in characters
+_SUMMARY_INPUT_CHARS = 48000
+
+_OMITTED_OUTPUT = "[Output omitted to fit the context window]"
+_LEFT_OUT = "[{} earlier messages were left out to fit the context window]"
+
+_encoding = None
+
+
+def count_tokens(text: str) -> int:
+    """Tokens in a text, with tiktoken's cl100k_base if installed, else about four characters a token"""
+    global _encoding
+    if tiktoken is not None:
+        if _encoding is None:
+            _encoding = tiktoken.get_encoding('cl100k_base')
+        return len(_encoding.encode(text, disallowed_special=()))
+    return (len(text) + 3) // 4
+
+
+def message_tokens(message: Dict[str, Any]) -> int:
+    """Tokens a message takes up in a model request"""
+    if message.get('type') == 'image':
+        return _IMAGE_TOKENS
+    content = message.get('content')
+    if not isinstance(content, str):
+        content = '' if content is None else str(content)
+    return count_tokens(content) + _MESSAGE_TOKENS
+
+
+def _key(message: Dict[str, Any]) -> tuple:
+    """What a cached count depends on; strings compare by identity first, so this is cheap"""
+    return message.get('role'), message.get('type'), message.get('format'), message.get('content')
+
+
+def _is_output(message: Dict[str, Any]) -> bool:
+    """Console output and images produced by running code"""
+    return message.get('role') == 'computer'
+
+
+class TokenLedger:
+    """
+    Cached token counts of one interpreter's messages, by position
+
+    ``sync()`` keeps the counts of the longest unchanged prefix and counts
+    only what comes after it, so a request that follows an append costs one
+    count per new message, and a truncation costs nothing.
+    """
+
+    def __init__(self):
+        self._keys: List[tuple] = []
+        self._counts: List[int] = []
+        self.total = 0
+        self._lock = threading.Lock()
+
+    def sync(self, messages: Sequence[Dict[str, Any]]) -> List[int]:
+        """
+        Bring the ledger up to date with a list of messages
+
+        Returns:
+            The token count of each message
+        """
+        with self._lock:
+            keys = self._keys
+            keep = min(len(keys), len(messages))
+            for index in range(keep):
+                if keys[index] != _key(messages[index]):
+                    keep = index
+                    break
+            if keep < len(keys):
+                self.total -= sum(self._counts[keep:])
+                del keys[keep:]
+                del self._counts[keep:]
+            for message in messages[keep:]:
+                count = message_tokens(message)
+                keys.append(_key(message))
+                self._counts.append(count)
+                self.total += count
+            return list(self._counts)
+
+    def __len__(self) -> int:
+        return len(self._counts)
+
+
+class ContextPolicy:
+    """
+    How one interpreter's requests are fitted into the context window
+
+    Args:
+        policy: ``off``, ``trim`` (elide and drop output, then drop old turns)
+            or ``summarize`` (trim, but summarize old turns before dropping them)
+        elide_tokens: Outputs longer than this keep only this many tokens, half from each end
+        keep_turns: Most recent turns (from a user message on) left whole when trimming
+
+    Raises:
+        ValueError: If the policy isn't one of POLICIES or a number is negative
+    """
+
+    __slots__ = ('policy', 'elide_tokens', 'keep_turns')
+
+    def __init__(self, policy: str = 'trim', elide_tokens: int = 2000, keep_turns: int = 2):
+        self.policy = 'trim'
+        self.elide_tokens = 0
+        self.keep_turns = 0
+        self.configure(policy, elide_tokens, keep_turns)
+
+    def configure(self, policy: Optional[str] = None, elide_tokens: Optional[int] = None,
+                  keep_turns: Optional[int] = None):
+        """
+        Change the policy; None leaves a setting as it is
+
+        Raises:
+            ValueError: If the policy isn't one of POLICIES or a number is negative
+        """
+        if policy is not None and policy not in POLICIES:
+            raise ValueError(f"Unknown context policy: {policy} (expected one of {', '.join(POLICIES)})")
+        if (elide_tokens is not None and elide_tokens < 0) or (keep_turns is not None and keep_turns < 0):
+            raise ValueError("Context settings can't be negative")
+        if policy is not None:
+            self.policy = policy
+        if elide_tokens is not None:
+            self.elide_tokens = elide_tokens
+        if keep_turns is not None:
+            self.keep_turns = keep_turns
+
+    def copy(self) -> 'ContextPolicy':
+        """An independent policy with the same settings"""
+        return ContextPolicy(self.policy, self.elide_tokens, self.keep_turns)
+
+    @property
+    def settings(self) -> Dict[str, Any]:
+        """The policy, as exposed in /settings"""
+        return {
+            "context_policy": self.policy,
+            "context_elide_tokens": self.elide_tokens,
+            "context_keep_turns": self.keep_turns,
+        }
+
+
+class ContextManager:
+    """
+    Applies each attached interpreter's context policy to its model requests
+
+    Args:
+        policy: Default policy of newly attached interpreters (see ContextPolicy)
+        elide_tokens: Default output elision threshold
+        keep_turns: Default number of recent turns left whole
+        get_client: Returns the OpenAI client used for summaries
+        summary_model: Chat model that writes summaries
+        upstream: Optional upstream whose circuit breaker and stats cover the summary calls
+    """
+
+    def __init__(self, policy: str = 'trim', elide_tokens: int = 2000, keep_turns: int = 2,
+                 get_client: Optional[Callable[[], Any]] = None, summary_model: str = 'gpt-4o-mini',
+                 upstream: Optional[UpstreamClient] = None):
+        self.defaults = ContextPolicy(policy, elide_tokens, keep_turns)
+        self.get_client = get_client
+        self.summary_model = summary_model
+        self.upstream = upstream
+        self._ledgers: "weakref.WeakKeyDictionary[Any, TokenLedger]" = weakref.WeakKeyDictionary()
+        self._policies: "weakref.WeakKeyDictionary[Any, ContextPolicy]" = weakref.WeakKeyDictionary()
+        # Ledger -> (messages covered, summary) of its latest summary
+        self._summaries: "weakref.WeakKeyDictionary[TokenLedger, Tuple[List[tuple], str]]" = \
+            weakref.WeakKeyDictionary()
+        self._lock = threading.Lock()
+
+        # Stats
+        self.requests = 0
+        self.compacted = 0
+        self.tokens_saved = 0
+        self.summaries = 0
+        self.summary_failures = 0
+
+    def configure(self, policy: Optional[str] = None, elide_tokens: Optional[int] = None,
+                  keep_turns: Optional[int] = None):
+        """
+        Change the defaults of interpreters attached from now on; None leaves a setting as it is
+
+        Raises:
+            ValueError: If the policy isn't one of POLICIES or a number is negative
+        """
+        self.defaults.configure(policy, elide_tokens, keep_turns)
+
+    def attach(self, interpreter: Any):
+        """
+        Budget every model request the interpreter makes
+
+        Wraps ``interpreter.llm.run``, which Open Interpreter calls with the
+        messages of each request, including the requests after code runs.
+        """
+        llm = getattr(interpreter, 'llm', None)
+        run = getattr(llm, 'run', None)
+        if run is None:
+            print("[Context] This interpreter has no llm.run to budget, context policy disabled", file=sys.stderr)
+            return
+        ledger = TokenLedger()
+        policy = self.defaults.copy()
+        self._ledgers[interpreter] = ledger
+        self._policies[interpreter] = policy
+
+        def budgeted_run(messages, *args, **kwargs):
+            return run(self.compact(messages, ledger, self.budget(llm), policy), *args, **kwargs)
+
+        llm.run = budgeted_run
+
+    def ledger(self, interpreter: Any) -> Optional[TokenLedger]:
+        """The interpreter's ledger, if it is attached"""
+        return self._ledgers.get(interpreter)
+
+    def policy(self, interpreter: Any) -> Optional[ContextPolicy]:
+        """The interpreter's own policy, if it is attached; changing it affects only that interpreter"""
+        return self._policies.get(interpreter)
+
+    @staticmethod
+    def budget(llm: Any) -> Optional[int]:
+        """Tokens the request may use: the context window minus the reply's max tokens, None if unknown"""
+        context_window = getattr(llm, 'context_window', None)
+        if not context_window:
+            return None
+        return max(0, int(context_window) - int(getattr(llm, 'max_tokens', None) or 0))
+
+    def compact(self, messages: List[Dict[str, Any]], ledger: TokenLedger, budget: Optional[int],
+                policy: Optional[ContextPolicy] = None) -> List[Dict[str, Any]]:
+        """
+        The messages to send, with the policy applied
+
+        Args:
+            messages: The request's messages; they and their dicts are left unchanged
+            ledger: The interpreter's token ledger
+            budget: Tokens the messages may use (None for no limit)
+            policy: The interpreter's policy (defaults to the manager's defaults)
+
+        Returns:
+            The messages to send instead (the same list if nothing had to change)
+        """
+        with self._lock:
+            self.requests += 1
+        policy = policy or self.defaults
+        if policy.policy == 'off':
+            return messages
+        counts = ledger.sync(messages)
+        original = ledger.total
+        out = list(messages)
+        changed = False
+
+        # Huge outputs lose their middle wherever they are
+        if policy.elide_tokens:
+            for index, message in enumerate(out):
+                if _is_output(message) and message.get('type') != 'image' and counts[index] > policy.elide_tokens:
+                    out[index], counts[index] = self._elide(message, counts[index], policy.elide_tokens)
+                    changed = True
+
+        if budget is not None and sum(counts) > budget:
+            first, protected = self._turns(out, policy.keep_turns)
+
+            # Then output of older turns goes
+            for index in range(first, protected):
+                if _is_output(out[index]):
+                    out[index] = {"role": "computer", "type": "console", "format": "output",
+                                  "content": _OMITTED_OUTPUT}
+                    counts[index] = message_tokens(out[index])
+                    changed = True
+
+            if sum(counts) > budget and protected > first:
+                out, counts = self._shorten(out, counts, ledger, first, protected, budget, policy.policy)
+                changed = True
+
+        if not changed:
+            return messages
+        with self._lock:
+            self.compacted += 1
+            self.tokens_saved += max(0, original - sum(counts))
+        return out
+
+    @property
+    def stats(self) -> Dict[str, Any]:
+        """Policy and compaction counters"""
+        with self._lock:
+            return dict(self.defaults.settings, **{
+                "requests": self.requests,
+                "compacted": self.compacted,
+                "tokens_saved": self.tokens_saved,
+                "summaries": self.summaries,
+                "summary_failures": self.summary_failures,
+                "ledgers": len(self._ledgers),
+                "tracked_tokens": sum(ledger.total for ledger in list(self._ledgers.values())),
+            })
+
+    @staticmethod
+    def _elide(message: Dict[str, Any], count: int, elide_tokens: int) -> Tuple[Dict[str, Any], int]:
+        """A copy of an output message with its middle cut out, and its estimated token count"""
+        content = message.get('content') or ''
+        # Cut by characters in proportion, rather than re-tokenizing the whole output
+        keep = max(1, len(content) * elide_tokens // (2 * count))
+        elided = count - elide_tokens
+        text = f"{content[:keep]}\n[... {elided} tokens of output elided ...]\n{content[-keep:]}"
+        return dict(message, content=text), elide_tokens + _MESSAGE_TOKENS + 12
+
+    @staticmethod
+    def _turns(messages: List[Dict[str, Any]], keep_turns: int) -> Tuple[int, int]:
+        """
+        The range of old turns that may be compacted
+
+        Returns:
+            (index after the leading system messages, start of the turns kept whole)
+        """
+        first = 0
+        while first < len(messages) and messages[first].get('role') == 'system':
+            first += 1
+        starts = [index for index in range(first, len(messages)) if messages[index].get('role') == 'user']
+        # The current turn is always kept, whatever keep_turns says
+        kept = starts[-max(1, keep_turns):] if starts else []
+        protected = kept[0] if kept else len(messages)
+        return first, max(first, protected)
+
+    def _shorten(self, out: List[Dict[str, Any]], counts: List[int], ledger: TokenLedger,
+                 first: int, protected: int, budget: int, policy: str) -> Tuple[List[Dict[str, Any]], List[int]]:
+        """Summarize (if the policy says so) or leave out old turns until the messages fit"""
+        head, head_counts = out[:first], counts[:first]
+        old, old_counts = out[first:protected], counts[first:protected]
+        tail, tail_counts = out[protected:], counts[protected:]
+
+        if policy == 'summarize':
+            summary = self._summary(ledger, old)
+            if summary is not None:
+                note = {"role": "user", "type": "message",
+                        "content": f"Summary of the earlier conversation:\n{summary}"}
+                old, old_counts = [note], [message_tokens(note)]
+                if sum(head_counts) + old_counts[0] + sum(tail_counts) <= budget:
+                    return head + old + tail, head_counts + old_counts + tail_counts
+
+        # Leave out whole turns, oldest first, until the rest fits (with room for the note saying so)
+        note = {"role": "user", "type": "message", "content": _LEFT_OUT.format(len(old))}
+        available = budget - sum(head_counts) - sum(tail_counts) - message_tokens(note)
+        kept = len(old)
+        used = 0
+        while kept > 0 and used + old_counts[kept - 1] <= available:
+            kept -= 1
+            used += old_counts[kept]
+        # Start at a turn, so no reply is left without its question
+        while kept < len(old) and old[kept].get('role') != 'user':
+            kept += 1
+        if kept:
+            note['content'] = _LEFT_OUT.format(kept)
+            old, old_counts = [note] + old[kept:], [message_tokens(note)] + old_counts[kept:]
+        return head + old + tail, head_counts + old_counts + tail_counts
+
+    def _summary(self, ledger: TokenLedger, messages: List[Dict[str, Any]]) -> Optional[str]:
+        """A summary of old messages, extending the ledger's previous summary when it covers a prefix of them"""
+        if self.get_client is None:
+            return None
+        keys = [_key(message) for message in messages]
+        previous = self._summaries.get(ledger)
+        if previous is not None:
+            covered, summary = previous
+            if covered == keys:
+                return summary
+            if covered != keys[:len(covered)]:
+                previous = None
+        start = len(previous[0]) if previous is not None else 0
+        transcript = '\n\n'.join(f"{message.get('role')} ({message.get('type')}): {message.get('content')}"
+                                 for message in messages[start:] if message.get('type') != 'image')
+        prompt = transcript[-_SUMMARY_INPUT_CHARS:]
+        if previous is not None:
+            prompt = f"Previous summary:\n{previous[1]}\n\nConversation since:\n{prompt}"
+        try:
+            client = self.get_client()
+            with self.upstream.guard() if self.upstream is not None else nullcontext():
+                response = client.chat.completions.create(
+                    model=self.summary_model,
+                    messages=[
+                        {"role": "system", "content": SUMMARY_PROMPT},
+                        {"role": "user", "content": prompt},
+                    ],
+                    temperature=0.2,
+                    max_tokens=800
+                )
+            summary = (response.choices[0].message.content or '').strip()
+        except Exception as e:
+            with self._lock:
+                self.summary_failures += 1
+            print(f"[Context] Summary failed, leaving out old turns instead: {str(e)}", file=sys.stderr)
+            return None
+        if not summary:
+            return None
+        self._summaries[ledger] = (keys, summary)
+        with self._lock:
+            self.summaries += 1
+        print(f"[Context] Summarized {len(messages)} earlier messages", file=sys.stderr)
+        return summary
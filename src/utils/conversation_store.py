@@ -0,0 +1,268 @@
+"""
+Durable conversation storage in SQLite
+
+Every message of a conversation is one row keyed by (conversation id,
+position), so saving after each completed block writes only the messages
+that changed, and loading a conversation is one indexed range read. A
+restarted server, or a session that was evicted from memory, picks its
+conversation back up from here instead of starting empty.
+
+Conversations are stored under the session id the browser sends, which
+is the secret that lets a client continue a conversation, so it is never
+listed. Each conversation also has a random public id, used to list, load
+and delete it, and an owner: a hash of the client that created it. Only the
+owner can list or load its conversations.
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import sys
+import threading
+import time
+import uuid
+from typing import Any, Dict, List, Optional
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS conversations (
+    id TEXT PRIMARY KEY,
+    title TEXT,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL,
+    message_count INTEGER NOT NULL DEFAULT 0,
+    public_id TEXT,
+    owner TEXT
+);
+CREATE TABLE IF NOT EXISTS messages (
+    conversation_id TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    role TEXT,
+    type TEXT,
+    data TEXT NOT NULL,
+    PRIMARY KEY (conversation_id, position)
+) WITHOUT ROWID;
+"""
+
+# Added after the first release; databases created before get them on open
+_ADDED_COLUMNS = (('public_id', 'TEXT'), ('owner', 'TEXT'))
+
+_INDEXES = """
+CREATE INDEX IF NOT EXISTS conversations_updated ON conversations (updated_at);
+CREATE UNIQUE INDEX IF NOT EXISTS conversations_public_id ON conversations (public_id);
+CREATE INDEX IF NOT EXISTS conversations_owner ON conversations (owner, updated_at);
+"""
+
+# Characters of the first user message used as a conversation's title
+_TITLE_CHARS = 80
+
+
+def _title_of(messages: List[Dict[str, Any]]) -> Optional[str]:
+    """Title for a conversation: the start of its first user message"""
+    for message in messages:
+        if message.get('role') == 'user' and isinstance(message.get('content'), str):
+            return ' '.join(message['content'].split())[:_TITLE_CHARS] or None
+    return None
+
+
+def owner_key(client_id: str) -> str:
+    """Owner of the conversations a client creates: a hash, so the client's own id isn't stored"""
+    return hashlib.sha256(client_id.encode('utf-8')).hexdigest()
+
+
+class ConversationStore:
+    """
+    SQLite-backed message store, one row per message
+
+    Args:
+        path: Database file (``:memory:`` keeps it in memory, e.g. for a throwaway server)
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        if path != ':memory:':
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        # With WAL, NORMAL only risks the last commits on power loss, never corruption
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.executescript(_SCHEMA)
+        self._migrate()
+        self._lock = threading.Lock()
+
+        # Stats
+        self.saved_messages = 0
+        self.loads = 0
+        print(f"[Conversations] Storing conversations in {path}", file=sys.stderr)
+
+    def save(self, conversation_id: str, messages: List[Dict[str, Any]], start: int = 0,
+             owner: Optional[str] = None):
+        """
+        Store a conversation's messages from ``start`` onwards
+
+        Messages before ``start`` are assumed to be stored already; rows at
+        or after it are replaced, so a conversation that was cut short and
+        continued differently is stored correctly.
+
+        Args:
+            conversation_id: The conversation (session) id
+            messages: All of the conversation's messages
+            start: Index of the first message that may have changed
+            owner: owner_key() of the client, recorded the first time it is known
+        """
+        start = max(0, min(start, len(messages)))
+        rows = [(conversation_id, position, message.get('role'), message.get('type'),
+                 json.dumps(message, default=str))
+                for position, message in enumerate(messages[start:], start)]
+        now = time.time()
+        with self._lock:
+            self._db.execute('BEGIN IMMEDIATE')
+            try:
+                self._db.execute(
+                    'INSERT INTO conversations (id, title, created_at, updated_at, message_count, public_id, owner) '
+                    'VALUES (?, ?, ?, ?, ?, ?, ?) ON CONFLICT(id) DO UPDATE SET '
+                    'title = COALESCE(conversations.title, excluded.title), '
+                    'updated_at = excluded.updated_at, message_count = excluded.message_count, '
+                    'owner = COALESCE(conversations.owner, excluded.owner)',
+                    (conversation_id, _title_of(messages), now, now, len(messages), uuid.uuid4().hex, owner))
+                self._db.execute('DELETE FROM messages WHERE conversation_id = ? AND position >= ?',
+                                 (conversation_id, start))
+                self._db.executemany('INSERT INTO messages VALUES (?, ?, ?, ?, ?)', rows)
+                self._db.execute('COMMIT')
+            except BaseException:
+                self._db.execute('ROLLBACK')
+                raise
+            self.saved_messages += len(rows)
+
+    def truncate(self, conversation_id: str, length: int):
+        """Drop the messages at and after ``length`` (e.g. when the conversation is reset)"""
+        with self._lock:
+            self._db.execute('BEGIN IMMEDIATE')
+            try:
+                self._db.execute('DELETE FROM messages WHERE conversation_id = ? AND position >= ?',
+                                 (conversation_id, length))
+                self._db.execute('UPDATE conversations SET message_count = MIN(message_count, ?), updated_at = ? '
+                                 'WHERE id = ?', (length, time.time(), conversation_id))
+                if length == 0:
+                    self._db.execute('UPDATE conversations SET title = NULL WHERE id = ?', (conversation_id,))
+                self._db.execute('COMMIT')
+            except BaseException:
+                self._db.execute('ROLLBACK')
+                raise
+
+    def load(self, conversation_id: str, start: int = 0,
+             limit: Optional[int] = None) -> Optional[List[Dict[str, Any]]]:
+        """
+        A conversation's messages in order, or a range of them
+
+        Args:
+            conversation_id: The conversation id
+            start: Index of the first message
+            limit: Most messages returned (all if None)
+
+        Returns:
+            The messages, or None if the conversation isn't stored
+        """
+        with self._lock:
+            self.loads += 1
+            if self._db.execute('SELECT 1 FROM conversations WHERE id = ?', (conversation_id,)).fetchone() is None:
+                return None
+            rows = self._db.execute(
+                'SELECT data FROM messages WHERE conversation_id = ? AND position >= ? ORDER BY position LIMIT ?',
+                (conversation_id, start, -1 if limit is None else limit)).fetchall()
+        return [json.loads(data) for data, in rows]
+
+    def find(self, public_id: str, owner: str) -> Optional[str]:
+        """
+        The session id a conversation is stored under
+
+        Args:
+            public_id: The conversation's public id
+            owner: owner_key() of the client asking
+
+        Returns:
+            The session id, or None if there is no such conversation or it belongs to another client
+        """
+        with self._lock:
+            row = self._db.execute('SELECT id FROM conversations WHERE public_id = ? AND owner = ?',
+                                   (public_id, owner)).fetchone()
+        return row[0] if row else None
+
+    def summary(self, conversation_id: str) -> Optional[Dict[str, Any]]:
+        """A conversation's public id, title, timestamps and message count, or None if it isn't stored"""
+        summaries = self._summaries('WHERE id = ?', (conversation_id,))
+        return summaries[0] if summaries else None
+
+    def get(self, conversation_id: str) -> Optional[Dict[str, Any]]:
+        """A conversation's summary and messages, or None if it isn't stored"""
+        conversation = self.summary(conversation_id)
+        if conversation is None:
+            return None
+        conversation['messages'] = self.load(conversation_id) or []
+        return conversation
+
+    def list(self, owner: str, limit: int = 50, before: Optional[float] = None) -> List[Dict[str, Any]]:
+        """
+        Summaries of a client's stored conversations, most recently updated first
+
+        Args:
+            owner: owner_key() of the client
+            limit: Most conversations returned
+            before: Only conversations last updated before this time (for paging)
+        """
+        if before is None:
+            return self._summaries('WHERE owner = ? AND message_count > 0 ORDER BY updated_at DESC LIMIT ?',
+                                   (owner, limit))
+        return self._summaries('WHERE owner = ? AND message_count > 0 AND updated_at < ? '
+                               'ORDER BY updated_at DESC LIMIT ?', (owner, before, limit))
+
+    def delete(self, conversation_id: str) -> bool:
+        """
+        Remove a conversation and its messages
+
+        Returns:
+            True if it existed
+        """
+        with self._lock:
+            self._db.execute('BEGIN IMMEDIATE')
+            try:
+                self._db.execute('DELETE FROM messages WHERE conversation_id = ?', (conversation_id,))
+                deleted = self._db.execute('DELETE FROM conversations WHERE id = ?', (conversation_id,)).rowcount
+                self._db.execute('COMMIT')
+            except BaseException:
+                self._db.execute('ROLLBACK')
+                raise
+        return deleted > 0
+
+    @property
+    def stats(self) -> Dict[str, Any]:
+        """Stored conversations and write/read counters"""
+        with self._lock:
+            conversations, = self._db.execute('SELECT COUNT(*) FROM conversations').fetchone()
+            return {
+                "conversations": conversations,
+                "saved_messages": self.saved_messages,
+                "loads": self.loads,
+            }
+
+    def _summaries(self, clause: str, params: tuple) -> List[Dict[str, Any]]:
+        with self._lock:
+            rows = self._db.execute(
+                f'SELECT public_id, title, created_at, updated_at, message_count FROM conversations {clause}',
+                params).fetchall()
+        return [{
+            "id": public_id,
+            "title": title,
+            "created_at": created_at,
+            "updated_at": updated_at,
+            "message_count": message_count,
+        } for public_id, title, created_at, updated_at, message_count in rows]
+
+    def _migrate(self):
+        """Add the columns and indexes of newer versions to an existing database"""
+        columns = {row[1] for row in self._db.execute('PRAGMA table_info(conversations)')}
+        for name, column_type in _ADDED_COLUMNS:
+            if name not in columns:
+                self._db.execute(f'ALTER TABLE conversations ADD COLUMN {name} {column_type}')
+        # Older conversations get a public id; they have no owner until their session saves again
+        self._db.execute('UPDATE conversations SET public_id = lower(hex(randomblob(16))) WHERE public_id IS NULL')
+        self._db.executescript(_INDEXES)
@@ -0,0 +1,255 @@
+"""
+Branching conversations as a persistent tree of messages
+
+Editing or regenerating a message used to slice the interpreter's message
+list and throw the rest away, so going back to an earlier answer meant
+asking the model again. Every message is now a node with a parent pointer,
+and each branch shares its common prefix with its siblings instead of
+copying it. The interpreter's ``messages`` list is only the active path
+through the tree:
+
+- forking at an index moves the active leaf to that node, which is O(1)
+  in the tree; the interpreter's list is truncated in place
+- the abandoned messages stay in the tree as a sibling branch
+- switching to another branch rewrites the list from the first message the
+  two branches don't share, with no model call
+
+Messages the interpreter appends are picked up lazily by ``sync()``. Once
+a message has a successor it is treated as immutable, so sharing it
+between branches is safe.
+"""
+import itertools
+import threading
+from typing import Any, Dict, List, Optional
+
+# Characters of a message shown in a branch listing
+_PREVIEW_CHARS = 80
+
+
+def turn_start(messages: List[Dict[str, Any]], turn: int) -> int:
+    """
+    Index of the user message that starts a turn
+
+    Args:
+        messages: The conversation's messages
+        turn: The turn, counting user messages from 0
+
+    Returns:
+        The message's index, or len(messages) if the conversation has fewer turns
+    """
+    seen = 0
+    for index, message in enumerate(messages):
+        if message.get('role') == 'user':
+            if seen == turn:
+                return index
+            seen += 1
+    return len(messages)
+
+
+class MessageNode:
+    """One message in the tree"""
+
+    __slots__ = ('id', 'message', 'parent', 'depth', 'children', 'active_child')
+
+    def __init__(self, node_id: int, message: Optional[Dict[str, Any]], parent: Optional['MessageNode']):
+        self.id = node_id
+        self.message = message
+        self.parent = parent
+        # Index of the message in any path through it
+        self.depth = parent.depth + 1 if parent is not None else -1
+        self.children: List['MessageNode'] = []
+        # Child the active path continues through when switching back to this node
+        self.active_child: Optional['MessageNode'] = None
+
+
+class ConversationTree:
+    """
+    The branches of one conversation, with an active path
+
+    All methods take the interpreter's current message list and keep it
+    equal to the active path.
+    """
+
+    def __init__(self):
+        self._ids = itertools.count(1)
+        self._root = MessageNode(0, None, None)
+        self._nodes: Dict[int, MessageNode] = {}
+        # Nodes of the active path, index i holding message i
+        self._path: List[MessageNode] = []
+        self._lock = threading.Lock()
+
+    def sync(self, messages: List[Dict[str, Any]]):
+        """
+        Add messages the interpreter appended to the active path
+
+        Messages removed from the end of the list (e.g. a failed attempt
+        that was rolled back) are dropped from the tree; they were never
+        a branch anyone chose.
+        """
+        with self._lock:
+            self._sync(messages)
+
+    def clear(self):
+        """Forget every branch (the conversation was reset)"""
+        with self._lock:
+            self._root = MessageNode(0, None, None)
+            self._nodes.clear()
+            self._path = []
+
+    def fork(self, messages: List[Dict[str, Any]], index: int) -> int:
+        """
+        Make the active path end at a message, keeping the rest as a branch
+
+        Args:
+            messages: The interpreter's message list, truncated in place
+            index: Index of the last message kept (-1 keeps none)
+
+        Returns:
+            Number of messages left
+        """
+        with self._lock:
+            self._sync(messages)
+            keep = max(0, min(index + 1, len(self._path)))
+            parent = self._path[keep - 1] if keep else self._root
+            # The next message appended starts a new sibling; the old one stays reachable
+            parent.active_child = None
+            del self._path[keep:]
+            del messages[keep:]
+            return keep
+
+    def replace(self, messages: List[Dict[str, Any]], new_messages: List[Dict[str, Any]]) -> int:
+        """
+        Make new_messages the active path, sharing the prefix it has in common with the current one
+
+        Args:
+            messages: The interpreter's message list, rewritten in place
+            new_messages: The messages the conversation should consist of
+
+        Returns:
+            Index of the first message that changed
+        """
+        with self._lock:
+            self._sync(messages)
+            common = 0
+            limit = min(len(self._path), len(new_messages))
+            while common < limit and self._path[common].message == new_messages[common]:
+                common += 1
+            parent = self._path[common - 1] if common else self._root
+            parent.active_child = None
+            del self._path[common:]
+            del messages[common:]
+            messages.extend(new_messages[common:])
+            self._sync(messages)
+            return common
+
+    def switch(self, messages: List[Dict[str, Any]], node_id: int) -> int:
+        """
+        Make the active path run through a node, continuing down its branch's last active messages
+
+        Args:
+            messages: The interpreter's message list, rewritten in place
+            node_id: The node to switch to
+
+        Returns:
+            Index of the first message that changed
+
+        Raises:
+            KeyError: If the node isn't in the tree
+        """
+        with self._lock:
+            self._sync(messages)
+            node = self._nodes[node_id]
+            path = []
+            while node is not self._root:
+                path.append(node)
+                node.parent.active_child = node
+                node = node.parent
+            path.reverse()
+            while path[-1].active_child is not None:
+                path.append(path[-1].active_child)
+
+            common = 0
+            limit = min(len(self._path), len(path))
+            while common < limit and self._path[common] is path[common]:
+                common += 1
+            self._path = path
+            del messages[common:]
+            messages.extend(node.message for node in path[common:])
+            return common
+
+    def branches(self, messages: List[Dict[str, Any]], index: int) -> List[Dict[str, Any]]:
+        """
+        The alternatives for the message at an index of the active path
+
+        Returns:
+            One entry per sibling: {"id", "role", "type", "preview", "active"}
+        """
+        with self._lock:
+            self._sync(messages)
+            if index < 0 or index > len(self._path):
+                return []
+            parent = self._path[index - 1] if index else self._root
+            active = self._path[index] if index < len(self._path) else None
+            return [{
+                "id": child.id,
+                "role": child.message.get('role'),
+                "type": child.message.get('type'),
+                "preview": str(child.message.get('content') or '')[:_PREVIEW_CHARS],
+                "active": child is active,
+            } for child in parent.children]
+
+    def branch_points(self, messages: List[Dict[str, Any]]) -> List[Dict[str, int]]:
+        """
+        Indices of the active path that have alternatives
+
+        Returns:
+            {"index", "count" of alternatives, "active" position among them} for each
+        """
+        with self._lock:
+            self._sync(messages)
+            points = []
+            parent = self._root
+            for index, node in enumerate(self._path):
+                if len(parent.children) > 1:
+                    points.append({"index": index, "count": len(parent.children),
+                                   "active": parent.children.index(node)})
+                parent = node
+            return points
+
+    @property
+    def stats(self) -> Dict[str, int]:
+        """Nodes in the tree and the length of the active path"""
+        with self._lock:
+            return {"nodes": len(self._nodes), "active_path": len(self._path)}
+
+    def _sync(self, messages: List[Dict[str, Any]]):
+        """Bring the active path up to date with the list (caller holds the lock)"""
+        path = self._path
+        shared = min(len(path), len(messages))
+        # Messages are only ever appended to or cut from the end, so checking the last shared one suffices
+        if shared and path[shared - 1].message is not messages[shared - 1]:
+            shared = 0
+            while shared < len(path) and shared < len(messages) and path[shared].message is messages[shared]:
+                shared += 1
+        if shared < len(path):
+            self._detach(path[shared])
+            del path[shared:]
+        parent = path[-1] if path else self._root
+        for message in messages[shared:]:
+            node = MessageNode(next(self._ids), message, parent)
+            self._nodes[node.id] = node
+            parent.children.append(node)
+            parent.active_child = node
+            path.append(node)
+            parent = node
+
+    def _detach(self, node: MessageNode):
+        """Remove a node and everything under it"""
+        node.parent.children.remove(node)
+        if node.parent.active_child is node:
+            node.parent.active_child = None
+        pending = [node]
+        while pending:
+            current = pending.pop()
+            self._nodes.pop(current.id, None)
+            pending.extend(current.children)
@@ -0,0 +1,91 @@
+"""
+Paged, projected views of a conversation's history
+
+/history used to send every message in full on every call, base64 images
+and megabytes of console output included. A client can now ask for only
+the messages after the ones it already has (``since``), a page at a time
+(``limit``), with only some fields (``fields``) and long contents cut to a
+preview (``preview``). Every view carries a strong ETag derived from the
+conversation's version, so re-asking for an unchanged history costs a 304.
+"""
+import hashlib
+from typing import Any, Dict, List, Optional, Sequence
+
+# Most messages returned in one page
+MAX_PAGE = 500
+
+# Message types whose content is binary data (base64) rather than text
+_BINARY_TYPES = ('image', 'audio', 'video')
+
+
+def history_etag(*parts: Any) -> str:
+    """ETag (unquoted) for a version of a history view; parts must identify the version and the view"""
+    return 'h-' + hashlib.sha1(':'.join(str(part) for part in parts).encode('utf-8')).hexdigest()[:20]
+
+
+def parse_fields(value: Optional[str]) -> Optional[List[str]]:
+    """Comma-separated field names, or None for every field"""
+    fields = [field.strip() for field in (value or '').split(',') if field.strip()]
+    return fields or None
+
+
+def project_message(message: Dict[str, Any], fields: Optional[Sequence[str]] = None,
+                    preview: Optional[int] = None) -> Dict[str, Any]:
+    """
+    A copy of a message with only the requested fields and its content cut to a preview
+
+    Args:
+        message: The message
+        fields: Fields to keep (all if None)
+        preview: Longest content kept, in characters; binary content is left out altogether
+
+    Returns:
+        The projected message; cut content is marked with ``truncated`` and its full ``size``
+    """
+    projected = {key: value for key, value in message.items() if fields is None or key in fields}
+    content = projected.get('content')
+    if preview is not None and isinstance(content, str):
+        if message.get('type') in _BINARY_TYPES:
+            projected['content'] = None
+            projected['truncated'] = True
+            projected['size'] = len(content)
+        elif len(content) > preview:
+            projected['content'] = content[:preview]
+            projected['truncated'] = True
+            projected['size'] = len(content)
+    return projected
+
+
+def history_page(messages: Sequence[Dict[str, Any]], start: int, total: int,
+                 fields: Optional[Sequence[str]] = None, preview: Optional[int] = None,
+                 branches: Optional[List[Dict[str, int]]] = None) -> Dict[str, Any]:
+    """
+    Envelope for one page of history
+
+    Args:
+        messages: The page's messages, starting at index ``start``
+        start: Index of the first message
+        total: Number of messages in the whole conversation
+        fields: Fields to keep (all if None)
+        preview: Longest content kept, in characters
+        branches: Indices of the conversation that have alternative branches, if known
+
+    Returns:
+        {"messages": [... each with its "index"], "start", "total",
+         "next": index to continue from, or None after the last page[, "branches"]}
+    """
+    page = []
+    for index, message in enumerate(messages, start):
+        projected = project_message(message, fields, preview)
+        projected['index'] = index
+        page.append(projected)
+    end = start + len(page)
+    envelope = {
+        "messages": page,
+        "start": start,
+        "total": total,
+        "next": end if end < total else None,
+    }
+    if branches is not None:
+        envelope["branches"] = branches
+    return envelope
@@ -0,0 +1,236 @@
+"""
+Routing of chats across several OpenAI-compatible local model servers
+
+Each configured backend is health-probed in the background through its
+/models endpoint. Every chat on a local model goes to the healthy backend
+with the lowest expected wait: (requests in flight + 1) times its observed
+time to first token, a moving average. If a backend fails before it
+produces anything, the turn is rolled back and retried on the next best
+one, so a dead or restarting GPU box costs one failed attempt rather than a
+failed chat.
+"""
+import sys
+import threading
+import time
+from typing import Any, Callable, Dict, Iterator, List, Optional, Sequence
+
+# Weight of the newest sample in the time-to-first-token moving average
+_TTFT_ALPHA = 0.3
+
+
+def normalize_api_base(api_base: Optional[str]) -> str:
+    """API base without a trailing slash, so equal bases compare equal"""
+    return (api_base or '').strip().rstrip('/')
+
+
+def parse_api_bases(value: Optional[str]) -> List[str]:
+    """Comma- or whitespace-separated API bases, normalized and deduplicated, in order"""
+    api_bases = []
+    for api_base in (value or '').replace(',', ' ').split():
+        api_base = normalize_api_base(api_base)
+        if api_base and api_base not in api_bases:
+            api_bases.append(api_base)
+    return api_bases
+
+
+class LlmBackend:
+    """Health and load of one model server"""
+
+    __slots__ = ('api_base', 'healthy', 'in_flight', 'ttft', 'requests', 'failures', 'last_error', 'checked_at')
+
+    def __init__(self, api_base: str):
+        self.api_base = api_base
+        # Optimistic until the first probe says otherwise
+        self.healthy = True
+        self.in_flight = 0
+        # Moving average of seconds to the first chunk, None until measured
+        self.ttft: Optional[float] = None
+        self.requests = 0
+        self.failures = 0
+        self.last_error: Optional[str] = None
+        self.checked_at = 0.0
+
+
+class LlmRouter:
+    """
+    Least-loaded, latency-aware choice between local model backends
+
+    Args:
+        api_bases: The backends' API base URLs; the first is the primary
+        probe: Called with an API base; raises if the backend is unhealthy
+        probe_interval: Seconds between health probes of each backend
+    """
+
+    def __init__(self, api_bases: Sequence[str], probe: Callable[[str], Any], probe_interval: float = 15):
+        self.backends = [LlmBackend(api_base) for api_base in parse_api_bases(' '.join(api_bases))]
+        self.probe = probe
+        self.probe_interval = probe_interval
+        self._prober: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+
+        # Stats
+        self.failovers = 0
+
+    @property
+    def primary(self) -> Optional[str]:
+        """The first configured API base, shown in settings and used for model lists"""
+        return self.backends[0].api_base if self.backends else None
+
+    @property
+    def api_bases(self) -> List[str]:
+        return [backend.api_base for backend in self.backends]
+
+    def routes(self, api_base: Optional[str]) -> bool:
+        """Whether chats to an API base are routed (i.e. it is one of the backends)"""
+        return normalize_api_base(api_base) in self.api_bases
+
+    def acquire(self, exclude: Sequence[LlmBackend] = ()) -> Optional[LlmBackend]:
+        """
+        Pick a backend for a chat and count it as in flight
+
+        Healthy backends are preferred; if none is left, an unhealthy one is
+        tried anyway, since its last probe may be stale.
+        Every acquire must be paired with a release().
+
+        Args:
+            exclude: Backends already tried for this chat
+
+        Returns:
+            The backend, or None if every backend has been tried
+        """
+        self.start()
+        with self._lock:
+            candidates = [backend for backend in self.backends if backend not in exclude]
+            if not candidates:
+                return None
+            known = [backend.ttft for backend in candidates if backend.ttft is not None]
+            # Unmeasured backends are assumed to be average, so they get tried
+            default_ttft = sum(known) / len(known) if known else 1.0
+
+            def expected_wait(backend):
+                return (not backend.healthy, (backend.in_flight + 1) * (backend.ttft or default_ttft),
+                        backend.requests)
+
+            backend = min(candidates, key=expected_wait)
+            backend.in_flight += 1
+            backend.requests += 1
+            return backend
+
+    def release(self, backend: LlmBackend):
+        """A chat on the backend has finished"""
+        with self._lock:
+            backend.in_flight = max(0, backend.in_flight - 1)
+
+    def record_first_token(self, backend: LlmBackend, seconds: float):
+        """Fold a time-to-first-token sample into the backend's average"""
+        with self._lock:
+            backend.healthy = True
+            backend.ttft = seconds if backend.ttft is None else \
+                _TTFT_ALPHA * seconds + (1 - _TTFT_ALPHA) * backend.ttft
+
+    def record_failure(self, backend: LlmBackend, error: Exception):
+        """Mark a backend unhealthy until its next successful probe"""
+        with self._lock:
+            backend.healthy = False
+            backend.failures += 1
+            backend.last_error = str(error)
+
+    def chat(self, interpreter: Any, prompt: str) -> Iterator[Any]:
+        """
+        An interpreter's chat stream, sent to the best backend when it uses a routed local model
+
+        If a backend raises before the first chunk, the messages the attempt
+        added are rolled back and the prompt is retried on the next backend.
+        After the first chunk errors propagate as usual, since the reply may
+        already have run code.
+
+        Args:
+            interpreter: The session's interpreter
+            prompt: The user's prompt
+
+        Returns:
+            The interpreter's chunks
+        """
+        if not self.routes(getattr(interpreter.llm, 'api_base', None)):
+            yield from interpreter.chat(prompt, stream=True, display=False)
+            return
+
+        first_new_message = len(interpreter.messages)
+        tried: List[LlmBackend] = []
+        while True:
+            backend = self.acquire(exclude=tried)
+            if backend is None:
+                raise RuntimeError(f"No local model backend could answer (tried {len(tried)})")
+            interpreter.llm.api_base = backend.api_base
+            stream = interpreter.chat(prompt, stream=True, display=False)
+            start_time = time.monotonic()
+            started = False
+            try:
+                for chunk in stream:
+                    if not started:
+                        started = True
+                        self.record_first_token(backend, time.monotonic() - start_time)
+                    yield chunk
+                return
+            except Exception as e:
+                if started:
+                    raise
+                self.record_failure(backend, e)
+                tried.append(backend)
+                if len(tried) >= len(self.backends):
+                    raise
+                with self._lock:
+                    self.failovers += 1
+                print(f"[Router] {backend.api_base} failed before its first token, failing over: {str(e)}",
+                      file=sys.stderr)
+                del interpreter.messages[first_new_message:]
+            finally:
+                # Closing the interpreter's generator stops the model request
+                stream.close()
+                self.release(backend)
+
+    def start(self):
+        """Start the background health probes (idempotent)"""
+        with self._lock:
+            if self._prober is not None or not self.backends:
+                return
+            self._prober = threading.Thread(target=self._probe_loop, name='llm-router', daemon=True)
+            self._prober.start()
+
+    @property
+    def stats(self) -> Dict[str, Any]:
+        """Health, load and latency of each backend"""
+        with self._lock:
+            return {
+                "failovers": self.failovers,
+                "backends": [{
+                    "api_base": backend.api_base,
+                    "healthy": backend.healthy,
+                    "in_flight": backend.in_flight,
+                    "ttft_ms": round(1000 * backend.ttft, 1) if backend.ttft is not None else None,
+                    "requests": backend.requests,
+                    "failures": backend.failures,
+                    "last_error": backend.last_error,
+                } for backend in self.backends],
+            }
+
+    def _probe_loop(self):
+        while True:
+            for backend in self.backends:
+                self._check(backend)
+            time.sleep(self.probe_interval)
+
+    def _check(self, backend: LlmBackend):
+        try:
+            self.probe(backend.api_base)
+            healthy, error = True, None
+        except Exception as e:
+            healthy, error = False, str(e)
+        with self._lock:
+            if backend.healthy != healthy:
+                print(f"[Router] {backend.api_base} is {'healthy' if healthy else 'unhealthy'}"
+                      + (f": {error}" if error else ''), file=sys.stderr)
+            backend.healthy = healthy
+            backend.checked_at = time.monotonic()
+            if error:
+                backend.last_error = error
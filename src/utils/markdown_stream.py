@@ -0,0 +1,216 @@
+"""
+Incremental server-side markdown rendering of streamed assistant messages
+
+The browser used to run marked over the whole accumulated message, and
+highlight.js over every code block, on every chunk, which is quadratic in
+the length of a reply. In this mode the server splits each message into
+top-level markdown blocks as it streams. A block is rendered to HTML once,
+as soon as it is closed by a blank line or the end of its code fence, and
+sent as a ``markdown`` chunk. That chunk also carries the raw text of the
+block still open (the ``tail``). The client appends finished fragments and
+renders only the short tail itself.
+
+Requires the optional ``markdown`` package; without it the mode is off and
+the client keeps rendering everything itself.
+"""
+import re
+from typing import Any, Dict, List, Optional
+
+try:
+    import markdown
+except ImportError:
+    markdown = None
+
+MARKDOWN_EXTENSIONS = ['fenced_code', 'tables', 'sane_lists']
+
+_FENCE_OPEN = re.compile(r'^ {0,3}(`{3,}|~{3,})')
+_LIST_ITEM = re.compile(r'^ {0,3}(?:[-*+]|\d{1,9}[.)])\s')
+
+# Flags on a message chunk that make the client start a new message element
+_NEW_MESSAGE_FLAGS = ('is_new_block', 'new_message', 'new_message_after_code')
+
+# Chunk types that pass through without ending the current message
+_PASSTHROUGH_TYPES = ('speech', 'markdown', 'fence_open', 'fence_close')
+
+
+def markdown_available() -> bool:
+    """Whether server-side rendering can be offered"""
+    return markdown is not None
+
+
+class IncrementalMarkdown:
+    """
+    Block-level incremental renderer for one message
+
+    Text goes in through ``feed()``; HTML for each block comes out once the
+    block can no longer change. A blank line only closes a block when the
+    next line doesn't continue it (an indented line, or another item of the
+    same list), so loose lists stay one list.
+    """
+
+    def __init__(self):
+        self._md = markdown.Markdown(extensions=MARKDOWN_EXTENSIONS)
+        # Text not rendered yet; complete lines before _scan have been looked at
+        self._buffer = ''
+        self._scan = 0
+        # Open code fence as (character, length), if inside one
+        self._fence: Optional[tuple] = None
+        self._has_content = False
+        self._is_list = False
+        self._after_blank = False
+
+    @property
+    def tail(self) -> str:
+        """Raw text of the block that is still open"""
+        return self._buffer
+
+    def feed(self, text: str) -> str:
+        """
+        Add text to the message
+
+        Returns:
+            HTML of the blocks the text closed (empty if none)
+        """
+        self._buffer += text
+        html = []
+        while True:
+            end = self._buffer.find('\n', self._scan)
+            if end < 0:
+                break
+            start, self._scan = self._scan, end + 1
+            cut = self._line(self._buffer[start:end], start, end + 1)
+            if cut is not None:
+                html.append(self._render(self._buffer[:cut]))
+                self._buffer = self._buffer[cut:]
+                self._scan -= cut
+        return ''.join(html)
+
+    def flush(self) -> str:
+        """
+        Render whatever is left, closing an unterminated code fence
+
+        Returns:
+            HTML of the rest of the message (empty if nothing is left)
+        """
+        text = self._buffer
+        if self._fence is not None:
+            text = text.rstrip('\n') + '\n' + self._fence[0] * self._fence[1] + '\n'
+        self._buffer = ''
+        self._scan = 0
+        self._fence = None
+        self._reset_block()
+        return self._render(text) if text.strip() else ''
+
+    def _line(self, line: str, start: int, end: int) -> Optional[int]:
+        """Track block state for one complete line; returns a buffer offset to render up to, if a block closed"""
+        if self._fence is not None:
+            stripped = line.strip()
+            char, length = self._fence
+            if stripped and set(stripped) == {char} and len(stripped) >= length and len(line) - len(line.lstrip()) < 4:
+                self._fence = None
+                self._reset_block()
+                return end
+            return None
+
+        if not line.strip():
+            if self._has_content:
+                self._after_blank = True
+            return None
+
+        cut = None
+        if self._after_blank:
+            continues = line[:1] in (' ', '\t') or (self._is_list and _LIST_ITEM.match(line))
+            if not continues:
+                cut = start
+                self._reset_block()
+            self._after_blank = False
+
+        if not self._has_content:
+            self._has_content = True
+            self._is_list = bool(_LIST_ITEM.match(line))
+        fence = _FENCE_OPEN.match(line)
+        if fence:
+            self._fence = (fence.group(1)[0], len(fence.group(1)))
+        return cut
+
+    def _reset_block(self):
+        self._has_content = False
+        self._is_list = False
+        self._after_blank = False
+
+    def _render(self, text: str) -> str:
+        self._md.reset()
+        return self._md.convert(text) + '\n'
+
+
+class MarkdownStream:
+    """
+    Adds rendered HTML to one generation's assistant messages
+
+    Feed every chunk through ``process()`` and call ``finish()`` at the end;
+    both return the chunks to publish instead. Message boundaries follow the
+    client's: a new message starts at a message chunk flagged as new, and
+    text between thinking_start and thinking_end isn't part of the message.
+    Any other chunk (code, output, ...) ends the current message first,
+    since the client adds its own markdown for those between the text.
+    """
+
+    def __init__(self):
+        self._renderer: Optional[IncrementalMarkdown] = None
+        self._thinking = False
+
+    def process(self, chunk: Any) -> List[Any]:
+        """
+        Route a chunk through the renderer
+
+        Args:
+            chunk: A UI-ready chunk
+
+        Returns:
+            The chunk, followed by a markdown chunk if it closed any blocks
+        """
+        chunk_type = chunk.get('type') if hasattr(chunk, 'get') else None
+        if chunk_type == 'thinking_start':
+            self._thinking = True
+            return [chunk]
+        if chunk_type == 'thinking_end':
+            self._thinking = False
+            return [chunk]
+        if chunk_type != 'message':
+            if chunk_type in _PASSTHROUGH_TYPES:
+                return [chunk]
+            return self.finish() + [chunk]
+        content = chunk.get('content')
+        if self._thinking or not isinstance(content, str):
+            return [chunk]
+
+        out = []
+        if any(chunk.get(flag) for flag in _NEW_MESSAGE_FLAGS):
+            # The rest of the previous message goes to the client before it moves on
+            out.extend(self.finish())
+        out.append(chunk)
+        if self._renderer is None:
+            self._renderer = IncrementalMarkdown()
+        html = self._renderer.feed(content)
+        if html:
+            out.append(self._chunk(html, self._renderer.tail))
+        return out
+
+    def finish(self) -> List[Dict[str, Any]]:
+        """
+        Render the rest of the current message
+
+        Returns:
+            A markdown chunk with the final HTML (possibly empty), if a message was open
+        """
+        if self._renderer is None:
+            return []
+        html = self._renderer.flush()
+        self._renderer = None
+        # Sent even when empty: it tells the client that the message's text is all rendered
+        return [self._chunk(html, '')]
+
+    @staticmethod
+    def _chunk(html: str, tail: str) -> Dict[str, Any]:
+        # Flagged as a new block so the compact encoding always sends its tail
+        return {"type": "markdown", "content": html, "tail": tail, "is_new_block": True, "skip_chat": True}
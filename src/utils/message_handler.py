@@ -1,8 +1,15 @@
 """
 Helper module for message handling in the web bridge
 """
+import json
 import sys
-from typing import Dict, Any, Union
+from typing import Dict, Any, Optional, Union
+
+# Final SSE frame sent when a generation has finished
+SSE_DONE = "data: [DONE]\n\n"
+
+# SSE comment sent on idle streams; clients ignore it
+SSE_KEEPALIVE = ": keepalive\n\n"
 
 def process_chunk_for_ui(chunk: Dict[str, Any]) -> Dict[str, Any]:
     """
@@ -62,3 +69,36 @@ def process_chunk_for_ui(chunk: Dict[str, Any]) -> Dict[str, Any]:
         'panel': 'chat',
         'new_message': chunk.get('is_new_block', False)
     }
+
+def format_sse_event(chunk: Union[Dict[str, Any], str, Any], event_id: Optional[int] = None) -> str:
+    """
+    Serialize a chunk from the chat stream into an SSE data frame
+    
+    Args:
+        chunk: A StreamChunk, a processed chunk dict, a JSON/plain string, or any other value
+        event_id: The stream event id, sent as the SSE ``id:`` field for resuming
+        
+    Returns:
+        The ``data: ...`` frame including the blank line terminator
+    """
+    if hasattr(chunk, 'to_json'):
+        # StreamChunks serialize themselves without an intermediate dict
+        chunk_str = chunk.to_json()
+    elif isinstance(chunk, dict):
+        # Already a dictionary, convert to JSON
+        chunk_str = json.dumps(chunk)
+    elif isinstance(chunk, str):
+        # Try parsing as JSON in case it's already a JSON string
+        try:
+            json.loads(chunk)  # Just to validate
+            chunk_str = chunk
+        except json.JSONDecodeError:
+            # If not valid JSON, wrap it as a message
+            chunk_str = json.dumps({"type": "message", "content": chunk})
+    else:
+        # For any other type, convert to string and wrap as message
+        chunk_str = json.dumps({"type": "message", "content": str(chunk)})
+    
+    if event_id is not None:
+        return f"id: {event_id}\ndata: {chunk_str}\n\n"
+    return f"data: {chunk_str}\n\n"
@@ -0,0 +1,139 @@
+"""
+Cached model lists for OpenAI-compatible API bases
+
+The settings panel asks for the model list on every page load and settings
+change. Each API base's list is cached for ``ttl`` seconds. After that the
+cached list is still served straight away (stale-while-revalidate) while a
+single background refresh runs. A slow or restarting local model server
+therefore never holds up a page load, and it is polled at most once per
+``ttl`` however many clients ask.
+"""
+import sys
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Optional
+
+
+class _Entry:
+    """Cached list and refresh state for one API base"""
+
+    __slots__ = ('payload', 'fetched_at', 'attempted_at', 'error', 'refreshing', 'loaded')
+
+    def __init__(self):
+        self.payload: Optional[Dict[str, Any]] = None
+        self.fetched_at = 0.0
+        self.attempted_at = 0.0
+        self.error: Optional[str] = None
+        self.refreshing = False
+        # Set once the first fetch has finished, successfully or not
+        self.loaded = threading.Event()
+
+
+class ModelCatalogue:
+    """
+    Per-API-base model list cache with background refresh
+
+    Args:
+        fetch: Called with an API base; returns the /models response JSON or raises
+        ttl: Seconds a list is fresh, and the minimum interval between fetches of one API base
+        error_ttl: Minimum interval between fetches after a failed one
+        max_entries: API bases remembered (least recently used are dropped)
+    """
+
+    def __init__(self, fetch: Callable[[str], Dict[str, Any]], ttl: float = 60, error_ttl: float = 10,
+                 max_entries: int = 32):
+        self.fetch = fetch
+        self.ttl = ttl
+        self.error_ttl = min(error_ttl, ttl)
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[str, _Entry]" = OrderedDict()
+        self._lock = threading.Lock()
+
+        # Stats
+        self.hits = 0
+        self.stale_hits = 0
+        self.fetches = 0
+        self.errors = 0
+
+    def get(self, api_base: str, timeout: float = 0) -> Dict[str, Any]:
+        """
+        The model list for an API base
+
+        Args:
+            api_base: The API base URL
+            timeout: Seconds to wait when nothing is cached yet
+
+        Returns:
+            {"payload": the /models JSON or None, "age": seconds since it was fetched or None,
+             "stale": bool, "error": last fetch error or None}
+        """
+        with self._lock:
+            entry = self._entries.get(api_base)
+            if entry is None:
+                entry = _Entry()
+                self._entries[api_base] = entry
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+            else:
+                self._entries.move_to_end(api_base)
+            now = time.monotonic()
+            fresh = entry.payload is not None and now - entry.fetched_at < self.ttl
+            if fresh:
+                self.hits += 1
+            elif entry.payload is not None:
+                self.stale_hits += 1
+            self._refresh_if_due(api_base, entry, now)
+
+        if entry.payload is None and timeout > 0:
+            entry.loaded.wait(timeout)
+
+        with self._lock:
+            age = time.monotonic() - entry.fetched_at if entry.payload is not None else None
+            return {
+                "payload": entry.payload,
+                "age": age,
+                "stale": age is not None and age >= self.ttl,
+                "error": entry.error,
+            }
+
+    @property
+    def stats(self) -> Dict[str, Any]:
+        """Hit and fetch counters"""
+        with self._lock:
+            return {
+                "api_bases": len(self._entries),
+                "hits": self.hits,
+                "stale_hits": self.stale_hits,
+                "fetches": self.fetches,
+                "errors": self.errors,
+            }
+
+    def _refresh_if_due(self, api_base: str, entry: _Entry, now: float):
+        """Start a background fetch unless one is running or the last attempt was recent (caller holds the lock)"""
+        interval = self.error_ttl if entry.error else self.ttl
+        if entry.refreshing or (entry.attempted_at and now - entry.attempted_at < interval):
+            return
+        entry.refreshing = True
+        entry.attempted_at = now
+        self.fetches += 1
+        thread = threading.Thread(target=self._fetch, args=(api_base, entry), name='model-catalogue', daemon=True)
+        thread.start()
+
+    def _fetch(self, api_base: str, entry: _Entry):
+        try:
+            payload = self.fetch(api_base)
+            with self._lock:
+                entry.payload = payload
+                entry.fetched_at = time.monotonic()
+                entry.error = None
+        except Exception as e:
+            # Keep serving the last good list
+            with self._lock:
+                entry.error = str(e)
+                self.errors += 1
+            print(f"[Models] Error fetching models from {api_base}: {str(e)}", file=sys.stderr)
+        finally:
+            with self._lock:
+                entry.refreshing = False
+            entry.loaded.set()
@@ -0,0 +1,335 @@
+"""
+Spill-to-disk storage for large code execution output
+
+A program that prints megabytes would otherwise turn every line into a
+stream chunk held in memory and sent to the browser. The OutputSpiller sits
+between the chunk translator and the replay buffer: once one execution's
+output passes a threshold, the rest of it is appended to a per-session file
+instead of being streamed. The stream gets a notice with a handle when
+spilling starts and the tail of the output when the execution ends.
+The full output can then be read back in byte ranges through the handle.
+"""
+import hashlib
+import os
+import re
+import shutil
+import sys
+import threading
+import uuid
+from typing import Any, Dict, List, Optional, Tuple
+
+from .chunk_coalescer import BOUNDARY_FLAGS
+
+# Handles are opaque hex ids
+HANDLE_PATTERN = re.compile(r'^[0-9a-f]{32}$')
+
+# Session directories are named with a hash of the session id
+_SESSION_DIR_PATTERN = re.compile(r'^[0-9a-f]{16}$')
+
+
+class OutputNotFound(Exception):
+    """Raised when a handle is unknown or belongs to another session"""
+
+
+class _Segment:
+    """One execution's spilled output: a byte range of its session's log file"""
+
+    __slots__ = ('session_id', 'path', 'offset', 'size')
+
+    def __init__(self, session_id: str, path: str, offset: int):
+        self.session_id = session_id
+        self.path = path
+        self.offset = offset
+        self.size = 0
+
+
+class OutputSpillStore:
+    """
+    Per-session append-only files holding spilled output
+
+    Args:
+        directory: Root directory for the session files
+        threshold: Bytes of one execution's output streamed before the rest is spilled (0 disables)
+        tail_bytes: Bytes from the end of spilled output sent when the execution finishes
+        max_file_bytes: Size at which a session's file stops accepting output
+    """
+
+    def __init__(self, directory: str, threshold: int = 65536, tail_bytes: int = 8192,
+                 max_file_bytes: int = 256 * 1024 * 1024):
+        self.directory = directory
+        self.threshold = threshold
+        self.tail_bytes = tail_bytes
+        self.max_file_bytes = max_file_bytes
+        self._segments: Dict[str, _Segment] = {}
+        self._lock = threading.Lock()
+        if self.enabled:
+            self._remove_stale()
+            print(f"[Output] Spilling output over {threshold} bytes to {directory}", file=sys.stderr)
+
+    @property
+    def enabled(self) -> bool:
+        """Whether spilling is turned on"""
+        return self.threshold > 0
+
+    def spiller(self, session_id: str) -> "OutputSpiller":
+        """Create the spiller for one generation in a session"""
+        return OutputSpiller(self, session_id)
+
+    def open_segment(self, session_id: str, initial: bytes) -> Tuple[str, _Segment]:
+        """
+        Start a new spilled segment at the end of the session's file
+
+        Args:
+            session_id: The owning session
+            initial: Output already seen for this execution, written first
+
+        Returns:
+            (handle, segment)
+        """
+        session_dir = os.path.join(self.directory, self._session_key(session_id))
+        os.makedirs(session_dir, exist_ok=True)
+        path = os.path.join(session_dir, 'output.log')
+        with self._lock:
+            offset = os.path.getsize(path) if os.path.exists(path) else 0
+            segment = _Segment(session_id, path, offset)
+            handle = uuid.uuid4().hex
+            self._segments[handle] = segment
+        self.append(segment, initial)
+        return handle, segment
+
+    def append(self, segment: _Segment, data: bytes) -> bool:
+        """
+        Append output to a segment
+
+        Returns:
+            False if the session's file is full and the data was discarded
+        """
+        with self._lock:
+            if segment.offset + segment.size + len(data) > self.max_file_bytes:
+                return False
+            with open(segment.path, 'ab') as f:
+                f.write(data)
+            segment.size += len(data)
+        return True
+
+    def size(self, handle: str, session_id: str) -> int:
+        """
+        Total size in bytes of a spilled output (it grows while the execution runs)
+
+        Raises:
+            OutputNotFound: If the handle is unknown to this session
+        """
+        return self._lookup(handle, session_id).size
+
+    def read(self, handle: str, session_id: str, start: int = 0, end: Optional[int] = None) -> Tuple[bytes, int]:
+        """
+        Read a byte range of a spilled output
+
+        Args:
+            handle: The output handle
+            session_id: The requesting session (handles are private to their session)
+            start: First byte to read
+            end: Last byte to read, inclusive (None reads to the end)
+
+        Returns:
+            (data, total size)
+
+        Raises:
+            OutputNotFound: If the handle is unknown to this session
+        """
+        segment = self._lookup(handle, session_id)
+        size = segment.size
+        end = size - 1 if end is None else min(end, size - 1)
+        if start > end:
+            return b'', size
+        with open(segment.path, 'rb') as f:
+            f.seek(segment.offset + start)
+            return f.read(end - start + 1), size
+
+    def remove_session(self, session_id: str):
+        """Delete a session's spilled output"""
+        with self._lock:
+            for handle in [h for h, s in self._segments.items() if s.session_id == session_id]:
+                del self._segments[handle]
+        shutil.rmtree(os.path.join(self.directory, self._session_key(session_id)), ignore_errors=True)
+
+    def _lookup(self, handle: str, session_id: str) -> _Segment:
+        with self._lock:
+            segment = self._segments.get(handle)
+        if segment is None or segment.session_id != session_id:
+            raise OutputNotFound(f"Unknown output handle: {handle}")
+        return segment
+
+    @staticmethod
+    def _session_key(session_id: str) -> str:
+        """Filesystem-safe directory name for a session"""
+        return hashlib.sha256(session_id.encode('utf-8')).hexdigest()[:16]
+
+    def _remove_stale(self):
+        """Delete session directories left behind by a previous run"""
+        if not os.path.isdir(self.directory):
+            return
+        for name in os.listdir(self.directory):
+            if _SESSION_DIR_PATTERN.match(name):
+                shutil.rmtree(os.path.join(self.directory, name), ignore_errors=True)
+
+
+class OutputSpiller:
+    """
+    Tracks one generation's output blocks and diverts large ones to disk
+
+    Feed every chunk through ``process()`` and call ``finish()`` at the end;
+    both return the chunks to publish instead.
+    """
+
+    def __init__(self, store: OutputSpillStore, session_id: str):
+        self.store = store
+        self.session_id = session_id
+        # Handle of each output block in stream order (None if it wasn't spilled)
+        self.handles: List[Optional[str]] = []
+        # What history keeps of each spilled block: the streamed head, the notices and the tail
+        self.contents: List[Optional[str]] = []
+        self._in_block = False
+        self._head: List[bytes] = []
+        self._size = 0
+        self._handle: Optional[str] = None
+        self._segment: Optional[_Segment] = None
+        self._tail = b''
+        self._streamed = 0
+        self._truncated = False
+        self._kept = ''
+
+    def process(self, chunk: Any) -> List[Any]:
+        """
+        Route a chunk through the spiller
+
+        Args:
+            chunk: A UI-ready chunk from the translator
+
+        Returns:
+            The chunks to publish in its place
+        """
+        if not self.store.enabled:
+            return [chunk]
+        chunk_type = chunk.get('type') if hasattr(chunk, 'get') else None
+        if chunk_type == 'console':
+            # Active line markers interleave with a running execution's output
+            return [chunk]
+        if chunk_type != 'output':
+            return self.finish() + [chunk]
+
+        if not self._in_block:
+            self._start_block()
+
+        content = chunk.get('content')
+        data = content.encode('utf-8') if isinstance(content, str) else b''
+        self._size += len(data)
+
+        if self._segment is None:
+            if self._size <= self.store.threshold:
+                self._head.append(data)
+                return [chunk]
+            head = b''.join(self._head)
+            self._handle, self._segment = self.store.open_segment(self.session_id, head + data)
+            self._streamed = self._size - len(data)
+            self._head = []
+            self._tail = data[-self.store.tail_bytes:]
+            print(f"[Output] Spilling output block to {self._handle}", file=sys.stderr)
+            notice = self._notice(chunk, "\n[Output is large; the rest is saved on the server]\n")
+            self._kept = head.decode('utf-8', errors='replace') + notice['content']
+            return [notice]
+
+        if not self.store.append(self._segment, data):
+            self._truncated = True
+        self._tail = (self._tail + data)[-self.store.tail_bytes:]
+
+        # Chunks carrying flags still go out, without their content
+        if chunk.get('is_end') or any(chunk.get(flag) for flag in BOUNDARY_FLAGS):
+            flagged = chunk.copy()
+            flagged['content'] = ''
+            return [flagged]
+        return []
+
+    def finish(self) -> List[Any]:
+        """
+        Close the current output block
+
+        Returns:
+            A summary chunk with the tail of the output if the block was spilled
+        """
+        if not self._in_block:
+            return []
+        self._in_block = False
+        self.handles.append(self._handle)
+        if self._segment is None:
+            self.contents.append(None)
+            return []
+
+        omitted = max(0, self._segment.size - self._streamed - len(self._tail))
+        note = f"\n[... {omitted} bytes omitted"
+        if self._truncated:
+            note += ", output beyond the server's limit was discarded"
+        summary = {
+            "type": "output",
+            "panel": "output",
+            "skip_chat": True,
+            "content": note + " ...]\n" + self._tail.decode('utf-8', errors='replace'),
+            "output_handle": self._handle,
+            "output_size": self._segment.size,
+        }
+        self.contents.append(self._kept + summary['content'])
+        self._segment = None
+        self._handle = None
+        self._tail = b''
+        self._kept = ''
+        return [summary]
+
+    def _start_block(self):
+        self._in_block = True
+        self._head = []
+        self._size = 0
+        self._truncated = False
+
+    def _notice(self, chunk: Any, text: str) -> Dict[str, Any]:
+        """Output chunk announcing that this block is being spilled"""
+        notice = chunk.to_dict() if hasattr(chunk, 'to_dict') else dict(chunk)
+        notice.update({"content": text, "output_handle": self._handle})
+        return notice
+
+
+def attach_output_handles(messages: List[Dict[str, Any]], spiller: OutputSpiller):
+    """
+    Replace the spilled console output messages of a generation with what was streamed
+
+    Each spilled message keeps only the head, the notices and the tail of its
+    output, and is tagged with the handle serving the rest.
+
+    Args:
+        messages: The interpreter messages added by the generation
+        spiller: The generation's OutputSpiller, after finish()
+    """
+    outputs = [m for m in messages
+               if m.get('role') == 'computer' and m.get('type') == 'console' and m.get('format') == 'output']
+    for message, handle, content in zip(outputs, spiller.handles, spiller.contents):
+        if handle is not None:
+            message['content'] = content
+            message['output_handle'] = handle
+
+
+def without_output_handles(messages: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """
+    Messages with their output handles removed, for storing beyond the spill files' lifetime
+
+    Spill files are deleted with their session and at startup, so a stored or
+    restored conversation must not advertise them.
+
+    Args:
+        messages: Conversation messages (left unchanged)
+
+    Returns:
+        The same list if no message has a handle, otherwise a new list with copies of those that do
+    """
+    if not any('output_handle' in message for message in messages):
+        return messages
+    return [{k: v for k, v in message.items() if k != 'output_handle'} if 'output_handle' in message else message
+            for message in messages]
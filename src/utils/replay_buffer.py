@@ -0,0 +1,378 @@
+"""
+Replay buffer for resumable chat streams
+
+Each generation writes its chunks into a ReplayBuffer, which numbers them with
+monotonically increasing event ids (sent as the SSE ``id:`` field). Readers
+follow the buffer with a cursor instead of popping from a queue, so when a
+connection drops the client can reconnect with ``Last-Event-ID`` and pick up
+where it left off, without another model call.
+
+Chunks that have not been delivered yet are always kept. Once delivered,
+only the most recent ``capacity`` events are retained for replay.
+
+The number of undelivered events is bounded too, so a slow or stalled client
+can't make the server buffer a chatty code execution without limit. When the
+buffer is full:
+
+- output/console chunks are merged into the newest unread chunk of the same
+  kind, or dropped once that chunk is large, with a marker reporting how
+  much output was lost
+- every other chunk (message and code text, flags, errors) blocks the
+  producer until readers catch up
+
+The buffer also counts attached readers, so the server can tell when every
+client has gone away, and carries the cancellation flag the producer polls.
+"""
+import itertools
+import threading
+import time
+from collections import deque
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+from .chunk_coalescer import ChunkCoalescer, BOUNDARY_FLAGS, merge_key
+
+Event = Tuple[int, Any]
+
+# Sent to a resuming client when the events it asked for have been trimmed
+REPLAY_GAP_CHUNK = {
+    "type": "error",
+    "content": "Part of this response is no longer available to replay",
+}
+
+# Chunk types that may be merged or dropped when the buffer is full
+DROPPABLE_TYPES = ('output', 'console')
+
+
+def _is_droppable(chunk: Any) -> bool:
+    """Whether a chunk is bulk output that the overflow policy may merge or drop"""
+    if not hasattr(chunk, 'get') or chunk.get('type') not in DROPPABLE_TYPES:
+        return False
+    return not chunk.get('is_end') and not any(chunk.get(flag) for flag in BOUNDARY_FLAGS)
+
+
+def _dropped_notice(size: int) -> Dict[str, Any]:
+    """Output chunk telling the client that output was dropped"""
+    return {
+        "type": "output",
+        "panel": "output",
+        "skip_chat": True,
+        "content": f"\n[{size} bytes of output dropped because the client fell behind]\n",
+    }
+
+
+class ReplayBuffer:
+    """
+    Numbered, bounded history of one generation's chunks
+
+    The producer calls ``put()`` (None ends the stream); readers call
+    ``read()`` with the id of the last event they have seen.
+
+    Args:
+        chat_id: The generation's chat ID
+        capacity: Number of delivered events kept for replay
+        max_pending: Number of undelivered events before the overflow policy applies (0 disables)
+        overflow_chunk_bytes: Largest output chunk the overflow policy builds by merging
+    """
+
+    def __init__(self, chat_id: str, capacity: int = 4096, max_pending: int = 1024,
+                 overflow_chunk_bytes: int = 65536):
+        self.chat_id = chat_id
+        self.capacity = capacity
+        self.max_pending = max_pending
+        self.overflow_chunk_bytes = overflow_chunk_bytes
+        self._events: "deque[Event]" = deque()
+        self._next_id = 1
+        self._delivered_id = 0
+        self._read_id = 0
+        self._unreported_drop = 0
+        self._closed = False
+        self._cancelled = False
+        self._readers = 0
+        self._ever_attached = False
+        self._cond = threading.Condition()
+        self._listeners: List[Callable[[], None]] = []
+
+        # Called when the last reader detaches while the stream is still open
+        self.on_abandoned: Optional[Callable[[], None]] = None
+
+        # Overflow stats
+        self.coalesced_chunks = 0
+        self.dropped_chunks = 0
+        self.dropped_bytes = 0
+        self.blocked_seconds = 0.0
+
+    @property
+    def closed(self) -> bool:
+        """Whether the producer has finished"""
+        return self._closed
+
+    @property
+    def cancelled(self) -> bool:
+        """Whether the generation has been asked to stop"""
+        return self._cancelled
+
+    @property
+    def readers(self) -> int:
+        """Number of readers currently following the buffer"""
+        return self._readers
+
+    @property
+    def ever_attached(self) -> bool:
+        """Whether any reader has attached so far"""
+        return self._ever_attached
+
+    @property
+    def last_id(self) -> int:
+        """Id of the newest event (0 if none yet)"""
+        return self._next_id - 1
+
+    @property
+    def first_id(self) -> int:
+        """Id of the oldest event still available for replay"""
+        with self._cond:
+            return self._events[0][0] if self._events else self._next_id
+
+    @property
+    def pending(self) -> int:
+        """Number of events not yet delivered to any reader"""
+        with self._cond:
+            return self.last_id - self._delivered_id
+
+    @property
+    def stats(self) -> Dict[str, Any]:
+        """Queue depth and overflow counters"""
+        with self._cond:
+            return {
+                "chat_id": self.chat_id,
+                "closed": self._closed,
+                "readers": self._readers,
+                "pending": self.pending,
+                "max_pending": self.max_pending,
+                "coalesced_chunks": self.coalesced_chunks,
+                "dropped_chunks": self.dropped_chunks,
+                "dropped_bytes": self.dropped_bytes,
+                "blocked_seconds": round(self.blocked_seconds, 3),
+            }
+
+    def put(self, chunk: Any):
+        """
+        Append a chunk from the producer
+
+        May block while the buffer is full, unless the chunk is output that
+        can be merged or dropped (see the module docstring).
+
+        Args:
+            chunk: The chunk to publish, or None to end the stream
+        """
+        with self._cond:
+            if self._closed:
+                return
+            if chunk is None:
+                self._report_dropped()
+                self._closed = True
+            elif self._full() and _is_droppable(chunk):
+                self._merge_or_drop(chunk)
+            else:
+                if self._full():
+                    # Conversation text and flags must arrive: wait for readers
+                    started = time.monotonic()
+                    while self._full() and not self._cancelled:
+                        self._cond.wait()
+                    self.blocked_seconds += time.monotonic() - started
+                self._report_dropped()
+                self._append(chunk)
+            self._cond.notify_all()
+            listeners = list(self._listeners)
+
+        for listener in listeners:
+            listener()
+
+    def read(self, after_id: int, timeout: Optional[float] = None) -> Tuple[List[Event], bool]:
+        """
+        Get the events after a cursor, waiting for new ones if there are none
+
+        Args:
+            after_id: Id of the last event the reader has seen
+            timeout: Seconds to wait for new events (None waits indefinitely)
+
+        Returns:
+            (events, finished) where finished means the stream has ended and
+            the reader has now seen everything
+        """
+        with self._cond:
+            if after_id >= self.last_id and not self._closed:
+                self._cond.wait(timeout)
+            events = self._after(after_id)
+            cursor = events[-1][0] if events else after_id
+            self._read_id = max(self._read_id, cursor)
+            return events, self._closed and cursor >= self.last_id
+
+    def mark_delivered(self, event_id: Optional[int]):
+        """Record that a reader has sent everything up to event_id"""
+        if event_id is None:
+            return
+        with self._cond:
+            if event_id > self._delivered_id:
+                self._delivered_id = event_id
+                self._trim()
+                # Wake a producer waiting for room
+                self._cond.notify_all()
+
+    def cancel(self) -> bool:
+        """
+        Ask the producer to stop
+
+        Returns:
+            True if the stream was still running and hadn't already been cancelled
+        """
+        with self._cond:
+            if self._closed or self._cancelled:
+                return False
+            self._cancelled = True
+            self._cond.notify_all()
+            return True
+
+    def attach(self):
+        """Register a reader"""
+        with self._cond:
+            self._readers += 1
+            self._ever_attached = True
+
+    def detach(self):
+        """Unregister a reader, calling on_abandoned if it was the last one"""
+        with self._cond:
+            self._readers -= 1
+            abandoned = self._readers == 0 and not self._closed
+        if abandoned and self.on_abandoned is not None:
+            self.on_abandoned()
+
+    def add_listener(self, listener: Callable[[], None]):
+        """Call listener (from the producer's thread) whenever the buffer changes"""
+        with self._cond:
+            self._listeners.append(listener)
+
+    def remove_listener(self, listener: Callable[[], None]):
+        """Stop notifying a listener"""
+        with self._cond:
+            if listener in self._listeners:
+                self._listeners.remove(listener)
+
+    def _full(self) -> bool:
+        """Whether undelivered events have reached max_pending (caller holds the lock)"""
+        return bool(self.max_pending) and self.pending >= self.max_pending
+
+    def _append(self, chunk: Any):
+        """Add a new event (caller holds the lock)"""
+        self._events.append((self._next_id, chunk))
+        self._next_id += 1
+        self._trim()
+
+    def _merge_or_drop(self, chunk: Any):
+        """Fold an output chunk into the newest unread event, or drop it (caller holds the lock)"""
+        content = chunk.get('content')
+        if self._events:
+            last_id, last = self._events[-1]
+            key = merge_key(chunk)
+            if (last_id > self._read_id and key is not None and key == merge_key(last)
+                    and len(last['content']) + len(content) <= self.overflow_chunk_bytes):
+                merged = last.copy()
+                merged['content'] = last['content'] + content
+                self._events[-1] = (last_id, merged)
+                self.coalesced_chunks += 1
+                return
+
+        size = len(content) if isinstance(content, str) else 0
+        self.dropped_chunks += 1
+        self.dropped_bytes += size
+        self._unreported_drop += size
+
+    def _report_dropped(self):
+        """Add a marker event for output dropped since the last one (caller holds the lock)"""
+        if self._unreported_drop:
+            self._append(_dropped_notice(self._unreported_drop))
+            self._unreported_drop = 0
+
+    def _after(self, after_id: int) -> List[Event]:
+        """Events newer than after_id (caller holds the lock)"""
+        if not self._events:
+            return []
+        start = max(0, after_id + 1 - self._events[0][0])
+        return list(itertools.islice(self._events, start, None))
+
+    def _trim(self):
+        """Drop the oldest delivered events beyond capacity (caller holds the lock)"""
+        while len(self._events) > self.capacity and self._events[0][0] <= self._delivered_id:
+            self._events.popleft()
+
+
+def collect_ready(events: List[Event], finished: bool,
+                  coalescer: Optional[ChunkCoalescer]) -> List[Tuple[Optional[int], Any]]:
+    """
+    Pass a batch of events through the optional coalescer
+
+    Args:
+        events: Events just read from the buffer (may be empty after a timeout)
+        finished: Whether the stream has ended
+        coalescer: The reader's coalescer, or None
+
+    Returns:
+        (event_id, chunk) pairs ready to be sent
+    """
+    if coalescer is None:
+        return events
+    ready = coalescer.flush_due() if not events else []
+    for event_id, chunk in events:
+        ready.extend(coalescer.add(chunk, event_id))
+    if finished:
+        ready.extend(coalescer.flush())
+    return ready
+
+
+def iter_events(buffer: ReplayBuffer, after_id: int = 0, coalescer: Optional[ChunkCoalescer] = None,
+                keepalive: Optional[float] = None) -> Iterator[Tuple[Optional[int], Any]]:
+    """
+    Follow a replay buffer from a cursor until the stream ends
+
+    Args:
+        buffer: The generation's replay buffer
+        after_id: Resume after this event id (0 reads from the start)
+        coalescer: Optional coalescer that merges consecutive chunks
+        keepalive: Yield a (None, None) keepalive after this many idle seconds,
+            so the writer notices a client that has gone away
+
+    Yields:
+        (event_id, chunk) pairs; each id is marked delivered once the
+        consumer asks for the next pair
+    """
+    buffer.attach()
+    try:
+        cursor = after_id
+        if cursor + 1 < buffer.first_id:
+            yield None, REPLAY_GAP_CHUNK
+            cursor = buffer.first_id - 1
+
+        last_sent = time.monotonic()
+        while True:
+            timeout = coalescer.time_until_flush() if coalescer is not None else None
+            if keepalive:
+                idle_left = max(0.0, keepalive - (time.monotonic() - last_sent))
+                timeout = idle_left if timeout is None else min(timeout, idle_left)
+            events, finished = buffer.read(cursor, timeout)
+            ready = collect_ready(events, finished, coalescer)
+
+            if events:
+                cursor = events[-1][0]
+            for event_id, chunk in ready:
+                yield event_id, chunk
+                buffer.mark_delivered(event_id)
+
+            if finished:
+                return
+
+            if ready:
+                last_sent = time.monotonic()
+            elif keepalive and time.monotonic() - last_sent >= keepalive:
+                yield None, None
+                last_sent = time.monotonic()
+    finally:
+        buffer.detach()
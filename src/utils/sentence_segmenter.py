@@ -0,0 +1,160 @@
+"""
+Incremental sentence segmentation of streamed assistant text
+
+The model's reply arrives as token-sized message deltas. The segmenter
+buffers them and hands back each sentence as soon as it is complete, so
+speech for it can be synthesized while the rest of the reply is still being
+generated. Fenced code blocks are skipped and light markdown is stripped,
+since neither should be read aloud.
+"""
+import re
+from typing import List
+
+# End of a sentence: terminal punctuation (plus closing quotes or brackets) followed
+# by whitespace, or a line break. The whitespace must have arrived, so "3.14" and
+# "file.txt" are never split while they are still streaming in.
+_BOUNDARY = re.compile(r'[.!?]+[\'")\]]*(?=\s)|\n')
+
+# Words whose trailing period does not end a sentence
+_ABBREVIATIONS = frozenset({
+    'mr', 'mrs', 'ms', 'dr', 'prof', 'sr', 'jr', 'st', 'vs', 'etc', 'e.g', 'i.e', 'approx', 'no', 'fig',
+})
+
+_FENCE = '```'
+
+_LINK = re.compile(r'!?\[([^\]]*)\]\([^)]*\)')
+_LINE_PREFIX = re.compile(r'^\s*(?:#{1,6}\s+|>\s*|[-*+]\s+|\d+[.)]\s+)', re.MULTILINE)
+_EMPHASIS = re.compile(r'[*_~`]+')
+_WHITESPACE = re.compile(r'\s+')
+_WORD = re.compile(r'\w')
+
+
+def strip_markdown(text: str) -> str:
+    """
+    Reduce a markdown fragment to the words that should be spoken
+
+    Returns:
+        The plain text, or '' if nothing speakable is left
+    """
+    text = _LINK.sub(r'\1', text)
+    text = _LINE_PREFIX.sub('', text)
+    text = _EMPHASIS.sub('', text)
+    text = _WHITESPACE.sub(' ', text).strip()
+    return text if _WORD.search(text) else ''
+
+
+class SentenceSegmenter:
+    """
+    Split streamed text into speakable sentences
+
+    Args:
+        min_chars: Sentences shorter than this are joined to the next one
+        max_chars: Text running this long without a boundary is split at a comma or space
+    """
+
+    def __init__(self, min_chars: int = 24, max_chars: int = 300):
+        self.min_chars = min_chars
+        self.max_chars = max_chars
+        # Text not yet checked for code fences
+        self._raw = ''
+        # Text outside code fences not yet split into sentences
+        self._text = ''
+        # Short sentences waiting to be joined to the next one
+        self._carry = ''
+        self._in_fence = False
+
+    def feed(self, text: str) -> List[str]:
+        """
+        Add a text delta
+
+        Args:
+            text: The next piece of the assistant's message
+
+        Returns:
+            Sentences completed by this delta (possibly none)
+        """
+        self._raw += text
+        self._consume_raw()
+        return self._split()
+
+    def flush(self) -> List[str]:
+        """
+        End the message and return whatever text is left as a final sentence
+
+        Returns:
+            A list with the final sentence, or an empty list
+        """
+        if not self._in_fence:
+            self._text += self._raw
+        self._raw = ''
+        self._in_fence = False
+        sentences = self._split()
+        rest = strip_markdown(self._carry + self._text)
+        self._carry = ''
+        self._text = ''
+        if rest:
+            sentences.append(rest)
+        return sentences
+
+    def _consume_raw(self):
+        """Move text outside code fences from _raw to _text"""
+        while self._raw:
+            marker = self._raw.find(_FENCE)
+            if marker < 0:
+                # Trailing backticks may be the start of a fence, so hold them back
+                keep = min(2, len(self._raw) - len(self._raw.rstrip('`')))
+                cut = len(self._raw) - keep
+                if not self._in_fence:
+                    self._text += self._raw[:cut]
+                self._raw = self._raw[cut:]
+                return
+            if not self._in_fence:
+                # A code block ends the sentence before it
+                self._text += self._raw[:marker] + '\n'
+            self._in_fence = not self._in_fence
+            self._raw = self._raw[marker + len(_FENCE):]
+
+    def _split(self) -> List[str]:
+        """Cut complete sentences off the front of _text"""
+        sentences = []
+        start = 0
+        for match in _BOUNDARY.finditer(self._text):
+            if match.group() != '\n' and not self._ends_sentence(self._text[start:match.start()]):
+                continue
+            self._add(self._text[start:match.end()], sentences)
+            start = match.end()
+
+        # Split overlong runs so a single sentence can't hold back the audio forever
+        while len(self._text) - start > self.max_chars:
+            window = self._text[start:start + self.max_chars]
+            cut = max(window.rfind(', '), window.rfind('; '))
+            if cut < self.max_chars // 2:
+                cut = window.rfind(' ')
+            cut = cut + 1 if cut > 0 else self.max_chars
+            self._add(self._text[start:start + cut], sentences)
+            start += cut
+
+        self._text = self._text[start:]
+        return sentences
+
+    def _add(self, piece: str, sentences: List[str]):
+        """Emit a piece once it (with any carried short sentences) is long enough"""
+        self._carry += piece
+        sentence = strip_markdown(self._carry)
+        if not sentence:
+            self._carry = ''
+        elif len(sentence) >= self.min_chars:
+            sentences.append(sentence)
+            self._carry = ''
+
+    @staticmethod
+    def _ends_sentence(before: str) -> bool:
+        """Whether punctuation after this text ends a sentence (not an abbreviation or list number)"""
+        words = before.split()
+        if not words:
+            return True
+        word = words[-1].lower().lstrip('(\'"')
+        if word in _ABBREVIATIONS or (len(word) == 1 and word.isalpha()):
+            return False
+        # "1. " at the start of a line is a list item
+        return not (word.isdigit() and len(words) == 1)
@@ -0,0 +1,230 @@
+"""
+Session management for the web bridge
+
+Each browser conversation gets its own OpenInterpreter instance and its own
+chunk channel, so concurrent users no longer share one global interpreter
+and one global queue.
+"""
+import sys
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, Optional
+
+from .conversation_tree import ConversationTree
+
+DEFAULT_SESSION_ID = "default"
+
+
+class SessionLimitError(Exception):
+    """Raised when no session slot can be freed for a new conversation"""
+
+
+class ChatSession:
+    """
+    State for a single conversation
+
+    The interpreter is built lazily on first access, so creating a session
+    (e.g. for /history or /settings) is cheap until the first chat.
+    """
+
+    def __init__(self, session_id: str, factory: Callable[[], Any],
+                 restore: Optional[Callable[[str, Any], None]] = None):
+        self.session_id = session_id
+        self._factory = factory
+        self._restore = restore
+        self._interpreter = None
+        self._init_lock = threading.Lock()
+
+        # Replay buffer of the current (or most recent) generation
+        self.generation = None
+
+        # Held while a generation is running for this session
+        self.generation_lock = threading.Lock()
+
+        self.created_at = time.time()
+        self.last_used = self.created_at
+
+        # Bumped whenever the interpreter's messages change; /history derives its ETag from it
+        self.history_version = 0
+
+        # Branches of the conversation; the interpreter's messages are its active path
+        self.tree = ConversationTree()
+
+        # Key of the client that owns the stored conversation (set by the first request that names it)
+        self.owner: Optional[str] = None
+
+    @property
+    def interpreter(self):
+        """The session's OpenInterpreter instance, constructed on first use"""
+        if self._interpreter is None:
+            with self._init_lock:
+                if self._interpreter is None:
+                    print(f"[Sessions] Creating interpreter for session {self.session_id}", file=sys.stderr)
+                    interpreter = self._factory()
+                    if self._restore is not None:
+                        try:
+                            self._restore(self.session_id, interpreter)
+                        except Exception as e:
+                            print(f"[Sessions] Error restoring session {self.session_id}: {str(e)}", file=sys.stderr)
+                    self._interpreter = interpreter
+        return self._interpreter
+
+    @property
+    def has_interpreter(self) -> bool:
+        """Whether the interpreter has been constructed yet"""
+        return self._interpreter is not None
+
+    @property
+    def busy(self) -> bool:
+        """Whether a generation is currently running for this session"""
+        return self.generation_lock.locked()
+
+    def touch(self):
+        """Mark the session as recently used"""
+        self.last_used = time.time()
+
+    def messages_changed(self):
+        """Record that the interpreter's messages were modified"""
+        self.history_version += 1
+
+    def terminate_code(self):
+        """Stop any code the session's interpreter is running"""
+        if self._interpreter is None:
+            return
+        try:
+            computer = getattr(self._interpreter, "computer", None)
+            if computer is not None and hasattr(computer, "terminate"):
+                computer.terminate()
+        except Exception as e:
+            print(f"[Sessions] Error terminating code in session {self.session_id}: {str(e)}", file=sys.stderr)
+
+    def close(self):
+        """Release resources held by the session's interpreter"""
+        self.terminate_code()
+        self._interpreter = None
+        self.tree.clear()
+
+
+class SessionManager:
+    """
+    Bounded pool of chat sessions with LRU eviction of idle sessions
+
+    Args:
+        factory: Callable that builds a new, configured interpreter
+        max_sessions: Maximum number of live sessions kept in memory
+        idle_timeout: Seconds after which an idle session is evicted (0 disables)
+        on_close: Optional callback run with each session that is evicted or removed
+        restore: Optional callback run with the session id and each new interpreter to reload saved state
+    """
+
+    def __init__(self, factory: Callable[[], Any], max_sessions: int = 16, idle_timeout: float = 3600,
+                 on_close: Optional[Callable[[ChatSession], None]] = None,
+                 restore: Optional[Callable[[str, Any], None]] = None):
+        self.factory = factory
+        self.restore = restore
+        self.max_sessions = max(1, max_sessions)
+        self.idle_timeout = idle_timeout
+        self.on_close = on_close
+        self._sessions: "OrderedDict[str, ChatSession]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, session_id: Optional[str] = None) -> ChatSession:
+        """
+        Get the session for an id, creating it if needed
+
+        Args:
+            session_id: The client supplied session id (falls back to the default session)
+
+        Returns:
+            The ChatSession for this id
+
+        Raises:
+            SessionLimitError: If the pool is full and every session is busy
+        """
+        session_id = session_id or DEFAULT_SESSION_ID
+        evicted = []
+        with self._lock:
+            evicted.extend(self._evict_expired())
+
+            session = self._sessions.get(session_id)
+            if session is not None:
+                self._sessions.move_to_end(session_id)
+            else:
+                while len(self._sessions) >= self.max_sessions:
+                    victim = self._pop_lru_idle()
+                    if victim is None:
+                        raise SessionLimitError(
+                            f"All {self.max_sessions} sessions are busy, try again later"
+                        )
+                    evicted.append(victim)
+                session = ChatSession(session_id, self.factory, self.restore)
+                self._sessions[session_id] = session
+            session.touch()
+
+        for victim in evicted:
+            self._close(victim)
+        return session
+
+    def peek(self, session_id: Optional[str] = None) -> Optional[ChatSession]:
+        """Get an existing session without creating one or updating its LRU position"""
+        with self._lock:
+            return self._sessions.get(session_id or DEFAULT_SESSION_ID)
+
+    def remove(self, session_id: str) -> bool:
+        """
+        Drop a session and release its interpreter
+
+        Returns:
+            True if the session existed
+        """
+        with self._lock:
+            session = self._sessions.pop(session_id, None)
+        if session is None:
+            return False
+        self._close(session)
+        return True
+
+    def sessions(self) -> List[ChatSession]:
+        """Snapshot of live sessions, least recently used first"""
+        with self._lock:
+            return list(self._sessions.values())
+
+    def stats(self) -> Dict[str, Any]:
+        """Summary of pool usage"""
+        sessions = self.sessions()
+        return {
+            "max_sessions": self.max_sessions,
+            "live_sessions": len(sessions),
+            "busy_sessions": sum(1 for s in sessions if s.busy),
+            "constructed_interpreters": sum(1 for s in sessions if s.has_interpreter),
+        }
+
+    def _close(self, session: ChatSession):
+        """Release a session that has left the pool"""
+        session.close()
+        if self.on_close is not None:
+            try:
+                self.on_close(session)
+            except Exception as e:
+                print(f"[Sessions] Error in close callback for {session.session_id}: {str(e)}", file=sys.stderr)
+
+    def _pop_lru_idle(self) -> Optional[ChatSession]:
+        """Remove and return the least recently used session that isn't generating"""
+        for session_id, session in self._sessions.items():
+            if not session.busy:
+                del self._sessions[session_id]
+                print(f"[Sessions] Evicting idle session {session_id}", file=sys.stderr)
+                return session
+        return None
+
+    def _evict_expired(self) -> List[ChatSession]:
+        """Remove sessions that have been idle longer than idle_timeout"""
+        if not self.idle_timeout:
+            return []
+        cutoff = time.time() - self.idle_timeout
+        expired = [
+            session_id for session_id, session in self._sessions.items()
+            if session.last_used < cutoff and not session.busy
+        ]
+        return [self._sessions.pop(session_id) for session_id in expired]
@@ -0,0 +1,171 @@
+"""
+Server-side rewrite of text into speech, with an emotion for the avatar
+
+Before a sentence is spoken, a small model rewrites it the way a person
+would say it (with Orpheus emotion tags) and picks the primary emotion.
+That is an extra LLM round trip in front of every clip, so results are kept
+in an LRU cache with a TTL, keyed on the normalized text, and identical
+requests that arrive while one is in flight share its result instead of
+each calling the model.
+"""
+import json
+import re
+import sys
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from contextlib import nullcontext
+from typing import Any, Callable, Dict, Optional, Tuple
+
+from .upstream import UpstreamClient
+
+EMOTIONS = ('happy', 'sad', 'angry', 'fear', 'disgust', 'love', 'neutral')
+
+SPEECH_REWRITE_PROMPT = """Analyze the text from the user and provide:
+1. Change the provided text to the way a human would say it.
+2. You can use the following emotion tags where appropriate <laugh>, <sigh>, <chuckle>, <cough>, <sniffle>, <groan>, <yawn>, <gasp>
+3. Choose primary emotion that best represents the tone (One of: happy, sad, angry, fear, disgust, love, neutral)
+4. No markdown or code blocks.
+
+Return your response in JSON format with properties "emotion" and "summary" only:
+{"emotion": "emotion_here", "summary": "<sigh>speech<laugh>"}"""
+
+_WHITESPACE = re.compile(r'\s+')
+
+
+def normalize_text(text: str) -> str:
+    """Collapse whitespace so trivially different copies of a sentence share a cache entry"""
+    return _WHITESPACE.sub(' ', text or '').strip()
+
+
+class SpeechRewriter:
+    """
+    Cached, single-flight speech rewriting
+
+    Args:
+        get_client: Returns the OpenAI client to call
+        model: Chat model used for the rewrite
+        max_entries: Rewrites kept in the LRU cache
+        ttl: Seconds a cached rewrite stays valid
+        enabled: When False, text is returned unchanged with a neutral emotion
+        upstream: Optional upstream whose circuit breaker and stats cover the model calls
+    """
+
+    def __init__(self, get_client: Callable[[], Any], model: str = 'gpt-4o-mini', max_entries: int = 1024,
+                 ttl: float = 3600, enabled: bool = True, upstream: Optional[UpstreamClient] = None):
+        self.get_client = get_client
+        self.upstream = upstream
+        self.model = model
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.enabled = enabled
+        # normalized text -> (expiry time, result)
+        self._cache: "OrderedDict[str, Tuple[float, Dict[str, str]]]" = OrderedDict()
+        # normalized text -> future of the rewrite in flight
+        self._inflight: Dict[str, Future] = {}
+        self._lock = threading.Lock()
+
+        # Stats
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.failures = 0
+
+    def rewrite(self, text: str) -> Dict[str, Any]:
+        """
+        Rewrite a piece of text for speech
+
+        Never raises: if the model fails, the text comes back unchanged with a
+        neutral emotion (and nothing is cached, so the next request retries).
+
+        Args:
+            text: The text to speak
+
+        Returns:
+            {"text": spoken text, "emotion": one of EMOTIONS, "cached": bool}
+        """
+        key = normalize_text(text)
+        if not key or not self.enabled:
+            return {"text": text, "emotion": "neutral", "cached": False}
+
+        with self._lock:
+            entry = self._cache.get(key)
+            if entry is not None:
+                if entry[0] > time.monotonic():
+                    self._cache.move_to_end(key)
+                    self.hits += 1
+                    return dict(entry[1], cached=True)
+                del self._cache[key]
+            future = self._inflight.get(key)
+            leader = future is None
+            if leader:
+                future = Future()
+                self._inflight[key] = future
+                self.misses += 1
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            # Someone is already rewriting this text; share their result
+            return dict(future.result(), cached=True)
+
+        result = {"text": key, "emotion": "neutral"}
+        try:
+            start_time = time.time()
+            result = self._complete(key)
+            print(f"[Speech] Rewrote {len(key)} chars in {time.time() - start_time:.2f} seconds", file=sys.stderr)
+            with self._lock:
+                self._remember(key, result)
+        except Exception as e:
+            with self._lock:
+                self.failures += 1
+            print(f"[Speech] Rewrite failed, speaking the text as written: {str(e)}", file=sys.stderr)
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+            future.set_result(result)
+        return dict(result, cached=False)
+
+    @property
+    def stats(self) -> Dict[str, Any]:
+        """Cache and deduplication counters"""
+        with self._lock:
+            return {
+                "enabled": self.enabled,
+                "model": self.model,
+                "entries": len(self._cache),
+                "hits": self.hits,
+                "misses": self.misses,
+                "coalesced": self.coalesced,
+                "failures": self.failures,
+            }
+
+    def _complete(self, text: str) -> Dict[str, str]:
+        """Ask the model for the spoken version and emotion"""
+        client = self.get_client()
+        with self.upstream.guard() if self.upstream is not None else nullcontext():
+            response = client.chat.completions.create(
+                model=self.model,
+                messages=[
+                    {"role": "system", "content": SPEECH_REWRITE_PROMPT},
+                    {"role": "user", "content": text},
+                ],
+                response_format={"type": "json_object"},
+                temperature=0.7,
+                max_tokens=max(100, len(text) // 2)
+            )
+        data = json.loads(response.choices[0].message.content)
+        emotion = str(data.get('emotion') or 'neutral').lower()
+        summary = normalize_text(str(data.get('summary') or ''))
+        return {
+            "text": summary or text,
+            "emotion": emotion if emotion in EMOTIONS else 'neutral',
+        }
+
+    def _remember(self, key: str, result: Dict[str, str]):
+        """Insert into the LRU and evict down to size (caller holds the lock)"""
+        self._cache[key] = (time.monotonic() + self.ttl, result)
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.max_entries:
+            self._cache.popitem(last=False)
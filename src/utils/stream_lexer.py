@@ -0,0 +1,195 @@
+"""
+Incremental lexing of streamed assistant text for thinking tags and code fences
+
+Thinking used to be detected by substring checks on each chunk on its own,
+so a ``<think>`` split across two deltas was missed, and every chunk was
+scanned several times. The lexer instead carries its state from one chunk
+to the next. It holds back only the few characters that could still turn
+into a tag or a fence line and looks at every other character once, so
+lexing a reply is linear in its length however it is chunked.
+
+Events are ``(kind, value)`` tuples, in stream order:
+
+- ``('text', text)``: text to display; thinking tags are removed, fence lines are kept
+- ``('thinking_start', '')`` / ``('thinking_end', '')``: a ``<think>`` / ``</think>`` tag
+- ``('fence_open', language)``: just before the line that opens a code fence
+- ``('fence_close', '')``: just after the line that closes it
+"""
+from typing import List, Optional, Tuple
+
+THINK_OPEN = '<think>'
+THINK_CLOSE = '</think>'
+
+# Longest partial fence line held back; longer lines are decided as they are
+_MAX_FENCE_LINE = 256
+
+# Outcomes of looking at the start of a line
+_TEXT, _OPEN, _CLOSE, _PARTIAL = range(4)
+
+Event = Tuple[str, str]
+
+
+class StreamLexer:
+    """
+    State machine over one stream of assistant text
+
+    Feed each delta to ``feed()``, and call ``flush()`` at the end of a
+    message for whatever is still held back.
+    """
+
+    def __init__(self):
+        self.thinking = False
+        # Open code fence as (character, length), if inside one
+        self.fence: Optional[Tuple[str, int]] = None
+        self._pending = ''
+        self._line_start = True
+
+    @property
+    def held(self) -> bool:
+        """Whether text is held back waiting for the next delta"""
+        return bool(self._pending)
+
+    def feed(self, text: str) -> List[Event]:
+        """
+        Lex the next piece of the stream
+
+        Returns:
+            The events it completed
+        """
+        if not self._pending and not self._line_start and '\n' not in text and \
+                ('<' not in text or (self.fence is not None and not self.thinking)):
+            # Mid-line text with nothing that could start a tag
+            return [('text', text)] if text else []
+        return self._scan(self._pending + text, final=False)
+
+    def flush(self) -> List[Event]:
+        """
+        Lex what is held back as if the stream ended here
+
+        Returns:
+            The remaining events
+        """
+        return self._scan(self._pending, final=True)
+
+    def reset(self):
+        """Forget fence and line state, e.g. at the start of a new message (thinking carries over)"""
+        self.fence = None
+        self._pending = ''
+        self._line_start = True
+
+    def _scan(self, buf: str, final: bool) -> List[Event]:
+        self._pending = ''
+        events: List[Event] = []
+        start = pos = 0
+        end = len(buf)
+        held = False
+        while pos < end:
+            newline = buf.find('\n', pos)
+            line_end = end if newline < 0 else newline
+
+            if self._line_start:
+                fence_end, complete = line_end, newline >= 0 or final
+                if self.thinking:
+                    # A fence line in the thinking ends where </think> may start
+                    tag_at = buf.find('<', pos, line_end)
+                    if tag_at >= 0:
+                        fence_end, complete = tag_at, True
+                kind, language = self._classify(buf, pos, fence_end, complete)
+                if kind == _PARTIAL:
+                    break
+                self._line_start = False
+                if kind == _OPEN:
+                    if pos > start:
+                        events.append(('text', buf[start:pos]))
+                    events.append(('fence_open', language))
+                    start = pos
+                elif kind == _CLOSE:
+                    self.fence = None
+                    closed_early = fence_end < line_end
+                    pos = fence_end if closed_early or newline < 0 else newline + 1
+                    events.append(('text', buf[start:pos]))
+                    events.append(('fence_close', ''))
+                    start = pos
+                    self._line_start = not closed_early
+                    continue
+
+            # Tags aren't recognized inside code, except the end of thinking
+            while self.fence is None or self.thinking:
+                tag_at = buf.find('<', pos, line_end)
+                if tag_at < 0:
+                    break
+                tag = self._tag(buf, tag_at, final)
+                if tag is None:
+                    pos = tag_at + 1
+                elif tag == '':
+                    # Could still become a tag once the next delta arrives
+                    pos = tag_at
+                    held = True
+                    break
+                else:
+                    if tag_at > start:
+                        events.append(('text', buf[start:tag_at]))
+                    if self.thinking and self.fence is not None:
+                        # A fence left open in the thinking doesn't run on into the reply
+                        self.fence = None
+                        events.append(('fence_close', ''))
+                    self.thinking = tag == THINK_OPEN
+                    events.append(('thinking_start' if self.thinking else 'thinking_end', ''))
+                    start = pos = tag_at + len(tag)
+
+            if held:
+                break
+            if newline < 0:
+                pos = end
+            else:
+                pos = newline + 1
+                self._line_start = True
+
+        if pos < end:
+            self._pending = buf[pos:]
+        if pos > start:
+            events.append(('text', buf[start:pos]))
+        return events
+
+    def _tag(self, buf: str, at: int, final: bool) -> Optional[str]:
+        """The thinking tag at a '<': the tag, '' if it may be one cut short, or None"""
+        tag = THINK_CLOSE if self.thinking or buf.startswith('</', at) else THINK_OPEN
+        if buf.startswith(tag, at):
+            return tag
+        rest = buf[at:at + len(tag)]
+        if not final and len(rest) < len(tag) and tag.startswith(rest):
+            return ''
+        return None
+
+    def _classify(self, buf: str, start: int, end: int, complete: bool) -> Tuple[int, str]:
+        """Whether the line at start opens or closes a fence, as (outcome, language)"""
+        indent = start
+        while indent < end and indent - start < 4 and buf[indent] == ' ':
+            indent += 1
+        if indent == end:
+            return (_TEXT, '') if complete or indent - start >= 4 else (_PARTIAL, '')
+        char = buf[indent]
+        if indent - start >= 4 or char not in '`~':
+            return _TEXT, ''
+
+        run = indent
+        while run < end and buf[run] == char:
+            run += 1
+        length = run - indent
+        if run == end and not complete and end - start < _MAX_FENCE_LINE:
+            return _PARTIAL, ''
+        if length < 3:
+            return _TEXT, ''
+
+        info = buf[run:end].strip()
+        if self.fence is not None:
+            if char == self.fence[0] and length >= self.fence[1] and not info:
+                return (_CLOSE, '') if complete or end - start >= _MAX_FENCE_LINE else (_PARTIAL, '')
+            return _TEXT, ''
+        if char == '`' and '`' in info:
+            # Inline code such as ```x```, not a fence
+            return _TEXT, ''
+        if not complete and end - start < _MAX_FENCE_LINE:
+            return _PARTIAL, ''
+        self.fence = (char, length)
+        return _OPEN, info.split()[0] if info else ''
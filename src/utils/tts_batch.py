@@ -0,0 +1,110 @@
+"""
+Batched speech synthesis for a block of text
+
+A client that already has a whole paragraph sends its sentences in one
+request. They are synthesized concurrently, up to a per-backend limit, and
+streamed back in order, each as soon as it and all sentences before it are
+done. A paragraph then takes about as long as its slowest sentence rather
+than the sum of all of them.
+
+Each result is one length-prefixed frame:
+
+    [4-byte big-endian header length][header JSON][4-byte audio length][audio]
+
+The header is {"index", "text", "cached", "media_type"} for a clip, or
+{"index", "text", "error", "status"} (and no audio) for a failed sentence.
+"""
+import json
+import struct
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Iterator, List, Optional
+
+from .sentence_segmenter import SentenceSegmenter
+from .tts_cache import TtsCache
+from .tts_engines import TtsError, synthesize_cached
+
+BATCH_MEDIA_TYPE = 'application/vnd.oi-tts-batch'
+
+# Most segments accepted in one request
+MAX_BATCH_SEGMENTS = 64
+
+
+def encode_batch_frame(header: Dict[str, Any], audio: bytes = b'') -> bytes:
+    """Build one length-prefixed result frame"""
+    head = json.dumps(header, ensure_ascii=False).encode('utf-8')
+    return struct.pack('>I', len(head)) + head + struct.pack('>I', len(audio)) + audio
+
+
+def split_sentences(text: str) -> List[str]:
+    """Split a block of text into the sentences to synthesize"""
+    segmenter = SentenceSegmenter()
+    return segmenter.feed(text) + segmenter.flush()
+
+
+class TtsBatchSynthesizer:
+    """
+    Per-backend worker pools for batched synthesis
+
+    Args:
+        cache: The audio cache results are read from and stored in
+        concurrency: Concurrent synthesis requests per engine name
+        default_concurrency: Limit for engines missing from ``concurrency``
+    """
+
+    def __init__(self, cache: TtsCache, concurrency: Optional[Dict[str, int]] = None,
+                 default_concurrency: int = 4):
+        self.cache = cache
+        self.concurrency = dict(concurrency or {})
+        self.default_concurrency = default_concurrency
+        self._executors: Dict[str, ThreadPoolExecutor] = {}
+        self._lock = threading.Lock()
+
+    def synthesize(self, engine: Any, segments: List[str], voice: str) -> Iterator[Dict[str, Any]]:
+        """
+        Synthesize segments concurrently, yielding results in order
+
+        Every segment is queued up front. Closing the iterator early (e.g. when
+        the client disconnects) cancels the ones that haven't started.
+
+        Args:
+            engine: The TTS engine
+            segments: Texts to speak, in playback order
+            voice: Requested voice
+
+        Returns:
+            An iterator of {"index", "text", "audio", "cached"} or {"index", "text", "error", "status"} dicts
+        """
+        executor = self._executor(engine)
+        # Repeated segments share one job
+        jobs = {}
+        futures = []
+        for text in segments:
+            key = engine.cache_key(text, voice)
+            if key not in jobs:
+                jobs[key] = executor.submit(synthesize_cached, engine, self.cache, text, voice)
+            futures.append(jobs[key])
+
+        def results():
+            try:
+                for index, (text, future) in enumerate(zip(segments, futures)):
+                    try:
+                        result = future.result()
+                    except TtsError as e:
+                        yield {"index": index, "text": text, "error": str(e), "status": e.status_code}
+                        continue
+                    yield {"index": index, "text": text, "audio": result['audio'], "cached": result['cached']}
+            finally:
+                for future in futures:
+                    future.cancel()
+        return results()
+
+    def _executor(self, engine: Any) -> ThreadPoolExecutor:
+        """The engine's worker pool, created on first use"""
+        with self._lock:
+            executor = self._executors.get(engine.name)
+            if executor is None:
+                workers = max(1, self.concurrency.get(engine.name, self.default_concurrency))
+                executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix=f'tts-{engine.name}')
+                self._executors[engine.name] = executor
+            return executor
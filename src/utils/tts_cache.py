@@ -0,0 +1,202 @@
+"""
+Content-addressed cache for synthesized speech
+
+Audio is keyed by a hash of everything that determines it (engine, model,
+voice, format and text), so repeated phrases and replayed messages skip the
+upstream synthesizer entirely. There are two tiers:
+
+- memory: an LRU holding up to ``memory_bytes`` of audio
+- disk: files under ``directory`` up to ``disk_bytes``, least recently used
+  evicted first, surviving restarts
+
+A disk hit is promoted into memory.
+"""
+import hashlib
+import json
+import os
+import sys
+import tempfile
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+
+
+def tts_cache_key(engine: str, model: str, voice: str, text: str, response_format: str = 'mp3') -> str:
+    """
+    Hash the parameters that determine a synthesized clip
+
+    Returns:
+        A hex digest used as the cache key
+    """
+    payload = json.dumps([engine, model, voice, response_format, text], ensure_ascii=False)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+class TtsCache:
+    """
+    Two-tier (memory + disk) LRU cache of audio bytes
+
+    Args:
+        memory_bytes: Byte budget of the in-memory tier (0 disables it)
+        directory: Directory of the disk tier (None disables it)
+        disk_bytes: Byte budget of the disk tier (0 disables it)
+    """
+
+    def __init__(self, memory_bytes: int = 32 * 1024 * 1024, directory: Optional[str] = None,
+                 disk_bytes: int = 512 * 1024 * 1024):
+        self.memory_bytes = memory_bytes
+        self.directory = directory if disk_bytes > 0 else None
+        self.disk_bytes = disk_bytes
+        self._memory: "OrderedDict[str, bytes]" = OrderedDict()
+        self._memory_size = 0
+        # key -> file size, least recently used first
+        self._disk: "OrderedDict[str, int]" = OrderedDict()
+        self._disk_size = 0
+        self._lock = threading.Lock()
+
+        # Stats
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+        if self.directory:
+            os.makedirs(self.directory, exist_ok=True)
+            self._load_disk_index()
+
+    def get(self, key: str) -> Optional[bytes]:
+        """
+        Look up a clip
+
+        Returns:
+            The audio bytes, or None on a miss
+        """
+        with self._lock:
+            audio = self._memory.get(key)
+            if audio is not None:
+                self._memory.move_to_end(key)
+                self.memory_hits += 1
+                return audio
+            on_disk = key in self._disk
+
+        if on_disk:
+            audio = self._read_disk(key)
+            if audio is not None:
+                with self._lock:
+                    self.disk_hits += 1
+                    if key in self._disk:
+                        self._disk.move_to_end(key)
+                    self._remember(key, audio)
+                return audio
+
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, key: str, audio: bytes):
+        """Store a clip in both tiers"""
+        if not audio:
+            return
+        with self._lock:
+            self._remember(key, audio)
+        if self.directory:
+            self._write_disk(key, audio)
+
+    @property
+    def stats(self) -> Dict[str, Any]:
+        """Hit/miss counters and tier usage"""
+        with self._lock:
+            lookups = self.memory_hits + self.disk_hits + self.misses
+            return {
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_rate": round((self.memory_hits + self.disk_hits) / lookups, 3) if lookups else 0.0,
+                "memory_entries": len(self._memory),
+                "memory_bytes": self._memory_size,
+                "disk_entries": len(self._disk),
+                "disk_bytes": self._disk_size,
+            }
+
+    def _remember(self, key: str, audio: bytes):
+        """Insert into the memory tier and evict down to budget (caller holds the lock)"""
+        if len(audio) > self.memory_bytes:
+            return
+        previous = self._memory.pop(key, None)
+        if previous is not None:
+            self._memory_size -= len(previous)
+        self._memory[key] = audio
+        self._memory_size += len(audio)
+        while self._memory_size > self.memory_bytes:
+            _, evicted = self._memory.popitem(last=False)
+            self._memory_size -= len(evicted)
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key[:2], key)
+
+    def _read_disk(self, key: str) -> Optional[bytes]:
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                audio = f.read()
+            os.utime(path)
+            return audio
+        except OSError:
+            with self._lock:
+                size = self._disk.pop(key, None)
+                if size is not None:
+                    self._disk_size -= size
+            return None
+
+    def _write_disk(self, key: str, audio: bytes):
+        """Write a clip atomically, then evict least recently used files down to budget"""
+        path = self._path(key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+            with os.fdopen(fd, 'wb') as f:
+                f.write(audio)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print(f"[TTS] Error writing cache file: {str(e)}", file=sys.stderr)
+            return
+
+        with self._lock:
+            previous = self._disk.pop(key, None)
+            if previous is not None:
+                self._disk_size -= previous
+            self._disk[key] = len(audio)
+            self._disk_size += len(audio)
+            evicted = []
+            while self._disk_size > self.disk_bytes and len(self._disk) > 1:
+                old_key, size = self._disk.popitem(last=False)
+                self._disk_size -= size
+                evicted.append(old_key)
+
+        for old_key in evicted:
+            try:
+                os.remove(self._path(old_key))
+            except OSError:
+                pass
+
+    def _load_disk_index(self):
+        """Rebuild the disk index from the cache directory, oldest access first"""
+        entries = []
+        for prefix in os.listdir(self.directory):
+            prefix_dir = os.path.join(self.directory, prefix)
+            if len(prefix) != 2 or not os.path.isdir(prefix_dir):
+                continue
+            for name in os.listdir(prefix_dir):
+                if len(name) != 64:
+                    # Leftover temp file from an interrupted write
+                    continue
+                try:
+                    stat = os.stat(os.path.join(prefix_dir, name))
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, name, stat.st_size))
+
+        for _, key, size in sorted(entries):
+            self._disk[key] = size
+            self._disk_size += size
+        print(f"[TTS] Audio cache: {len(self._disk)} clips ({self._disk_size} bytes) on disk in {self.directory}",
+              file=sys.stderr)
@@ -0,0 +1,222 @@
+"""
+Text-to-speech backends
+
+Each engine can synthesize a whole clip (for the base64 JSON endpoints and
+the cache) or stream the upstream audio body chunk by chunk, so playback can
+start as soon as the first bytes arrive. Streams are tee'd into the audio
+cache once they complete.
+"""
+import os
+import sys
+import time
+from typing import Any, Dict, Iterator, Optional
+
+import requests
+
+from .tts_cache import TtsCache, tts_cache_key
+from .upstream import UpstreamError, upstreams
+
+# Bytes per chunk forwarded from a streaming upstream response
+STREAM_CHUNK_BYTES = 4096
+
+
+class TtsError(Exception):
+    """Raised when the upstream synthesizer fails"""
+
+    def __init__(self, message: str, status_code: int = 500):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class OpenAiTts:
+    """OpenAI speech API (tts-1, MP3)"""
+
+    name = 'openai'
+    model = 'tts-1'
+    response_format = 'mp3'
+    media_type = 'audio/mpeg'
+    default_voice = 'alloy'
+
+    def cache_key(self, text: str, voice: str) -> str:
+        return tts_cache_key(self.name, self.model, voice, text, self.response_format)
+
+    def synthesize(self, text: str, voice: str) -> bytes:
+        """Synthesize a whole clip"""
+        try:
+            client = upstreams.openai()
+            with upstreams.get('openai').guard():
+                response = client.audio.speech.create(
+                    model=self.model,
+                    voice=voice,
+                    input=text,
+                    response_format=self.response_format
+                )
+                return response.content
+        except TtsError:
+            raise
+        except Exception as e:
+            raise TtsError(str(e), getattr(e, 'status_code', None) or 500)
+
+    def open_stream(self, text: str, voice: str) -> Iterator[bytes]:
+        """
+        Start a streaming synthesis
+
+        The upstream request is made before this returns, so errors surface
+        as TtsError rather than as a broken audio stream.
+
+        Returns:
+            An iterator over audio chunks (close it to abort the upstream request)
+        """
+        try:
+            client = upstreams.openai()
+            # The breaker and latency stats cover the request up to the response headers
+            with upstreams.get('openai').guard():
+                context = client.audio.speech.with_streaming_response.create(
+                    model=self.model,
+                    voice=voice,
+                    input=text,
+                    response_format=self.response_format
+                )
+                response = context.__enter__()
+        except TtsError:
+            raise
+        except Exception as e:
+            raise TtsError(str(e), getattr(e, 'status_code', None) or 500)
+
+        def chunks():
+            try:
+                for chunk in response.iter_bytes(STREAM_CHUNK_BYTES):
+                    yield chunk
+            finally:
+                context.__exit__(None, None, None)
+        return chunks()
+
+
+class OrpheusTts:
+    """Local Orpheus server with an OpenAI-compatible /v1/audio/speech route (WAV)"""
+
+    name = 'orpheus'
+    model = 'orpheus-3b-0.1-ft'
+    response_format = 'wav'
+    media_type = 'audio/wav'
+    # The Orpheus server only knows its own voices, so requests always use this one
+    default_voice = 'tara'
+
+    def __init__(self, api_base: Optional[str] = None):
+        api_base = api_base or os.environ.get('ORPEUS_MODEL_API_BASE', 'http://127.0.0.1:5005')
+        self.url = f"{api_base.rstrip('/')}/v1/audio/speech"
+        self._http = upstreams.get('orpheus')
+
+    def cache_key(self, text: str, voice: str) -> str:
+        return tts_cache_key(self.name, self.model, self.default_voice, text, self.response_format)
+
+    def synthesize(self, text: str, voice: str) -> bytes:
+        """Synthesize a whole clip"""
+        response = self._post(text)
+        return response.content
+
+    def open_stream(self, text: str, voice: str) -> Iterator[bytes]:
+        """
+        Start a streaming synthesis
+
+        Returns:
+            An iterator over audio chunks (close it to abort the upstream request)
+        """
+        response = self._post(text, stream=True)
+
+        def chunks():
+            try:
+                for chunk in response.iter_content(STREAM_CHUNK_BYTES):
+                    if chunk:
+                        yield chunk
+            finally:
+                response.close()
+        return chunks()
+
+    def _post(self, text: str, stream: bool = False) -> requests.Response:
+        payload = {
+            "input": text,
+            "model": self.model,
+            "voice": self.default_voice,
+            "response_format": self.response_format,
+            "speed": 1
+        }
+        try:
+            # Synthesis has no side effects, so failed attempts may be repeated
+            response = self._http.post(self.url, retry=True, json=payload, stream=stream)
+        except UpstreamError as e:
+            raise TtsError(f"Orpheus API request failed: {str(e)}", e.status_code)
+        if response.status_code != 200:
+            message = f"Orpheus API returned error: {response.status_code}, {response.text}"
+            response.close()
+            raise TtsError(message, response.status_code)
+        return response
+
+
+def synthesize_cached(engine: Any, cache: TtsCache, text: str, voice: str) -> Dict[str, Any]:
+    """
+    Synthesize a clip through the cache
+
+    Returns:
+        {"audio": bytes, "cached": bool}
+
+    Raises:
+        TtsError: If the upstream synthesizer fails
+    """
+    key = engine.cache_key(text, voice)
+    audio = cache.get(key)
+    if audio is not None:
+        return {"audio": audio, "cached": True}
+
+    start_time = time.time()
+    audio = engine.synthesize(text, voice)
+    print(f"[TTS] {engine.name} synthesized {len(audio)} bytes in {time.time() - start_time:.2f} seconds",
+          file=sys.stderr)
+    cache.put(key, audio)
+    return {"audio": audio, "cached": False}
+
+
+def stream_cached(engine: Any, cache: TtsCache, text: str, voice: str) -> Iterator[bytes]:
+    """
+    Stream a clip, from the cache if possible, storing completed streams in it
+
+    The upstream request is made eagerly, so an upstream failure raises
+    TtsError here instead of truncating the response.
+
+    Args:
+        engine: The TTS engine
+        cache: The audio cache
+        text: Text to speak
+        voice: Requested voice
+
+    Returns:
+        An iterator over audio chunks
+    """
+    key = engine.cache_key(text, voice)
+    audio = cache.get(key)
+    if audio is not None:
+        return iter([audio])
+
+    upstream = engine.open_stream(text, voice)
+    start_time = time.time()
+
+    def tee():
+        parts = []
+        first = True
+        completed = False
+        try:
+            for chunk in upstream:
+                if first:
+                    print(f"[TTS] {engine.name} first audio after {time.time() - start_time:.2f} seconds",
+                          file=sys.stderr)
+                    first = False
+                parts.append(chunk)
+                yield chunk
+            completed = True
+        finally:
+            if hasattr(upstream, 'close'):
+                upstream.close()
+            # Only cache clips that arrived in full
+            if completed:
+                cache.put(key, b''.join(parts))
+    return tee()
@@ -0,0 +1,261 @@
+"""
+Speculative speech synthesis driven by the chat stream
+
+While a reply streams, each completed sentence is submitted to a small
+worker pool that synthesizes it into the audio cache. The stream carries a
+``speech`` chunk with the sentence and its audio handle, so by the time the
+browser finishes playing one clip the next is usually already synthesized
+and is fetched from /api/tts/audio/<handle> without waiting on the backend.
+
+With a SpeechRewriter, each job first rewrites its sentence for speech, so
+the rewrite of the next sentence overlaps playback of the current one
+instead of sitting in front of it.
+"""
+import hashlib
+import re
+import sys
+import threading
+from concurrent.futures import CancelledError, Future, ThreadPoolExecutor, TimeoutError
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional
+
+from .sentence_segmenter import SentenceSegmenter
+from .speech_rewrite import SpeechRewriter
+from .tts_cache import TtsCache
+from .tts_engines import TtsError, synthesize_cached
+
+# Handles are audio cache keys (sha256 hex digests)
+AUDIO_HANDLE_PATTERN = re.compile(r'^[0-9a-f]{64}$')
+
+# Emotions of recently prefetched clips kept for the avatar
+_MAX_EMOTIONS = 1024
+
+
+def audio_media_type(audio: bytes) -> str:
+    """Media type of a synthesized clip, from its header"""
+    if audio[:4] == b'RIFF':
+        return 'audio/wav'
+    return 'audio/mpeg'
+
+
+class TtsPrefetcher:
+    """
+    Bounded pool that synthesizes sentences ahead of playback
+
+    Jobs run in submission order, so the sentences of a reply are ready in
+    the order they will be played.
+
+    Args:
+        cache: The audio cache finished clips are stored in
+        max_workers: Concurrent synthesis requests (0 disables prefetching)
+        max_pending: Sentences queued or running before new ones are refused
+        rewriter: Optional rewrite applied to each sentence before synthesis
+    """
+
+    def __init__(self, cache: TtsCache, max_workers: int = 2, max_pending: int = 32,
+                 rewriter: Optional[SpeechRewriter] = None):
+        self.cache = cache
+        self.max_pending = max_pending
+        self.rewriter = rewriter if rewriter is not None and rewriter.enabled else None
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='tts') \
+            if max_workers > 0 else None
+        # Handle -> future of jobs that haven't finished yet
+        self._jobs: Dict[str, Future] = {}
+        # Handle -> emotion picked by the rewriter, most recent last
+        self._emotions: "OrderedDict[str, str]" = OrderedDict()
+        self._lock = threading.Lock()
+
+        # Stats
+        self.submitted = 0
+        self.rejected = 0
+        self.failed = 0
+
+    @property
+    def enabled(self) -> bool:
+        """Whether prefetching is turned on"""
+        return self._executor is not None
+
+    def submit(self, engine: Any, text: str, voice: str) -> Optional[str]:
+        """
+        Queue a sentence for synthesis
+
+        Args:
+            engine: The TTS engine
+            text: Sentence to speak
+            voice: Requested voice
+
+        Returns:
+            The audio handle, or None if prefetching is disabled or the pool is saturated
+        """
+        if not self.enabled:
+            return None
+        handle = self.handle_for(engine, text, voice)
+        with self._lock:
+            if handle in self._jobs:
+                return handle
+            if len(self._jobs) >= self.max_pending:
+                self.rejected += 1
+                return None
+            self.submitted += 1
+            future = self._executor.submit(self._run, engine, text, voice, handle)
+            self._jobs[handle] = future
+        future.add_done_callback(lambda _: self._forget(handle, future))
+        return handle
+
+    def handle_for(self, engine: Any, text: str, voice: str) -> str:
+        """
+        Handle of a sentence's audio
+
+        Rewritten audio depends on the rewrite model as well as the text, so it
+        gets a key of its own rather than the plain synthesis cache key.
+        """
+        key = engine.cache_key(text, voice)
+        if self.rewriter is None:
+            return key
+        return hashlib.sha256(f"{key}:{self.rewriter.model}".encode('utf-8')).hexdigest()
+
+    def emotion(self, handle: str) -> Optional[str]:
+        """The emotion the rewriter picked for a clip, if known"""
+        with self._lock:
+            return self._emotions.get(handle)
+
+    def get(self, handle: str, timeout: Optional[float] = None) -> Optional[bytes]:
+        """
+        Audio for a handle, waiting for its synthesis if it is still running
+
+        Args:
+            handle: A handle returned by submit()
+            timeout: Seconds to wait for a running job
+
+        Returns:
+            The audio bytes, or None if the handle is unknown or its job was cancelled
+
+        Raises:
+            TtsError: If synthesis failed or didn't finish in time
+        """
+        with self._lock:
+            future = self._jobs.get(handle)
+        if future is not None:
+            try:
+                return future.result(timeout)
+            except CancelledError:
+                return None
+            except TimeoutError:
+                raise TtsError('Speech synthesis is taking too long', 504)
+        return self.cache.get(handle)
+
+    def cancel(self, handles: List[Optional[str]]):
+        """Drop queued jobs that haven't started yet (e.g. when their generation is cancelled)"""
+        with self._lock:
+            futures = [self._jobs.get(handle) for handle in handles if handle]
+        for future in futures:
+            if future is not None:
+                future.cancel()
+
+    @property
+    def stats(self) -> Dict[str, Any]:
+        """Job counters and queue depth"""
+        with self._lock:
+            return {
+                "submitted": self.submitted,
+                "rejected": self.rejected,
+                "failed": self.failed,
+                "pending": len(self._jobs),
+            }
+
+    def _run(self, engine: Any, text: str, voice: str, handle: str) -> bytes:
+        try:
+            if self.rewriter is None:
+                return synthesize_cached(engine, self.cache, text, voice)['audio']
+            spoken = self.rewriter.rewrite(text)
+            audio = synthesize_cached(engine, self.cache, spoken['text'], voice)['audio']
+            self.cache.put(handle, audio)
+            with self._lock:
+                self._emotions[handle] = spoken['emotion']
+                self._emotions.move_to_end(handle)
+                while len(self._emotions) > _MAX_EMOTIONS:
+                    self._emotions.popitem(last=False)
+            return audio
+        except TtsError as e:
+            with self._lock:
+                self.failed += 1
+            print(f"[TTS] Prefetch failed for '{text[:50]}...': {str(e)}", file=sys.stderr)
+            raise
+
+    def _forget(self, handle: str, future: Future):
+        """Remove a finished job; its audio is in the cache from now on"""
+        with self._lock:
+            if self._jobs.get(handle) is future:
+                del self._jobs[handle]
+
+
+class SpeechStream:
+    """
+    Turns one generation's assistant messages into speech chunks
+
+    Feed every chunk through ``process()`` and call ``finish()`` at the end;
+    both return the chunks to publish instead.
+
+    Args:
+        prefetcher: The synthesis pool
+        engine: The TTS engine to speak with
+        voice: Requested voice
+    """
+
+    def __init__(self, prefetcher: TtsPrefetcher, engine: Any, voice: str):
+        self.prefetcher = prefetcher
+        self.engine = engine
+        self.voice = voice
+        # Handle of each sentence in order (None if it wasn't prefetched)
+        self.handles: List[Optional[str]] = []
+        self._segmenter = SentenceSegmenter()
+        self._thinking = False
+
+    def process(self, chunk: Any) -> List[Any]:
+        """
+        Route a chunk through the segmenter
+
+        Args:
+            chunk: A UI-ready chunk
+
+        Returns:
+            The chunk, followed by a speech chunk for each sentence it completed
+        """
+        chunk_type = chunk.get('type') if hasattr(chunk, 'get') else None
+        if chunk_type == 'thinking_start':
+            self._thinking = True
+            return [chunk]
+        if chunk_type == 'thinking_end':
+            self._thinking = False
+            return [chunk]
+        if chunk_type != 'message':
+            # Code, output and errors end the spoken message
+            return self.finish() + [chunk] if chunk_type else [chunk]
+
+        content = chunk.get('content')
+        if self._thinking or chunk.get('thinking') or chunk.get('skip_chat') or not isinstance(content, str):
+            return [chunk]
+        return [chunk] + self._speak(self._segmenter.feed(content))
+
+    def finish(self) -> List[Dict[str, Any]]:
+        """
+        Speak the rest of the current message
+
+        Returns:
+            A speech chunk for the final sentence, if there is one
+        """
+        return self._speak(self._segmenter.flush())
+
+    def _speak(self, sentences: List[str]) -> List[Dict[str, Any]]:
+        chunks = []
+        for sentence in sentences:
+            handle = self.prefetcher.submit(self.engine, sentence, self.voice)
+            self.handles.append(handle)
+            chunks.append({
+                "type": "speech",
+                "content": sentence,
+                "audio": handle,
+                "media_type": self.engine.media_type,
+                "skip_chat": True,
+            })
+        return chunks
@@ -0,0 +1,318 @@
+"""
+Process-wide registry of clients for the upstream services
+
+Every upstream (the local model API, the Orpheus TTS server, OpenAI) gets
+one long-lived client with:
+
+- a pooled keep-alive HTTP session, so requests skip TCP and TLS setup
+- connect and read timeouts, so a hung upstream can't hold a worker forever
+- bounded retries with full jitter for connection errors and 502/503/504,
+  limited by a retry budget so retries can't multiply load on a struggling
+  upstream
+- a circuit breaker that fails fast after repeated failures and lets a
+  single trial request through once the cooldown is over
+- latency and error stats, reported by /api/stats
+
+Settings come from the environment, per upstream first and then globally:
+``UPSTREAM_ORPHEUS_READ_TIMEOUT`` overrides ``UPSTREAM_READ_TIMEOUT``.
+"""
+import os
+import random
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+
+# Statuses worth retrying: the upstream is restarting or overloaded
+RETRY_STATUSES = (502, 503, 504)
+
+# Latency samples kept per upstream
+_LATENCY_SAMPLES = 256
+
+DEFAULTS = {
+    'connect_timeout': 5.0,
+    'read_timeout': 60.0,
+    'retries': 2,
+    'backoff': 0.25,
+    'retry_budget': 0.2,
+    'breaker_threshold': 5,
+    'breaker_cooldown': 30.0,
+    'pool_size': 16,
+}
+
+
+class UpstreamError(Exception):
+    """Raised when an upstream request fails after any retries"""
+
+    def __init__(self, message: str, status_code: int = 502):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class CircuitOpenError(UpstreamError):
+    """Raised without contacting the upstream while its circuit breaker is open"""
+
+    def __init__(self, name: str, retry_after: float):
+        super().__init__(f"{name} is unavailable after repeated failures, retrying in {retry_after:.0f}s", 503)
+        self.retry_after = retry_after
+
+
+class UpstreamClient:
+    """
+    Pooled, guarded HTTP client for one upstream service
+
+    Args:
+        name: Upstream name used in errors and stats
+        connect_timeout: Seconds to establish a connection
+        read_timeout: Seconds to wait for each read from the upstream
+        retries: Extra attempts after a retryable failure
+        backoff: Base delay in seconds; attempt n sleeps a random time up to backoff * 2**n
+        retry_budget: Retries allowed as a fraction of requests (plus a small floor)
+        breaker_threshold: Consecutive failures that open the circuit (0 disables the breaker)
+        breaker_cooldown: Seconds the circuit stays open before a trial request
+        pool_size: Keep-alive connections kept per host
+    """
+
+    def __init__(self, name: str, connect_timeout: float = 5.0, read_timeout: float = 60.0, retries: int = 2,
+                 backoff: float = 0.25, retry_budget: float = 0.2, breaker_threshold: int = 5,
+                 breaker_cooldown: float = 30.0, pool_size: int = 16):
+        self.name = name
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.retry_budget = retry_budget
+        self.breaker_threshold = breaker_threshold
+        self.breaker_cooldown = breaker_cooldown
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=0)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        self._lock = threading.Lock()
+        self._consecutive_failures = 0
+        self._open_until = 0.0
+        self._trial_in_flight = False
+        self._latencies: deque = deque(maxlen=_LATENCY_SAMPLES)
+
+        # Stats
+        self.requests = 0
+        self.failures = 0
+        self.retried = 0
+        self.rejected = 0
+
+    @property
+    def timeout(self):
+        """(connect, read) timeout tuple for requests"""
+        return (self.connect_timeout, self.read_timeout)
+
+    def get(self, url: str, **kwargs) -> requests.Response:
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url: str, retry: bool = False, **kwargs) -> requests.Response:
+        """POST, retried only when the caller says the request is safe to repeat"""
+        return self.request('POST', url, retry=retry, **kwargs)
+
+    def request(self, method: str, url: str, retry: Optional[bool] = None, **kwargs) -> requests.Response:
+        """
+        Make a request through the pool, breaker and retry policy
+
+        Args:
+            method: HTTP method
+            url: Full URL
+            retry: Whether the request may be repeated (defaults to True for GET and HEAD)
+            **kwargs: Passed to requests (``timeout`` defaults to the upstream's)
+
+        Returns:
+            The response; 5xx responses that survive the retries are returned, not raised
+
+        Raises:
+            CircuitOpenError: If the circuit is open
+            UpstreamError: If the upstream couldn't be reached
+        """
+        if retry is None:
+            retry = method.upper() in ('GET', 'HEAD')
+        kwargs.setdefault('timeout', self.timeout)
+
+        attempt = 0
+        while True:
+            try:
+                with self.guard() as outcome:
+                    try:
+                        response = self.session.request(method, url, **kwargs)
+                    except requests.RequestException as e:
+                        raise UpstreamError(f"{self.name} request failed: {str(e)}")
+                    if response.status_code >= 500:
+                        outcome['failed'] = True
+            except CircuitOpenError:
+                raise
+            except UpstreamError:
+                if not (retry and self._may_retry(attempt)):
+                    raise
+            else:
+                if response.status_code not in RETRY_STATUSES or not (retry and self._may_retry(attempt)):
+                    return response
+                response.close()
+
+            time.sleep(random.uniform(0, self.backoff * (2 ** attempt)))
+            attempt += 1
+
+    @contextmanager
+    def guard(self) -> Iterator[Dict[str, Any]]:
+        """
+        Run one call to the upstream under the circuit breaker, recording its latency
+
+        Use it around calls made by other clients (e.g. the OpenAI SDK). An
+        exception, or setting ``outcome['failed']``, counts as a failure.
+
+        Raises:
+            CircuitOpenError: If the circuit is open
+        """
+        self._admit()
+        outcome = {'failed': False}
+        start_time = time.monotonic()
+        try:
+            yield outcome
+        except BaseException as e:
+            # Client errors (4xx) mean the upstream is up and answering
+            self._record(time.monotonic() - start_time, (getattr(e, 'status_code', None) or 500) < 500)
+            raise
+        self._record(time.monotonic() - start_time, not outcome['failed'])
+
+    @property
+    def state(self) -> str:
+        """Circuit breaker state: closed, open or half_open"""
+        with self._lock:
+            return self._state()
+
+    @property
+    def stats(self) -> Dict[str, Any]:
+        """Request, failure and retry counters, breaker state and latency percentiles"""
+        with self._lock:
+            latencies = sorted(self._latencies)
+            stats = {
+                "state": self._state(),
+                "requests": self.requests,
+                "failures": self.failures,
+                "retries": self.retried,
+                "rejected": self.rejected,
+                "consecutive_failures": self._consecutive_failures,
+            }
+        if latencies:
+            stats.update({
+                "latency_avg_ms": round(1000 * sum(latencies) / len(latencies), 1),
+                "latency_p50_ms": round(1000 * latencies[len(latencies) // 2], 1),
+                "latency_p95_ms": round(1000 * latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))], 1),
+            })
+        return stats
+
+    def _state(self) -> str:
+        if self._open_until == 0.0:
+            return 'closed'
+        return 'open' if time.monotonic() < self._open_until else 'half_open'
+
+    def _admit(self):
+        """Let a call through unless the circuit is open (caller must record the outcome)"""
+        with self._lock:
+            state = self._state()
+            if state == 'open' or (state == 'half_open' and self._trial_in_flight):
+                self.rejected += 1
+                raise CircuitOpenError(self.name, max(0.0, self._open_until - time.monotonic()))
+            if state == 'half_open':
+                self._trial_in_flight = True
+            self.requests += 1
+
+    def _record(self, elapsed: float, success: bool):
+        with self._lock:
+            self._latencies.append(elapsed)
+            self._trial_in_flight = False
+            if success:
+                self._consecutive_failures = 0
+                self._open_until = 0.0
+                return
+            self.failures += 1
+            self._consecutive_failures += 1
+            if self.breaker_threshold and (self._consecutive_failures >= self.breaker_threshold
+                                           or self._open_until):
+                # Open (or re-open after a failed trial)
+                self._open_until = time.monotonic() + self.breaker_cooldown
+
+    def _may_retry(self, attempt: int) -> bool:
+        """Whether another attempt is allowed by the per-request limit and the retry budget"""
+        with self._lock:
+            if attempt >= self.retries or self.retried >= 10 + self.retry_budget * self.requests:
+                return False
+            if self.breaker_threshold and self._open_until:
+                return False
+            self.retried += 1
+            return True
+
+
+class UpstreamRegistry:
+    """Process-wide clients, one per upstream name, configured from the environment"""
+
+    def __init__(self):
+        self._clients: Dict[str, UpstreamClient] = {}
+        self._openai = None
+        self._lock = threading.Lock()
+
+    def get(self, name: str, profile: Optional[str] = None) -> UpstreamClient:
+        """
+        The client for an upstream, created on first use
+
+        Args:
+            name: Upstream name; each name has its own pool, breaker and stats
+            profile: Name whose settings to use, when several upstreams share them (defaults to ``name``)
+        """
+        with self._lock:
+            client = self._clients.get(name)
+            if client is None:
+                client = UpstreamClient(name, **self.settings(profile or name))
+                self._clients[name] = client
+            return client
+
+    def openai(self):
+        """
+        The process-wide OpenAI SDK client, with the 'openai' upstream's timeouts and retries
+
+        Raises:
+            UpstreamError: If no API key is configured
+        """
+        if self._openai is None:
+            with self._lock:
+                if self._openai is None:
+                    if not os.environ.get('OPENAI_API_KEY'):
+                        raise UpstreamError('OpenAI API key not configured', 500)
+                    import httpx
+                    from openai import OpenAI
+                    settings = self.settings('openai')
+                    self._openai = OpenAI(
+                        timeout=httpx.Timeout(settings['read_timeout'], connect=settings['connect_timeout']),
+                        max_retries=settings['retries']
+                    )
+        return self._openai
+
+    def stats(self) -> Dict[str, Any]:
+        """Stats of every upstream used so far"""
+        with self._lock:
+            clients = list(self._clients.values())
+        return {client.name: client.stats for client in clients}
+
+    @staticmethod
+    def settings(name: str) -> Dict[str, Any]:
+        """An upstream's settings from UPSTREAM_<NAME>_<SETTING>, then UPSTREAM_<SETTING>, then the defaults"""
+        settings = {}
+        for key, default in DEFAULTS.items():
+            value = os.environ.get(f"UPSTREAM_{name.upper()}_{key.upper()}") or \
+                os.environ.get(f"UPSTREAM_{key.upper()}")
+            settings[key] = type(default)(value) if value else default
+        return settings
+
+
+# Shared by the whole process
+upstreams = UpstreamRegistry()
@@ -0,0 +1,194 @@
+"""
+Wire encodings for the chat stream
+
+The default encoding sends every chunk as a full JSON object. The compact
+encoding sends a chunk's metadata once, when its block opens, and afterwards
+only the block id and the content delta:
+
+    {"b": 3, "m": {"type": "code", "panel": "code", "language": "python", ...}, "d": "imp"}
+    [3, "ort os"]
+    [3, "\\n", 1]            <- third element marks the end of the block
+
+It is available as SSE (for browsers) and as length-prefixed MessagePack
+frames (for non-browser clients, requires the optional ``msgpack`` package).
+Clients pick an encoding with the Accept header or the ``stream_format``
+query parameter on /chat.
+"""
+import json
+import struct
+from typing import Any, Dict, Optional, Tuple, Union
+
+from .message_handler import format_sse_event, SSE_DONE, SSE_KEEPALIVE
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+COMPACT_MEDIA_TYPE = 'application/vnd.oi-stream.compact'
+MSGPACK_MEDIA_TYPE = 'application/x-msgpack'
+
+# Fields that describe a block; a change in any of them opens a new block
+BLOCK_FIELDS = ('type', 'panel', 'language', 'format', 'role', 'thinking', 'skip_chat', 'audio')
+
+# Flags that only apply to the chunk carrying them, so they always go in a header
+ONE_SHOT_FLAGS = ('is_new_block', 'new_message', 'new_ui_element', 'code_block_completed', 'new_message_after_code')
+
+_dumps = json.JSONEncoder(separators=(',', ':')).encode
+
+
+class UnsupportedStreamFormat(Exception):
+    """Raised when the client asks for an encoding this server can't produce"""
+
+
+def _as_dict(chunk: Any) -> Dict[str, Any]:
+    """Normalize a channel item (StreamChunk, dict or other) to a dict"""
+    if hasattr(chunk, 'to_dict'):
+        return chunk.to_dict()
+    if isinstance(chunk, dict):
+        return chunk
+    return {'type': 'message', 'content': str(chunk)}
+
+
+class SseJsonEncoder:
+    """The default encoding: one full JSON object per SSE frame"""
+
+    name = 'json'
+    media_type = 'text/event-stream'
+
+    def encode(self, chunk: Any, event_id: Optional[int] = None) -> str:
+        return format_sse_event(chunk, event_id)
+
+    def keepalive(self) -> str:
+        return SSE_KEEPALIVE
+
+    def done(self) -> str:
+        return SSE_DONE
+
+
+class CompactFramer:
+    """Turns chunks into compact header / delta frames, tracking open blocks"""
+
+    def __init__(self):
+        self._next_id = 0
+        self._block_id = 0
+        self._block_key: Optional[Tuple] = None
+
+    def frame(self, chunk: Any) -> Union[Dict[str, Any], list]:
+        """
+        Build the compact frame for a chunk
+
+        Args:
+            chunk: A StreamChunk or chunk dict
+
+        Returns:
+            A header dict when a block opens, otherwise a [block_id, delta(, 1)] list
+        """
+        data = _as_dict(chunk)
+        content = data.get('content', '')
+        is_end = bool(data.get('is_end'))
+        key = tuple(data.get(field) for field in BLOCK_FIELDS)
+
+        if key != self._block_key or any(data.get(flag) for flag in ONE_SHOT_FLAGS):
+            self._next_id += 1
+            self._block_id = self._next_id
+            self._block_key = key
+            frame = {
+                'b': self._block_id,
+                'm': {k: v for k, v in data.items() if k not in ('content', 'is_end')},
+                'd': content,
+            }
+            if is_end:
+                frame['e'] = 1
+        else:
+            frame = [self._block_id, content, 1] if is_end else [self._block_id, content]
+
+        if is_end:
+            # The next chunk always opens a fresh block
+            self._block_key = None
+        return frame
+
+
+class SseCompactEncoder:
+    """Compact frames over SSE"""
+
+    name = 'compact'
+    media_type = 'text/event-stream'
+
+    def __init__(self):
+        self._framer = CompactFramer()
+
+    def encode(self, chunk: Any, event_id: Optional[int] = None) -> str:
+        frame = f"data: {_dumps(self._framer.frame(chunk))}\n\n"
+        if event_id is not None:
+            return f"id: {event_id}\n{frame}"
+        return frame
+
+    def keepalive(self) -> str:
+        return SSE_KEEPALIVE
+
+    def done(self) -> str:
+        return SSE_DONE
+
+
+class MsgpackEncoder:
+    """Compact frames as 4-byte big-endian length-prefixed MessagePack; a nil frame ends the stream"""
+
+    name = 'msgpack'
+    media_type = MSGPACK_MEDIA_TYPE
+
+    def __init__(self):
+        if msgpack is None:
+            raise UnsupportedStreamFormat("MessagePack streaming requires the 'msgpack' package")
+        self._framer = CompactFramer()
+
+    def encode(self, chunk: Any, event_id: Optional[int] = None) -> bytes:
+        # Event ids (and so resuming) are only part of the SSE encodings
+        return self._pack(self._framer.frame(chunk))
+
+    def keepalive(self) -> Optional[bytes]:
+        # The framing has no no-op frame, so idle streams stay silent
+        return None
+
+    def done(self) -> bytes:
+        return self._pack(None)
+
+    @staticmethod
+    def _pack(value: Any) -> bytes:
+        payload = msgpack.packb(value, use_bin_type=True)
+        return struct.pack('>I', len(payload)) + payload
+
+
+ENCODERS = {
+    SseJsonEncoder.name: SseJsonEncoder,
+    SseCompactEncoder.name: SseCompactEncoder,
+    MsgpackEncoder.name: MsgpackEncoder,
+}
+
+
+def negotiate_stream_encoder(accept: Optional[str] = None, requested: Optional[str] = None):
+    """
+    Pick the stream encoder for a /chat request
+
+    Args:
+        accept: The request's Accept header
+        requested: The ``stream_format`` query parameter, which takes precedence
+
+    Returns:
+        A new encoder instance
+
+    Raises:
+        UnsupportedStreamFormat: If the requested format is unknown or unavailable
+    """
+    if requested:
+        encoder_class = ENCODERS.get(requested.lower())
+        if encoder_class is None:
+            raise UnsupportedStreamFormat(f"Unknown stream format: {requested}")
+        return encoder_class()
+
+    accept = (accept or '').lower()
+    if MSGPACK_MEDIA_TYPE in accept and msgpack is not None:
+        return MsgpackEncoder()
+    if COMPACT_MEDIA_TYPE in accept:
+        return SseCompactEncoder()
+    return SseJsonEncoder()